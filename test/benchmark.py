@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+''' offline benchmarks for ytarchiver
+
+Run from the main directory with
+$ python3 test/benchmark.py [-n VIDEOS] [-c CHANNELS] [-l LATENCY] [BENCHMARK ...]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ytacommon as yta
+import ytameta
+import ytaquota
+import ytalog
+from fakeapi import FakeAPI
+
+# --------------------------------------------------------------------------- #
+def main(args):
+    '''Run the benchmarks
+
+    :param args: The command line arguments given by the user
+    :type args: list
+    '''
+    parser = argparse.ArgumentParser(prog="benchmark", description="Run offline benchmarks against a local stand-in for the Youtube API")
+    parser.add_argument("-n", "--videos", action="store", dest="videos", type=int, default=10000, help="Total number of videos (Default: 10000)")
+    parser.add_argument("-c", "--channels", action="store", dest="channels", type=int, default=10, help="Number of channels for the benchmarks of all channels (Default: 10)")
+    parser.add_argument("-l", "--latency", action="store", dest="latency", type=float, default=0, help="Latency of the API in seconds (Default: 0)")
+    parser.add_argument("BENCHMARK", nargs='*', help="The benchmarks to run (Default: all), one of: " + ", ".join(BENCHMARKS))
+    args = parser.parse_args(args)
+    for name in args.BENCHMARK:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark \"{}\"".format(name))
+
+    tempDir = tempfile.mkdtemp(prefix="ytabench_")
+    api = FakeAPI(latency=args.latency).start()
+    os.environ["YTA_TEST"] = "TRUE"
+    os.environ["YTA_TEST_APIKEY"] = "fakekey"
+    os.environ["YTA_BASEURL"] = api.url
+    os.environ["YTA_QUOTADB"] = os.path.join(tempDir, "quota.db")
+    #Remove quota limit
+    dbCon = ytaquota.connectQuotaDB()
+    dbCon.execute("UPDATE setup SET dailyquota = ? WHERE id = 1;", (sys.maxsize,))
+    yta.closeDB(dbCon)
+    try:
+        for name in (args.BENCHMARK or BENCHMARKS):
+            BENCHMARKS[name](tempDir, api, args)
+    finally:
+        api.stop()
+        shutil.rmtree(tempDir)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createArchive(path, videos, offset=0):
+    '''Create an archive database with synthetic videos
+
+    :param path: The directory of the archive
+    :type path: string
+    :param videos: The number of videos
+    :type videos: integer
+    :param offset: The number of the first video (Default: 0)
+    :type offset: integer, optional
+    '''
+    os.makedirs(path, exist_ok=True)
+    dbCon = yta.connectDB(os.path.join(path, "archive.db"))
+    yta.createChannelTable(dbCon)
+    yta.createVideoTable(dbCon)
+    yta.createAPICacheTable(dbCon)
+    yta.createStatisticsHistoryTable(dbCon)
+    dbCon.execute("INSERT INTO channel(name, url, playlist, language, videos, lastupdate, dbversion, maxresolution, totalsize) VALUES(?,?,?,?,?,?,?,?,?)", ("Bench", '', '', "en", videos, 0, yta.__dbversion__, "default", 0))
+    now = int(time.time())
+    rows = []
+    for i in range(offset, offset + videos):
+        youtubeID = "v{:010d}".format(i)
+        rows.append(("Video {}".format(youtubeID), "Bench", "2020-01-01", now - (i % 3650) * 86400, "Description of video {}".format(youtubeID), youtubeID, "WEBVTT", youtubeID + ".mp4", '', "en", 1920, 1080, "Full HD", 0))
+    insert = "INSERT INTO videos(title,creator,date,timestamp,description,youtubeID,subtitles,filename,checksum,language,width,height,resolution,filesize) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+    dbCon.executemany(insert, rows)
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _report(name, count, duration, unit="videos"):
+    '''Print the result of a benchmark'''
+    print("{:<40} {:>9} {} {:>9.2f} s {:>10.0f} {}/s".format(name, count, unit, duration, count / duration if duration else 0, unit))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchUpdateStatistics(tempDir, api, args):
+    '''Benchmark the statistics update of a single archive: cold (nothing
+    cached), unchanged (everything cached), and with 10% of the videos changed
+    '''
+    path = os.path.join(tempDir, "single")
+    createArchive(path, args.videos)
+    dbCon = yta.connectDB(os.path.join(path, "archive.db"))
+    api.generation = 0
+    api.changing = 1.0
+    for name, changing in (("cold", 1.0), ("unchanged", 0.0), ("10% changed", 0.1)):
+        if name != "cold":
+            api.generation += 1
+        api.changing = changing
+        t1 = time.time()
+        ytameta.updateStatistics(dbCon)
+        dbCon.commit()
+        _report("updateStatistics ({})".format(name), args.videos, time.time() - t1)
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchUpdateAllStatistics(tempDir, api, args):
+    '''Benchmark the statistics update of all channels in a directory'''
+    path = os.path.join(tempDir, "all")
+    perChannel = args.videos // args.channels
+    for i in range(args.channels):
+        createArchive(os.path.join(path, str(i)), perChannel, i * perChannel)
+    dbCon = ytameta.connectUpdateCreateStatisticsDB(path)
+    dbCon.execute("UPDATE setup SET maxcount = ? WHERE id = 1;", (sys.maxsize,))
+    yta.closeDB(dbCon)
+    api.generation = 0
+    api.changing = 1.0
+    stdout = sys.stdout
+    for name in ("cold", "unchanged"):
+        if name != "cold":
+            api.generation += 1
+            api.changing = 0.0
+        t1 = time.time()
+        with open(os.devnull, "w") as sys.stdout:
+            ytameta.updateAllStatistics(path)
+        sys.stdout = stdout
+        _report("updateAllStatistics ({})".format(name), perChannel * args.channels, time.time() - t1)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchAmendCaptions(tempDir, api, args):
+    '''Benchmark amending the captions of all videos of an archive'''
+    path = os.path.join(tempDir, "captions")
+    createArchive(path, args.videos)
+    dbCon = yta.connectDB(os.path.join(path, "archive.db"))
+    videos = dbCon.execute("SELECT id,youtubeID,language FROM videos;").fetchall()
+    stdout = sys.stdout
+    for workers in (1, ytameta.CAPTION_WORKERS):
+        t1 = time.time()
+        with open(os.devnull, "w") as sys.stdout:
+            ytameta.amendMissingCaptions(dbCon, videos, workers)
+        sys.stdout = stdout
+        _report("amendMissingCaptions ({} workers)".format(workers), len(videos), time.time() - t1)
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchLoadMetadata(tempDir, api, args):
+    '''Benchmark loading the metadata of all videos of an archive'''
+    path = os.path.join(tempDir, "metadata")
+    createArchive(path, args.videos)
+    dbCon = yta.connectDB(os.path.join(path, "archive.db"))
+    for workers in (1, ytameta.METADATA_WORKERS):
+        t1 = time.time()
+        ytameta.loadMetadata(dbCon, workers=workers)
+        _report("loadMetadata ({} workers)".format(workers), args.videos, time.time() - t1)
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchLogging(tempDir, api, args):
+    '''Benchmark writing the progress updates of yt-dlp to a log: cleaning and
+    writing each message to the file as it is printed (as ytarchiver did
+    before ytalog), and the batched writer of ytalog
+    '''
+    count = args.videos * 10
+    messages = ["\r\x1b[K[download] {:5.1f}% of 100.00MiB at  1.00MiB/s ETA 00:10".format(i % 1000 / 10) for i in range(count)]
+    path = os.path.join(tempDir, "log")
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as term:
+        t1 = time.time()
+        with open(path, 'w+') as log:
+            for msg in messages:
+                term.write(msg)
+                log.write(ytalog.ANSI_ESCAPE.sub('', msg))
+                log.flush()
+        _report("log (each message)", count, time.time() - t1, "writes")
+        sys.stdout = term
+        try:
+            t1 = time.time()
+            with ytalog.task(path):
+                for msg in messages:
+                    sys.stdout.write(msg)
+                    sys.stdout.flush()
+            duration = time.time() - t1
+        finally:
+            sys.stdout = stdout
+        _report("ytalog.task (batched)", count, duration, "writes")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def benchStartup(tempDir, api, args):
+    '''Benchmark the startup time of each entry point by running it with
+    --help, the fastest of several runs is reported
+    '''
+    mainDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    entryPoints = sorted(f[:-3] for f in os.listdir(mainDir) if f.startswith("yta") and f.endswith(".py") and "__main__" in open(os.path.join(mainDir, f)).read())
+    runs = 10
+    for entry in entryPoints:
+        durations = []
+        for _ in range(runs):
+            t1 = time.time()
+            subprocess.run([sys.executable, os.path.join(mainDir, entry + ".py"), "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            durations.append(time.time() - t1)
+        print("{:<40} {:>9.0f} ms (fastest of {} runs)".format("startup ({} --help)".format(entry), min(durations) * 1000, runs))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+BENCHMARKS = {"updateStatistics": benchUpdateStatistics, "updateAllStatistics": benchUpdateAllStatistics, "amendCaptions": benchAmendCaptions, "loadMetadata": benchLoadMetadata, "logging": benchLogging, "startup": benchStartup}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt:
+        print("Aborted!")
+# ########################################################################### #
@@ -12,8 +12,9 @@ from appdirs import user_data_dir
 from requests.exceptions import ConnectionError as rConnectionError
 
 import ytarchiver
+from fakeapi import FakeAPI
 
-LATEST_DB = 7
+LATEST_DB = 13
 
 temp_complete_archive = None
 temp_complete_allarchive = None
@@ -30,6 +31,7 @@ def pytest_sessionstart(session):
     os.environ["YTA_TEST"] = "TRUE"
     os.environ["YTA_TESTDATA"] = os.path.join(os.path.dirname(__file__), "testdata")
     os.environ["YTA_TEST_LATESTDB"] = "dbv{}.db".format(LATEST_DB)
+    os.environ["YTA_QUOTADB"] = os.path.join(os.environ["YTA_TESTDATA"], "temp_quota.db")
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -40,6 +42,11 @@ def pytest_sessionfinish(session, exitstatus):
         del os.environ["YTA_TEST"]
     except KeyError:
         pass
+    #Remove quota ledger
+    try:
+        os.remove(os.environ.pop("YTA_QUOTADB"))
+    except (KeyError, OSError):
+        pass
     #Remove complete archives if they exist
     try:
         shutil.rmtree(temp_complete_archive)
@@ -96,6 +103,29 @@ def apikey(capsys):
     os.environ["YTA_TEST_APIKEY"] = apiKey
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+@pytest.fixture
+def fakeapi():
+    '''Start a local stand-in for the Youtube web services, redirect all
+    requests to it, and use an empty quota ledger
+    '''
+    api = FakeAPI().start()
+    oldKey = os.environ.get("YTA_TEST_APIKEY")
+    os.environ["YTA_BASEURL"] = api.url
+    os.environ["YTA_TEST_APIKEY"] = "fakekey"
+    try:
+        os.remove(os.environ["YTA_QUOTADB"])
+    except OSError:
+        pass
+    yield api
+    api.stop()
+    del os.environ["YTA_BASEURL"]
+    if oldKey:
+        os.environ["YTA_TEST_APIKEY"] = oldKey
+    else:
+        del os.environ["YTA_TEST_APIKEY"]
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 @pytest.fixture
 def temparchive(request):
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+''' local stand-in for the Youtube web services used by ytarchiver '''
+
+import json
+import gzip
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# --------------------------------------------------------------------------- #
+class FakeAPI:
+    '''Serves the Youtube Data API videos endpoint, the timedtext endpoint, the
+    oembed endpoint, and the playlist feeds with synthetic data. Point
+    ytarchiver to it by setting the "YTA_BASEURL" environment variable to
+    FakeAPI.url
+    '''
+
+    def __init__(self, latency=0, quota=None):
+        '''Init
+
+        :param latency: Delay of each response in seconds (Default: 0)
+        :type latency: float, optional
+        :param quota: Number of units available before quota errors are returned (Default: unlimited)
+        :type quota: integer, optional
+        '''
+        self.latency = latency
+        self.quota = quota
+        #Number of times the statistics changed and the fraction of videos whose statistics change
+        self.generation = 0
+        self.changing = 1.0
+        #Overrides of the synthetic data by Youtube ID (e.g. {"title": "Example"})
+        self.videos = {}
+        #Youtube IDs that do not exist
+        self.missing = set()
+        #API keys whose quota is exceeded
+        self.exhaustedKeys = set()
+        #Youtube IDs listed in the feed of each playlist or channel, newest first
+        self.feeds = {}
+        #Number of failing responses (503) per path before requests succeed again
+        self.failures = {}
+        #Log of the requested paths and of the API keys used
+        self.requests = []
+        self.keys = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.api = self
+        self._thread = None
+
+    @property
+    def url(self):
+        '''The base URL of the server'''
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def start(self):
+        '''Start serving in a background thread'''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the server'''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, path):
+        '''Return the number of requests to the given path'''
+        with self._lock:
+            return len([p for p in self.requests if p == path])
+
+    def video(self, youtubeID):
+        '''Return the synthetic data of a video
+
+        :param youtubeID: The Youtube ID
+        :type youtubeID: string
+
+        :returns: Dictionary with title, description, publishedAt, duration, caption, language, views, likes, and tags
+        :rtype: dict
+        '''
+        seed = int(hashlib.md5(youtubeID.encode("UTF-8")).hexdigest()[:8], 16)
+        changes = (seed % 1000) < self.changing * 1000
+        published = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1262304000 + seed % 315360000))
+        data = {
+            "title": "Video {}".format(youtubeID),
+            "description": "Description of video {}\n\n0:00 Start\n0:30 Middle\n0:50 End".format(youtubeID),
+            "publishedAt": published,
+            "duration": "PT1M",
+            "caption": "true",
+            "language": "en",
+            "views": seed % 1000000 + (self.generation * (seed % 997 + 1) if changes else 0),
+            "likes": seed % 10000 + (self.generation if changes else 0),
+            "tags": ["fake", "video"]
+        }
+        data.update(self.videos.get(youtubeID, {}))
+        return data
+
+    def spend(self, units):
+        '''Spend quota units, return False if the quota is exceeded'''
+        with self._lock:
+            if self.quota is None:
+                return True
+            if self.quota < units:
+                return False
+            self.quota -= units
+            return True
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _Handler(BaseHTTPRequestHandler):
+    '''Request handler of the fake server'''
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        '''Do not log requests'''
+
+    def do_GET(self):
+        '''Answer GET requests'''
+        api = self.server.api
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with api._lock:
+            api.requests.append(url.path)
+            fail = api.failures.get(url.path, 0) > 0
+            if fail:
+                api.failures[url.path] -= 1
+        if api.latency:
+            time.sleep(api.latency)
+        if fail:
+            self._send(503, b"Service Unavailable", "text/plain")
+            return
+        if url.path == "/youtube/v3/videos":
+            self._videos(api, query)
+        elif url.path == "/timedtext":
+            self._timedtext(api, query)
+        elif url.path == "/oembed":
+            self._oembed(api, query)
+        elif url.path == "/feeds/videos.xml":
+            self._feed(api, query)
+        else:
+            self._send(404, b"", "text/plain")
+
+    def _send(self, status, body, contentType, headers=None):
+        '''Send a response, gzip-compressed if accepted by the client'''
+        if "gzip" in self.headers.get("Accept-Encoding", "") and body:
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _videos(self, api, query):
+        '''Answer a request to the videos endpoint'''
+        with api._lock:
+            api.keys.append(query.get("key"))
+        if not query.get("key"):
+            self._send(403, json.dumps({"error": {"code": 403, "errors": [{"reason": "forbidden"}]}}).encode(), "application/json")
+            return
+        if query["key"] in api.exhaustedKeys or not api.spend(1):
+            self._send(403, json.dumps({"error": {"code": 403, "errors": [{"reason": "quotaExceeded"}]}}).encode(), "application/json")
+            return
+        parts = query.get("part", "").split(',')
+        items = []
+        for youtubeID in query.get("id", "").split(','):
+            if not youtubeID or youtubeID in api.missing:
+                continue
+            v = api.video(youtubeID)
+            item = {"kind": "youtube#video", "id": youtubeID}
+            if "snippet" in parts:
+                item["snippet"] = {"publishedAt": v["publishedAt"], "title": v["title"], "description": v["description"], "tags": v["tags"]}
+            if "contentDetails" in parts:
+                item["contentDetails"] = {"duration": v["duration"], "caption": v["caption"]}
+            if "statistics" in parts:
+                item["statistics"] = {"viewCount": str(v["views"]), "likeCount": str(v["likes"])}
+            item["etag"] = hashlib.sha1(json.dumps(item, sort_keys=True).encode()).hexdigest()
+            items.append(item)
+        etag = hashlib.sha1(''.join(i["etag"] for i in items).encode()).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", "application/json", {"ETag": etag})
+            return
+        body = {"kind": "youtube#videoListResponse", "etag": etag, "items": items, "pageInfo": {"totalResults": len(items), "resultsPerPage": len(items)}}
+        self._send(200, json.dumps(body).encode(), "application/json", {"ETag": etag})
+
+    def _timedtext(self, api, query):
+        '''Answer a request to the timedtext endpoint'''
+        youtubeID = query.get("v", "")
+        v = api.video(youtubeID)
+        if query.get("type") == "list":
+            tracks = ''
+            if v["caption"] == "true" and youtubeID not in api.missing:
+                tracks = '<track id="0" name="" lang_code="{0}" lang_original="{0}" lang_translated="{0}" lang_default="true"/>'.format(v["language"])
+            self._send(200, '<?xml version="1.0" encoding="utf-8" ?><transcript_list docid="0">{}</transcript_list>'.format(tracks).encode(), "text/xml")
+        else:
+            vtt = "WEBVTT\nKind: captions\nLanguage: {}\n\n00:00:00.000 --> 00:00:01.000\nSubtitle of {}\n".format(query.get("lang"), youtubeID)
+            self._send(200, vtt.encode(), "text/vtt")
+
+    def _oembed(self, api, query):
+        '''Answer a request to the oembed endpoint'''
+        youtubeID = query.get("url", "").rsplit("v=", 1)[-1]
+        if youtubeID in api.missing:
+            self._send(404, b"Not Found", "text/plain")
+            return
+        v = api.video(youtubeID)
+        body = {"title": v["title"], "author_name": v.get("author", "Fake Channel"), "type": "video"}
+        self._send(200, json.dumps(body).encode(), "application/json")
+
+    def _feed(self, api, query):
+        '''Answer a request to the feed of a playlist or channel'''
+        playlist = query.get("playlist_id") or query.get("channel_id")
+        if playlist not in api.feeds:
+            self._send(404, b"Not Found", "text/plain")
+            return
+        entries = ''.join('<entry><id>yt:video:{0}</id><yt:videoId>{0}</yt:videoId><title>{1}</title></entry>'.format(i, api.video(i)["title"]) for i in api.feeds[playlist])
+        body = '<?xml version="1.0" encoding="UTF-8"?><feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom"><title>Uploads</title>{}</feed>'.format(entries)
+        self._send(200, body.encode(), "application/atom+xml")
+# ########################################################################### #
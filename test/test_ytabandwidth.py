@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+''' unit test suite for ytabandwidth '''
+
+import threading
+import multiprocessing
+from datetime import datetime
+import pytest
+
+import ytabandwidth
+
+# --------------------------------------------------------------------------- #
+def test_parseProfile():
+    ''' Test parsing time-of-day profiles '''
+    assert ytabandwidth.parseProfile("08:00-18:00=20%") == [(480, 1080, 0.2)]
+    assert ytabandwidth.parseProfile("22:30-6:00=100%, 18:00-22:30=50%") == [(1350, 360, 1.0), (1080, 1350, 0.5)]
+    assert ytabandwidth.parseProfile("00:00-24:00=10%") == [(0, 1440, 0.1)]
+    for profile in ["", "08:00-18:00", "8-18=20%", "08:00-18:60=20%", "08:00-25:00=20%", "08:00-18:00=0%", "08:00-18:00=101%"]:
+        with pytest.raises(ValueError):
+            ytabandwidth.parseProfile(profile)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_share():
+    ''' Test the share of the rate during and outside of windows '''
+    assert ytabandwidth.BandwidthGovernor().share() is None
+    governor = ytabandwidth.BandwidthGovernor(1000000, ytabandwidth.parseProfile("08:00-18:00=20%,22:00-06:00=50%"))
+    assert governor.share(datetime(2020, 1, 1, 7, 59)) == 1000000
+    assert governor.share(datetime(2020, 1, 1, 8, 0)) == 200000
+    assert governor.share(datetime(2020, 1, 1, 17, 59)) == 200000
+    assert governor.share(datetime(2020, 1, 1, 18, 0)) == 1000000
+    #Window crossing midnight
+    assert governor.share(datetime(2020, 1, 1, 23, 0)) == 500000
+    assert governor.share(datetime(2020, 1, 1, 5, 59)) == 500000
+    assert governor.share(datetime(2020, 1, 1, 6, 0)) == 1000000
+    #Running downloads of other processes
+    shared = multiprocessing.Value('i', 4)
+    assert ytabandwidth.BandwidthGovernor(1000000, shared=shared).share() == 250000
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _FakeYDL:
+    '''Stand-in for yt-dlp that records its rate while "downloading"'''
+
+    def __init__(self, started, release):
+        self.params = {"ratelimit": None, "throttledratelimit": ytabandwidth.THROTTLED_RATE}
+        self.rates = []
+        self._started = started
+        self._release = release
+
+    def download(self, urls):
+        '''Wait until released'''
+        self.rates.append(self.params["ratelimit"])
+        self._started.release()
+        self._release.wait()
+        self.rates.append(self.params["ratelimit"])
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_BandwidthGovernor():
+    ''' Test adjusting the rate of running downloads '''
+    shared = multiprocessing.Value('i', 0)
+    governor = ytabandwidth.BandwidthGovernor(1000000, shared=shared)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+    first = _FakeYDL(started, release)
+    second = _FakeYDL(started, release)
+    thread = threading.Thread(target=governor.download, args=(first, ["a"]))
+    thread.start()
+    started.acquire()
+    assert first.rates == [1000000]
+    assert first.params["throttledratelimit"] == ytabandwidth.THROTTLED_RATE
+    #Starting a second download halves the rate of the first
+    thread2 = threading.Thread(target=governor.download, args=(second, ["b"]))
+    thread2.start()
+    started.acquire()
+    assert shared.value == 2
+    assert first.params["ratelimit"] == second.params["ratelimit"] == 500000
+    #A slow share disables the throttling detection
+    governor.rate = 300000
+    governor.adjust()
+    assert first.params["ratelimit"] == 150000
+    assert first.params["throttledratelimit"] is None
+    release.set()
+    thread.join()
+    thread2.join()
+    assert shared.value == 0
+# ########################################################################### #
@@ -2,6 +2,9 @@
 ''' unit test suite for ytacommon '''
 
 import os
+import sys
+import pickle
+import subprocess
 from shutil import copyfile
 import pytest
 import utils
@@ -14,6 +17,54 @@ def test_dbVersion():
     assert os.environ["YTA_TEST_LATESTDB"] == "dbv{}.db".format(ytacommon.__dbversion__)
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+#Dependencies that must only be loaded on the paths that use them
+HEAVY_MODULES = ["requests", "appdirs", "yt_dlp", "pycountry", "pytz"]
+ENTRY_POINTS = ["ytabackup", "ytacheck", "ytadaemon", "ytafix", "ytaformats", "ytahistory", "ytainfo", "ytameta", "ytamissing", "ytapost", "ytaquota", "ytarchiver"]
+#Prints the heavy modules that were loaded after running an entry point with --help
+LOADED_CODE = """
+import io, sys, types, runpy, contextlib
+sys.argv = [{0!r}, "--help"]
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_module({0!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(",".join(m for m in {1!r} if type(sys.modules.get(m)) is types.ModuleType))
+"""
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_lazyImport():
+    '''Test that modules are only loaded when first used'''
+    code = "import sys, types, ytacommon; m = ytacommon.lazyImport('colorsys'); print(type(m) is types.ModuleType, m.rgb_to_hsv(1, 0, 0), type(m) is types.ModuleType, ytacommon.lazyImport('colorsys') is m)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True, check=True).stdout
+    assert out == "False (0.0, 1.0, 1) True True\n"
+    #Threads using the module at the same time wait until it is loaded
+    code = "import ytacommon; from concurrent.futures import ThreadPoolExecutor; m = ytacommon.lazyImport('pycountry'); print(set(ThreadPoolExecutor(8).map(lambda _: m.languages.get(alpha_2='de').alpha_3, range(8))))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True, check=True).stdout
+    assert out == "{'deu'}\n"
+    with pytest.raises(ModuleNotFoundError):
+        ytacommon.lazyImport("notamodule")
+    assert issubclass(ytacommon.QuotaExceededError, ytacommon.requests.exceptions.HTTPError)
+    assert ytacommon.QuotaExceededError is ytacommon.QuotaExceededError
+    #It can be passed between processes
+    assert isinstance(pickle.loads(pickle.dumps(ytacommon.QuotaExceededError("quota"))), ytacommon.QuotaExceededError)
+    #Threads creating QuotaExceededError at the same time get the same class
+    code = "import ytacommon; from concurrent.futures import ThreadPoolExecutor; print(len(set(ThreadPoolExecutor(8).map(lambda _: ytacommon.QuotaExceededError, range(8)))))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True, check=True).stdout
+    assert out == "1\n"
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize("entry", ENTRY_POINTS)
+def test_startupImports(entry):
+    '''Test that the entry points do not load heavy dependencies when they are not used'''
+    code = LOADED_CODE.format(entry, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True, text=True, check=True).stdout
+    assert out == "\n"
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def test_calcSHA():
     '''Test the SHA256 calculation'''
@@ -148,6 +199,131 @@ def test_upgradeDatabaseV7(upgradeDB):
     #Close and remove database
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,8)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,8))],
+    ids=["new", "1>8", "2>8", "3>8", "4>8", "5>8", "6>8", "7>8"])
+def test_upgradeDatabaseV8(upgradeDB):
+    '''Test the database upgrade to version 8'''
+    #Verify added API cache
+    r = upgradeDB.execute("INSERT INTO apicache(key,part,etag,checked) VALUES(?,?,?,?)", ("test", "statistics", "etag", 1577836800))
+    assert r.rowcount == 1
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,9)),
+        pytest.param(marks=pytest.mark.internal_dbversion(8,9))],
+    ids=["new", "1>9", "2>9", "3>9", "4>9", "5>9", "6>9", "7>9", "8>9"])
+def test_upgradeDatabaseV9(upgradeDB):
+    '''Test the database upgrade to version 9'''
+    #Verify added statistics history
+    r = upgradeDB.execute("INSERT INTO statisticshistory(videoid,samples,lasttimestamp,lastviewcount,lastlikecount,lastdislikecount,data) VALUES(?,?,?,?,?,?,?)", (1, 1, 1577836800, 1000, 90, 5, b"\x00"))
+    assert r.rowcount == 1
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(8,10)),
+        pytest.param(marks=pytest.mark.internal_dbversion(9,10))],
+    ids=["new", "1>10", "2>10", "3>10", "4>10", "5>10", "6>10", "7>10", "8>10", "9>10"])
+def test_upgradeDatabaseV10(upgradeDB):
+    '''Test the database upgrade to version 10'''
+    #Verify added metadata queue
+    r = upgradeDB.execute("INSERT INTO pending_metadata(youtubeID,added) VALUES(?,?)", ("test", 1577836800))
+    assert r.rowcount == 1
+    assert upgradeDB.execute("SELECT attempts FROM pending_metadata WHERE youtubeID = 'test';").fetchone()[0] == 0
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(8,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(9,11)),
+        pytest.param(marks=pytest.mark.internal_dbversion(10,11))],
+    ids=["new", "1>11", "2>11", "3>11", "4>11", "5>11", "6>11", "7>11", "8>11", "9>11", "10>11"])
+def test_upgradeDatabaseV11(upgradeDB):
+    '''Test the database upgrade to version 11'''
+    #Verify added playlist cursor
+    assert upgradeDB.execute("SELECT cursor,lastsweep FROM channel WHERE id = 1;").fetchone() == (None, 0)
+    r = upgradeDB.execute("UPDATE channel SET cursor = ?, lastsweep = ? WHERE id = 1;", ("test", 1577836800))
+    assert r.rowcount == 1
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(8,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(9,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(10,12)),
+        pytest.param(marks=pytest.mark.internal_dbversion(11,12))],
+    ids=["new", "1>12", "2>12", "3>12", "4>12", "5>12", "6>12", "7>12", "8>12", "9>12", "10>12", "11>12"])
+def test_upgradeDatabaseV12(upgradeDB):
+    '''Test the database upgrade to version 12'''
+    #Verify added unavailable table
+    upgradeDB.execute("INSERT INTO unavailable(youtubeID, reason, lastfailure, retry) VALUES(?,?,?,?);", ("test", "private", 1577836800, 1578441600))
+    assert upgradeDB.execute("SELECT reason,failures,retry FROM unavailable;").fetchall() == [("private", 1, 1578441600)]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize(
+    (), [pytest.param(marks=pytest.mark.internal_dbversion(0,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(1,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(2,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(3,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(4,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(5,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(6,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(7,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(8,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(9,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(10,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(11,13)),
+        pytest.param(marks=pytest.mark.internal_dbversion(12,13))],
+    ids=["new", "1>13", "2>13", "3>13", "4>13", "5>13", "6>13", "7>13", "8>13", "9>13", "10>13", "11>13", "12>13"])
+def test_upgradeDatabaseV13(upgradeDB):
+    '''Test the database upgrade to version 13'''
+    #Verify added download queue
+    upgradeDB.execute("INSERT INTO download_queue(youtubeID, added) VALUES(?,?);", ("test", 1577836800))
+    assert upgradeDB.execute("SELECT state,attempts,lastattempt FROM download_queue;").fetchall() == [("pending", 0, None)]
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 @pytest.fixture
 def upgradeDB(request):
@@ -177,6 +353,11 @@ def createNewTestDB(path):
     dbCon = ytacommon.connectDB(path)
     #Create video table
     ytacommon.createVideoTable(dbCon)
+    ytacommon.createAPICacheTable(dbCon)
+    ytacommon.createStatisticsHistoryTable(dbCon)
+    ytacommon.createPendingMetadataTable(dbCon)
+    ytacommon.createUnavailableTable(dbCon)
+    ytacommon.createDownloadQueueTable(dbCon)
     insert = "INSERT INTO videos(title,creator,date,timestamp,youtubeID,filename,checksum,language,width,height,resolution,statisticsupdated,filesize) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)"
     dbCon.execute(insert, ("Test", "Test", "2020-01-01", 1577836800, "test", "test.mp4", "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08", "en", 1920, 1080, "Full HD", 1577836800, 1000000))
     #Create channel table
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+''' unit test suite for ytadaemon '''
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+import ytarchiver
+import ytadaemon
+
+# --------------------------------------------------------------------------- #
+def _createArchive(path, timestamps):
+    '''Create an archive database with videos uploaded at the given times'''
+    os.makedirs(path, exist_ok=True)
+    db = sqlite3.connect(os.path.join(path, "archive.db"))
+    db.execute("CREATE TABLE videos(id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL);")
+    db.executemany("INSERT INTO videos(timestamp) VALUES(?);", [(t,) for t in timestamps])
+    db.commit()
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_pollInterval(tmp_path):
+    ''' Test deriving the polling interval from the upload frequency '''
+    now = 1600000000
+    cases = [
+        ("daily", [now - i * 86400 for i in range(20)], 86400 // ytadaemon.POLLS_PER_UPLOAD),
+        ("hourly", [now - i * 3600 for i in range(20)], ytadaemon.MIN_POLL_INTERVAL),
+        ("weekly", [now - i * 7 * 86400 for i in range(20)], ytadaemon.MAX_POLL_INTERVAL),
+        #Channel that stopped uploading daily two days ago
+        ("stopped", [now - (i + 2) * 86400 for i in range(20)], 2 * 86400 // ytadaemon.POLLS_PER_UPLOAD),
+        ("single", [now], ytadaemon.DEFAULT_POLL_INTERVAL)
+    ]
+    for name, timestamps, expected in cases:
+        _createArchive(os.path.join(tmp_path, name), timestamps)
+        assert ytadaemon.pollInterval(os.path.join(tmp_path, name, "archive.db"), now) == expected, name
+    assert ytadaemon.pollInterval(os.path.join(tmp_path, "archive.db"), now) == ytadaemon.DEFAULT_POLL_INTERVAL
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _fakeArchive(args, parsed=False):
+    '''Stand-in for archive used by the daemon test, runs in the worker processes'''
+    with open(os.path.join(args.DIR, "polls"), 'a') as f:
+        f.write("poll\n")
+    if os.path.basename(args.DIR) == "exit":
+        sys.exit(1)
+    print("Archived {}".format(os.path.basename(args.DIR)))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _polls(path):
+    '''Return the number of polls of a fake channel'''
+    try:
+        with open(os.path.join(path, "polls")) as f:
+            return len(f.readlines())
+    except OSError:
+        return 0
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _waitFor(condition, timeout=10):
+    '''Wait until the condition is true'''
+    t = time.time()
+    while not condition():
+        assert time.time() - t < timeout
+        time.sleep(0.05)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_ArchiveDaemon(tmp_path, capsys, monkeypatch):
+    ''' Test polling the channels and the control interface '''
+    monkeypatch.setattr(ytarchiver, "archive", _fakeArchive)
+    now = int(time.time())
+    for name in ["a", "b"]:
+        _createArchive(os.path.join(tmp_path, name), [now - i * 86400 for i in range(20)])
+    args = ytarchiver.argparse.Namespace(check="", jobs=2, workers=1, ratelimit=None, profile=None)
+    archiver = ytadaemon.ArchiveDaemon(str(tmp_path), args)
+    server = ytadaemon.ControlServer(("127.0.0.1", 0), archiver)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    thread = threading.Thread(target=archiver.run)
+    try:
+        #Pause channel b before starting
+        assert ytadaemon.sendCommand(port, ["pause", "b"]) == {"ok": True}
+        thread.start()
+        _waitFor(lambda: _polls(os.path.join(tmp_path, "a")) == 1)
+        _waitFor(lambda: archiver.channels["a"].lastPoll is not None)
+        status = ytadaemon.sendCommand(port, ["status"])
+        channels = {c["name"]: c for c in status["channels"]}
+        assert channels["a"]["state"] == "waiting"
+        assert channels["a"]["lastResult"] == "ok"
+        assert channels["a"]["nextPoll"] == channels["a"]["lastPoll"] + 86400 // ytadaemon.POLLS_PER_UPLOAD
+        assert channels["b"]["state"] == "paused"
+        assert _polls(os.path.join(tmp_path, "b")) == 0
+        #Enqueue polls a channel right away
+        assert ytadaemon.sendCommand(port, ["enqueue", "a"]) == {"ok": True}
+        _waitFor(lambda: _polls(os.path.join(tmp_path, "a")) == 2)
+        #Resume the paused channel
+        assert ytadaemon.sendCommand(port, ["resume", "b"]) == {"ok": True}
+        _waitFor(lambda: _polls(os.path.join(tmp_path, "b")) == 1)
+        #New channels are discovered when enqueued
+        _createArchive(os.path.join(tmp_path, "c"), [])
+        assert ytadaemon.sendCommand(port, ["enqueue", "c"]) == {"ok": True}
+        _waitFor(lambda: _polls(os.path.join(tmp_path, "c")) == 1)
+        assert "error" in ytadaemon.sendCommand(port, ["enqueue", "d"])
+        assert "error" in ytadaemon.sendCommand(port, ["restart"])
+        #Pause all channels
+        assert ytadaemon.sendCommand(port, ["pause"]) == {"ok": True}
+        assert ytadaemon.sendCommand(port, ["status"])["paused"]
+        ytadaemon.sendCommand(port, ["enqueue", "a"])
+        time.sleep(0.5)
+        assert _polls(os.path.join(tmp_path, "a")) == 2
+        #A channel that exits is recorded as failed without stopping the daemon
+        assert ytadaemon.sendCommand(port, ["resume"]) == {"ok": True}
+        _createArchive(os.path.join(tmp_path, "exit"), [])
+        assert ytadaemon.sendCommand(port, ["enqueue", "exit"]) == {"ok": True}
+        _waitFor(lambda: archiver.channels["exit"].lastResult == "error")
+        assert thread.is_alive()
+        #Stop the daemon
+        assert ytadaemon.sendCommand(port, ["stop"]) == {"ok": True}
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        archiver.stop()
+        thread.join()
+        server.shutdown()
+        server.server_close()
+    out = capsys.readouterr().out
+    assert "ARCHIVED 'a'" in out
+    assert "Archived a\n" in out
+    assert "ERROR: Exited with status 1\n" in out
+# ########################################################################### #
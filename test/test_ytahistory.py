@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+''' unit test suite for ytahistory '''
+
+import os
+import pytest
+
+import ytahistory
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize("samples", [
+    [(1577836800, 0, 0, 0)],
+    [(1577836800, 1000, 90, 5), (1577923200, 1500, 95, 5), (1578009600, 1400, 80, 7)],
+    [(1577836800, 2**40, 2**20, 0), (1577836801, 2**40 + 1, 0, 2**20)]],
+    ids=["zero", "daily", "large"])
+def test_encodeSamples(samples):
+    '''Test the delta encoding and decoding of samples'''
+    data = ytahistory.encodeSamples(samples)
+    assert ytahistory.decodeSamples(data) == samples
+    #Verify appending encoded samples
+    extra = (samples[-1][0] + 86400, samples[-1][1] + 10, 3, 1)
+    data += ytahistory.encodeSamples([extra], samples[-1])
+    assert ytahistory.decodeSamples(data) == samples + [extra]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_appendSamples(tempcopy, db):
+    '''Test appending samples to the history and querying them'''
+    t = 1577836800
+    ytahistory.appendSamples(db, [(1, t, 1000, 90, 5), (2, t, 10, 1, 0)])
+    ytahistory.appendSamples(db, [(1, t + 86400, 1500, 95, 5), (2, t + 86400, 10, 1, 0)])
+    ytahistory.appendSamples(db, [(1, t + 2 * 86400, 1600, 95, 6)])
+    #Compare
+    assert ytahistory.query(db, 1) == [(t, 1000, 90, 5), (t + 86400, 1500, 95, 5), (t + 2 * 86400, 1600, 95, 6)]
+    assert ytahistory.query(db, 1, t + 1, t + 86400) == [(t + 86400, 1500, 95, 5)]
+    #Unchanged samples are not stored
+    assert ytahistory.query(db, 2) == [(t, 10, 1, 0)]
+    assert ytahistory.query(db, 3) == []
+    assert db.execute("SELECT samples,lastviewcount FROM statisticshistory WHERE videoid = 1;").fetchone() == (3, 1600)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_compact(tempcopy, dbCon):
+    '''Test downsampling the history'''
+    day = 86400
+    now = 1000 * day
+    #Add a daily sample for 1000 days
+    for i in range(1000):
+        ytahistory.appendSamples(dbCon, [(1, i * day, i * 100, i, 0)])
+    before, after = ytahistory.compact(dbCon, now, [(10 * day, 5 * day), (100 * day, 50 * day)])
+    samples = ytahistory.query(dbCon, 1)
+    #Compare: 10 recent daily samples, 18 samples with 5 days resolution, 18 samples with 50 days resolution
+    assert before == 1000
+    assert after == len(samples) == 10 + 18 + 18
+    assert samples[-1] == (999 * day, 99900, 999, 0)
+    assert [s[0] for s in samples[-11:-9]] == [989 * day, 990 * day]
+    #Compacting again does not change anything
+    assert ytahistory.compact(dbCon, now, [(10 * day, 5 * day), (100 * day, 50 * day)]) == (after, after)
+# ########################################################################### #
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+''' unit test suite for ytalog '''
+
+import os
+import sys
+import gzip
+import threading
+
+import ytalog
+
+# --------------------------------------------------------------------------- #
+def test_rotate(tmp_path):
+    ''' Test compressing and shifting old logs '''
+    path = os.path.join(tmp_path, "log")
+    for i in range(4):
+        with open(path, 'w') as f:
+            f.write("run {}\n".format(i))
+        ytalog.rotate(path, 2)
+    assert sorted(os.listdir(tmp_path)) == ["log.1.gz", "log.2.gz"]
+    with gzip.open(path + ".1.gz", 'rt') as f:
+        assert f.read() == "run 3\n"
+    with gzip.open(path + ".2.gz", 'rt') as f:
+        assert f.read() == "run 2\n"
+    #Empty logs are not rotated
+    open(path, 'w').close()
+    ytalog.rotate(path, 2)
+    assert os.path.isfile(path)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_clean():
+    ''' Test removing escape sequences and overwritten progress updates '''
+    assert ytalog.clean("\x1b[0;31mERROR:\x1b[0m Video unavailable\n") == "ERROR: Video unavailable\n"
+    assert ytalog.clean("[download]  10%\r\x1b[K[download]  50%\r\x1b[K[download] 100%\nDone\n") == "[download] 100%\nDone\n"
+    assert ytalog.clean("\r[download] 100%\r\n") == "[download] 100%\n"
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_LogFile(tmp_path):
+    ''' Test writing incomplete lines in batches '''
+    path = os.path.join(tmp_path, "log")
+    log = ytalog.LogFile(path)
+    for i in range(100):
+        log.write("\r[download] {:3d}%".format(i))
+    log.write("\n[ytarchiver] Post-processing")
+    log.write(" \"video.mp4\"\n")
+    log.write("incomplete")
+    log.close()
+    with open(path) as f:
+        assert f.read() == "[download]  99%\n[ytarchiver] Post-processing \"video.mp4\"\nincomplete"
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_task(tmp_path, capsys):
+    ''' Test routing the output of threads to the logs of their tasks '''
+    stdout = sys.stdout
+    ready = threading.Barrier(2)
+    def run(name):
+        with ytalog.task(os.path.join(tmp_path, name)):
+            ready.wait()
+            for i in range(50):
+                print("{} {}".format(name, i))
+            ready.wait()
+    threads = [threading.Thread(target=run, args=(name,)) for name in ["a", "b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sys.stdout is stdout
+    for name in ["a", "b"]:
+        with open(os.path.join(tmp_path, name)) as f:
+            assert f.read() == ''.join("{} {}\n".format(name, i) for i in range(50))
+    out = capsys.readouterr().out
+    assert "a 49\n" in out and "b 49\n" in out
+    #Threads bound to a task, and threads without a task while only one task runs
+    def worker(log):
+        with ytalog.bind(log):
+            print("bound")
+    path = os.path.join(tmp_path, "c")
+    with ytalog.task(path) as log:
+        assert ytalog.currentTask() is log
+        for thread in [threading.Thread(target=worker, args=(ytalog.currentTask(),)), threading.Thread(target=print, args=("unbound",))]:
+            thread.start()
+            thread.join()
+        print("main")
+    with open(path) as f:
+        assert f.read() == "bound\nunbound\nmain\n"
+    assert ytalog.currentTask() is None
+    assert sys.stdout is stdout
+# ########################################################################### #
@@ -2,14 +2,19 @@
 ''' unit test suite for ytameta '''
 
 import os
+import sys
 import time
+import json
 import shutil
 import pytest
 import utils
 import sqlite3
+import yt_dlp
 from requests.exceptions import RequestException
 
+import ytacommon
 import ytameta
+import ytaquota
 
 # --------------------------------------------------------------------------- #
 @pytest.mark.network
@@ -208,6 +213,17 @@ def test_getMetadata(capsys, expException):
         assert received == [None] * 8
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+@pytest.mark.network
+def test_extractStatistics():
+    '''Test extracting the statistics of a video with yt-dlp'''
+    with yt_dlp.YoutubeDL(ytameta.YTDLP_OPTIONS) as ytdl:
+        received = ytameta.extractStatistics(ytdl, "0-cN7NVjXxc")
+        assert received["snippet"]["description"] == "The first example video\n\n0:00 Grow one\n0:30 Halt one\n0:45 Shrink one\n\nLD\nCaptions\n\nGoodbye"
+        assert int(received["statistics"]["viewCount"]) > 0
+        assert ytameta.extractStatistics(ytdl, "01234567890") is None
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 @pytest.mark.network
 @pytest.mark.parametrize("lang,expected", [
@@ -231,11 +247,298 @@ def test_amendCaption(capsys, tempcopy, db, lang, expected):
             assert captured.out.startswith(expected) or captured.out.startswith("INFO: No subtitle with language")
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_updateStatisticsOffline(capsys, tempcopy, db, fakeapi):
+    '''Test updating the video statistics with a local stand-in for the Youtube API'''
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id;").fetchall()]
+    fakeapi.missing.add(ids[5])
+    #First update, everything changed
+    t1 = int(time.time())
+    assert ytameta.updateStatistics(db) == (sys.maxsize - 6, True, None)
+    t2 = int(time.time())
+    for youtubeID, title, oldtitles, viewcount, updated in db.execute("SELECT youtubeID,title,oldtitles,viewcount,statisticsupdated FROM videos WHERE id < 6;").fetchall():
+        assert title == "Video {}".format(youtubeID)
+        assert len(json.loads(oldtitles)) == 1
+        assert viewcount == fakeapi.video(youtubeID)["views"]
+        assert t1 <= updated <= t2
+    assert fakeapi.count("/youtube/v3/videos") == 1
+    assert db.execute("SELECT count(*) FROM apicache;").fetchone()[0] == 6
+    #Second update, batch unchanged
+    db.execute("UPDATE videos SET statisticsupdated = 0;")
+    ytameta.updateStatistics(db)
+    assert len(db.execute("SELECT id FROM videos WHERE statisticsupdated > 0;").fetchall()) == 5
+    assert fakeapi.count("/youtube/v3/videos") == 2
+    #Third update, statistics changed
+    fakeapi.generation += 1
+    ytameta.updateStatistics(db)
+    for youtubeID, oldtitles, viewcount in db.execute("SELECT youtubeID,oldtitles,viewcount FROM videos WHERE id < 6;").fetchall():
+        assert len(json.loads(oldtitles)) == 1
+        assert viewcount == fakeapi.video(youtubeID)["views"]
+    assert db.execute("SELECT count(*) FROM statisticshistory WHERE samples = 2;").fetchone()[0] == 5
+    #Fourth update, cached ETags ignored but nothing changed, only the timestamps are written
+    statements = []
+    db.connection.set_trace_callback(statements.append)
+    ytameta.updateStatistics(db, checkCaptions=True)
+    db.connection.set_trace_callback(None)
+    updates = [s for s in statements if s.startswith("UPDATE videos")]
+    assert len(updates) == 5
+    assert all(s.startswith("UPDATE videos SET statisticsupdated = ") for s in updates)
+    #Amend captions
+    db.execute("UPDATE videos SET subtitles = ? WHERE id = 1;", (None,))
+    ytameta.updateStatistics(db, amendCaptions=True)
+    received = db.execute("SELECT subtitles FROM videos WHERE id = 1;").fetchone()[0]
+    assert received == "WEBVTT\nKind: captions\nLanguage: en\n\n00:00:00.000 --> 00:00:01.000\nSubtitle of {}\n".format(ids[0])
+    #Quota exceeded
+    capsys.readouterr()
+    fakeapi.quota = 0
+    assert ytameta.updateStatistics(db) == (0, False, None)
+    assert capsys.readouterr().out == "WARNING: API quota exceeded, statistics update stopped early\n"
+    #The cursor is not advanced past swept videos that were not updated
+    assert ytameta.updateStatistics(db, count=3, cursor=2) == (0, False, 2)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_updateStatisticsKeyRotation(capsys, tempcopy, db, fakeapi):
+    '''Test that requests are dispatched to the key with the most quota left
+    and move on to the next key when the quota of a key is exceeded'''
+    os.environ["YTA_TEST_APIKEY"] = "key1,key2"
+    ytaquota.record("key1", "videos.metadata", 10)
+    ytameta.getMetadata("0-cN7NVjXxc")
+    assert fakeapi.keys == ["key2"]
+    #Exceeded quota of the selected key
+    fakeapi.exhaustedKeys.add("key2")
+    assert ytameta.updateStatistics(db) == (sys.maxsize - 6, True, None)
+    assert fakeapi.keys[1:] == ["key2", "key1"]
+    assert ytaquota.getRemaining("key2") == 0
+    assert ytaquota.getSpent("key1") == {"videos.metadata": 10, "videos.statistics": 1}
+    #Exhausted keys are skipped until the next quota day
+    ytameta.getMetadata("0-cN7NVjXxc")
+    assert fakeapi.keys[3:] == ["key1"]
+    #Quota of all keys exceeded
+    fakeapi.exhaustedKeys.add("key1")
+    with pytest.raises(ytacommon.QuotaExceededError):
+        ytameta.getMetadata("0-cN7NVjXxc")
+    with pytest.raises(ytacommon.QuotaExceededError):
+        ytameta.getMetadata("0-cN7NVjXxc")
+    assert len(fakeapi.keys) == 5
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_amendMissingCaptionsOffline(capsys, monkeypatch, tempcopy, db, fakeapi):
+    '''Test amending the captions of multiple videos concurrently with retries'''
+    monkeypatch.setattr(ytameta, "CAPTION_RETRY_DELAY", 0)
+    monkeypatch.setattr(ytameta, "CAPTION_BATCH", 2)
+    db.execute("UPDATE videos SET subtitles = NULL;")
+    videos = [(i[0], i[1], "en") for i in db.execute("SELECT id,youtubeID FROM videos ORDER BY id;").fetchall()]
+    fakeapi.missing.add(videos[5][1])
+    #Two transient errors are retried
+    fakeapi.failures["/timedtext"] = 2
+    assert ytameta.amendMissingCaptions(db, videos, workers=3) == (5, 0)
+    lines = capsys.readouterr().out.splitlines()
+    assert len([l for l in lines if l.startswith("INFO: Added subtitle \"en\"")]) == 5
+    assert lines[-1].startswith("INFO: Amended captions of 5 of 6 videos")
+    for youtubeID, subtitles in db.execute("SELECT youtubeID,subtitles FROM videos WHERE id < 6;").fetchall():
+        assert subtitles.endswith("Subtitle of {}\n".format(youtubeID))
+    #Persistent errors give up after the retries
+    db.execute("UPDATE videos SET subtitles = NULL;")
+    fakeapi.failures["/timedtext"] = 100
+    assert ytameta.amendMissingCaptions(db, videos[0:2], retries=1) == (0, 2)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("ERROR: Unable to amend subtitles for video")
+    assert fakeapi.failures["/timedtext"] == 96
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_backfillMetadataOffline(capsys, tempcopy, db, fakeapi):
+    '''Test loading the metadata of queued videos'''
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id;").fetchall()]
+    db.execute("UPDATE videos SET duration = NULL, tags = NULL, viewcount = NULL;")
+    for youtubeID in ids:
+        ytameta.queueMetadata(db, youtubeID)
+    ytameta.queueMetadata(db, ids[0])
+    assert db.execute("SELECT count(*) FROM pending_metadata;").fetchone()[0] == 6
+    #Network error
+    fakeapi.failures["/youtube/v3/videos"] = 1
+    assert ytameta.backfillMetadata(db) == 6
+    assert db.execute("SELECT sum(attempts) FROM pending_metadata;").fetchone()[0] == 6
+    assert capsys.readouterr().out.splitlines()[-1].startswith("ERROR: Network error while trying to load the metadata")
+    #Quota exceeded
+    fakeapi.quota = 0
+    assert ytameta.backfillMetadata(db) == 6
+    assert capsys.readouterr().out.splitlines()[-1] == "WARNING: API quota exceeded, metadata backfill stopped early"
+    #Backfill with one request
+    fakeapi.quota = None
+    os.remove(os.environ["YTA_QUOTADB"])
+    fakeapi.missing.add(ids[5])
+    fakeapi.videos[ids[0]] = {"description": ''}
+    assert ytameta.backfillMetadata(db) == 0
+    assert fakeapi.count("/youtube/v3/videos") == 3
+    assert capsys.readouterr().out.splitlines()[-1] == "WARNING: No metadata available for " + ids[5]
+    for youtubeID, duration, tags, viewcount, description, chapters in db.execute("SELECT youtubeID,duration,tags,viewcount,description,chapters FROM videos WHERE id < 6;").fetchall():
+        assert duration == 60
+        assert tags == "fake\nvideo"
+        assert viewcount == fakeapi.video(youtubeID)["views"]
+        if youtubeID != ids[0]:
+            assert description == fakeapi.video(youtubeID)["description"]
+            assert chapters == "00:00:00.000 Start\n00:00:30.000 Middle\n00:00:50.000 End"
+    assert db.execute("SELECT count(*) FROM statisticshistory;").fetchone()[0] == 5
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_loadMetadataOffline(request, capsys, monkeypatch, tempallarchive, fakeapi):
+    '''Test loading the metadata of all archives in batches'''
+    path = request.node.get_closest_marker("internal_path").args[0]
+    subdirs = sorted([os.path.join(path, d) for d in os.listdir(path) if os.path.isfile(os.path.join(path, d, "archive.db"))])
+    for i, subdir in enumerate(subdirs):
+        db = sqlite3.connect(os.path.join(subdir, "archive.db"))
+        db.execute("UPDATE videos SET timestamp = 0, duration = 0, tags = '';")
+        #Give each archive different videos
+        db.execute("UPDATE videos SET youtubeID = youtubeID || ?;", ("_{}".format(i),))
+        db.commit()
+        db.close()
+    #One request per archive
+    ytameta.addMetadata(["-a", path])
+    assert fakeapi.count("/youtube/v3/videos") == len(subdirs)
+    for subdir in subdirs:
+        db = sqlite3.connect(os.path.join(subdir, "archive.db"))
+        for youtubeID, timestamp, duration, tags in db.execute("SELECT youtubeID,timestamp,duration,tags FROM videos;").fetchall():
+            assert timestamp > 0
+            assert duration == 60
+            assert tags == "fake\nvideo"
+        db.close()
+    #Quota exceeded after the first request
+    db = sqlite3.connect(os.path.join(subdirs[0], "archive.db"))
+    db.execute("UPDATE videos SET duration = 0;")
+    db.commit()
+    monkeypatch.setattr(ytaquota, "VIDEOS_PER_REQUEST", 2)
+    fakeapi.quota = 1
+    capsys.readouterr()
+    assert ytameta.loadMetadata(db, workers=1) == 2
+    assert capsys.readouterr().out == "WARNING: API quota exceeded, metadata update stopped early\n"
+    assert db.execute("SELECT count(*) FROM videos WHERE duration = 0;").fetchone()[0] == 4
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_updateAllStatisticsOffline(request, capsys, tempallarchive, fakeapi):
+    '''Test that the cursor of a channel is persisted when its update is incomplete'''
+    path = request.node.get_closest_marker("internal_path").args[0]
+    dbCon = ytameta.connectUpdateCreateStatisticsDB(path)
+    dbCon.execute("UPDATE setup SET maxcount = 4 WHERE id = 1;")
+    dbCon.commit()
+    ytameta.updateAllStatistics(path)
+    assert "Quota allows updating up to 4 videos" in capsys.readouterr().out
+    received = dbCon.execute("SELECT complete,cursor FROM channels WHERE lastupdate < ?;", (sys.maxsize,)).fetchall()
+    assert received == [(False, 1)]
+    dbCon.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_updateStatisticsYTDLPOffline(capsys, monkeypatch, tempcopy, db, fakeapi):
+    '''Test updating the video statistics with yt-dlp, using the synthetic
+    data of the local stand-in instead of the extractor
+    '''
+    def extract(ytdl, youtubeID):
+        if youtubeID in fakeapi.missing:
+            return None
+        v = fakeapi.video(youtubeID)
+        return {"id": youtubeID, "snippet": {"title": v["title"], "description": v["description"]}, "contentDetails": {"caption": v["caption"]}, "statistics": {"viewCount": str(v["views"]), "likeCount": str(v["likes"])}}
+    monkeypatch.setattr(ytameta, "extractStatistics", extract)
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id;").fetchall()]
+    fakeapi.missing.add(ids[5])
+    #First update, everything changed
+    capsys.readouterr()
+    assert ytameta.updateStatistics(db, source="ytdlp") == (sys.maxsize - 6, True, None)
+    assert capsys.readouterr().out == "WARNING: Unable to extract the statistics of 1 videos with yt-dlp\n"
+    for youtubeID, title, viewcount in db.execute("SELECT youtubeID,title,viewcount FROM videos WHERE id < 6;").fetchall():
+        assert title == "Video {}".format(youtubeID)
+        assert viewcount == fakeapi.video(youtubeID)["views"]
+    assert fakeapi.count("/youtube/v3/videos") == 0
+    assert db.execute("SELECT count(*) FROM apicache WHERE part = 'ytdlp';").fetchone()[0] == 5
+    #Second update, nothing changed, only the timestamps are written
+    statements = []
+    db.connection.set_trace_callback(statements.append)
+    ytameta.updateStatistics(db, source="ytdlp")
+    db.connection.set_trace_callback(None)
+    updates = [s for s in statements if s.startswith("UPDATE videos")]
+    assert len(updates) == 5
+    assert all(s.startswith("UPDATE videos SET statisticsupdated = ") for s in updates)
+    #Fall back to yt-dlp when the quota is exceeded
+    fakeapi.generation += 1
+    fakeapi.quota = 0
+    capsys.readouterr()
+    assert ytameta.updateStatistics(db, source="auto") == (sys.maxsize - 6, True, None)
+    assert capsys.readouterr().out.startswith("WARNING: API quota exceeded, updating the statistics of the remaining 6 videos with yt-dlp\n")
+    for youtubeID, viewcount in db.execute("SELECT youtubeID,viewcount FROM videos WHERE id < 6;").fetchall():
+        assert viewcount == fakeapi.video(youtubeID)["views"]
+    #Only the API
+    assert ytameta.updateStatistics(db) == (0, False, None)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_getStatisticsSource(fakeapi):
+    '''Test selecting the source of the statistics update'''
+    keys = ytaquota.KeyPool()
+    assert ytameta.getStatisticsSource("auto", keys, 100) == ("auto", 100)
+    assert ytameta.getStatisticsSource("ytdlp", keys, 100) == ("ytdlp", 100)
+    assert ytameta.getStatisticsSource("auto", ytaquota.KeyPool([])) == ("ytdlp", sys.maxsize)
+    assert ytameta.getStatisticsSource("api", ytaquota.KeyPool([]), 100) == ("api", 0)
+    ytaquota.markExhausted("fakekey")
+    keys = ytaquota.KeyPool()
+    assert ytameta.getStatisticsSource("auto", keys, 100) == ("ytdlp", 100)
+    assert ytameta.getStatisticsSource("api", keys, 100) == ("api", 0)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_getMetadataOffline(fakeapi):
+    '''Test getting the metadata from a local stand-in for the Youtube API'''
+    fakeapi.videos["0-cN7NVjXxc"] = {"publishedAt": "2020-12-30T00:00:01Z", "duration": "PT1M1S"}
+    received = ytameta.getMetadata("0-cN7NVjXxc")
+    assert received[0:3] == [1609286401, 61, "fake\nvideo"]
+    assert received[4] == fakeapi.video("0-cN7NVjXxc")["views"]
+    fakeapi.missing.add("0-cN7NVjXxc")
+    assert ytameta.getMetadata("0-cN7NVjXxc") == [None] * 8
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_scheduleStatistics(tempcopy, db):
+    '''Test the selection of the videos whose statistics are updated next'''
+    now = 1700000000
+    day = 86400
+    #Prepare database: (upload age, time since last update) in days
+    ages = {1: (2000, 20), 2: (1, 2), 3: (2000, 90), 4: (30, 10), 5: (1, 0), 6: (400, 0)}
+    for dbID, (age, updated) in ages.items():
+        db.execute("UPDATE videos SET timestamp = ?, statisticsupdated = ? WHERE id = ?;", (now - age * day, now - updated * day, dbID))
+    #Schedule all videos
+    received, completed, cursor = ytameta.scheduleStatistics(db, 10, now=now)
+    assert received == [2, 3, 4, 1, 5, 6]
+    assert completed
+    assert cursor is None
+    #Schedule some videos
+    received, completed, _ = ytameta.scheduleStatistics(db, 3, now - 5 * day, now)
+    assert received == [2, 3, 4]
+    assert not completed
+    received, completed, _ = ytameta.scheduleStatistics(db, 3, now - 30 * day, now)
+    assert completed
+    #Select one video by ID after the cursor, continue at the start after the last video
+    assert ytameta.scheduleStatistics(db, 3, now=now, cursor=0) == ([1, 2, 3], False, 1)
+    assert ytameta.scheduleStatistics(db, 3, now=now, cursor=2) == ([3, 2, 4], False, 3)
+    assert ytameta.scheduleStatistics(db, 3, now=now, cursor=6) == ([1, 2, 3], False, 1)
+    assert ytameta.scheduleStatistics(db, 20, now=now, cursor=2) == ([2, 3, 4, 1, 5, 6], True, 2)
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def test_connectUpdateCreateStatisticsDB():
-    '''Test the creation of a statistics database and the connection to an existing
-    one. The upgrade functionality cannot really be tested yet, as there is only
-    v1 of the statistics database
+    '''Test the creation of a statistics database, the connection to an existing
+    one, and the upgrade from v1
     '''
     dbPath = os.path.join(os.environ["YTA_TESTDATA"], "statistics.db")
     #Clear previous
@@ -248,9 +551,10 @@ def test_connectUpdateCreateStatisticsDB():
     assert not data[0] #Autoupate == False
     assert data[1] == 0 #No lastupdate yet
     assert data[2] == 100000 #Default maxcount
-    assert data[3] == 1 #Statistics database version 1
+    assert data[3] == 2 #Statistics database version 2
     r = dbCon.execute("INSERT INTO channels(name,lastupdate,complete) VALUES(?,?,?);", ("Test", 1577836800, True))
     assert r.rowcount == 1
+    assert dbCon.execute("SELECT cursor FROM channels WHERE id = 1;").fetchone()[0] == 0
     #Close database
     dbCon.commit()
     dbCon.close()
@@ -262,6 +566,14 @@ def test_connectUpdateCreateStatisticsDB():
     assert data[0] == "Test"
     assert data[1] == 1577836800
     assert data[2] #True
+    #Downgrade to v1 and upgrade again
+    dbCon.execute("ALTER TABLE channels DROP COLUMN cursor;")
+    dbCon.execute("UPDATE setup SET dbversion = 1 WHERE id = 1;")
+    dbCon.commit()
+    dbCon.close()
+    dbCon = ytameta.connectUpdateCreateStatisticsDB(os.environ["YTA_TESTDATA"])
+    assert dbCon.execute("SELECT dbversion FROM setup WHERE id = 1;").fetchone()[0] == 2
+    assert dbCon.execute("SELECT name,cursor FROM channels WHERE id = 1;").fetchone() == ("Test", 0)
     #Close and delete database
     dbCon.close()
     utils.deleteIfExists(dbPath)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+''' unit test suite for ytametrics '''
+
+import os
+import requests
+
+import ytametrics
+
+# --------------------------------------------------------------------------- #
+def test_Registry():
+    ''' Test counting, observing, and rendering in the Prometheus text format '''
+    registry = ytametrics.Registry()
+    registry.inc("yta_videos_archived_total")
+    registry.inc("yta_videos_archived_total", 2)
+    registry.set("yta_queue_depth", 5, "downloads")
+    registry.observe("yta_stage_duration_seconds", 0.2, "hash")
+    registry.observe("yta_stage_duration_seconds", 7, "hash")
+    text = registry.render()
+    assert "# TYPE yta_videos_archived_total counter\nyta_videos_archived_total 3\n" in text
+    assert "yta_downloaded_bytes_total 0\n" in text
+    assert 'yta_queue_depth{queue="downloads"} 5\n' in text
+    assert 'yta_stage_duration_seconds_bucket{stage="hash",le="0.1"} 0\n' in text
+    assert 'yta_stage_duration_seconds_bucket{stage="hash",le="0.5"} 1\n' in text
+    assert 'yta_stage_duration_seconds_bucket{stage="hash",le="10"} 2\n' in text
+    assert 'yta_stage_duration_seconds_bucket{stage="hash",le="+Inf"} 2\n' in text
+    assert 'yta_stage_duration_seconds_count{stage="hash"} 2\n' in text
+    assert 'yta_stage_duration_seconds_sum{stage="hash"} 7.2\n' in text
+    #Merge the values of another process
+    other = ytametrics.Registry()
+    other.inc("yta_videos_archived_total")
+    other.set("yta_queue_depth", 1, "downloads")
+    other.observe("yta_stage_duration_seconds", 1, "hash")
+    other.observe("yta_stage_duration_seconds", 1, "db")
+    registry.merge(other.snapshot())
+    text = registry.render()
+    assert "yta_videos_archived_total 4\n" in text
+    assert 'yta_queue_depth{queue="downloads"} 1\n' in text
+    assert 'yta_stage_duration_seconds_count{stage="hash"} 3\n' in text
+    assert 'yta_stage_duration_seconds_count{stage="db"} 1\n' in text
+    registry.reset()
+    assert "yta_videos_archived_total 0\n" in registry.render()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_hooks(monkeypatch):
+    ''' Test the progress hook and timing stages '''
+    monkeypatch.setattr(ytametrics, "REGISTRY", ytametrics.Registry())
+    ytametrics.progressHook({"status": "downloading", "downloaded_bytes": 100})
+    ytametrics.progressHook({"status": "finished", "total_bytes": 1000, "elapsed": 2.5})
+    ytametrics.progressHook({"status": "finished", "downloaded_bytes": 500})
+    with ytametrics.timed("remux"):
+        pass
+    text = ytametrics.REGISTRY.render()
+    assert "yta_downloaded_bytes_total 1500\n" in text
+    assert 'yta_stage_duration_seconds_count{stage="download"} 1\n' in text
+    assert 'yta_stage_duration_seconds_sum{stage="download"} 2.5\n' in text
+    assert 'yta_stage_duration_seconds_count{stage="remux"} 1\n' in text
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_export(tmp_path, monkeypatch):
+    ''' Test writing the metrics to a file and serving them '''
+    monkeypatch.setattr(ytametrics, "REGISTRY", ytametrics.Registry())
+    ytametrics.REGISTRY.inc("yta_videos_archived_total", 3)
+    path = os.path.join(tmp_path, "yta.prom")
+    ytametrics.writeTextfile(path)
+    with open(path) as f:
+        assert f.read() == ytametrics.REGISTRY.render()
+    assert os.listdir(tmp_path) == ["yta.prom"]
+    server = ytametrics.MetricsServer(("127.0.0.1", 0)).start()
+    try:
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        r = requests.get(url + "/metrics")
+        assert r.status_code == 200
+        assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "yta_videos_archived_total 3\n" in r.text
+        assert requests.get(url + "/other").status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+# ########################################################################### #
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+''' unit test suite for ytaquota '''
+
+import os
+import time
+import sqlite3
+import threading
+import json
+import pytest
+import requests
+import utils
+
+import ytacommon
+import ytaquota
+
+# --------------------------------------------------------------------------- #
+@pytest.fixture
+def ledger():
+    '''Provide a connection to a fresh quota ledger and delete it afterwards'''
+    utils.deleteIfExists(os.environ["YTA_QUOTADB"])
+    dbCon = ytaquota.connectQuotaDB()
+    yield dbCon
+    dbCon.close()
+    utils.deleteIfExists(os.environ["YTA_QUOTADB"])
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_connectQuotaDB(ledger):
+    '''Test the creation of the quota ledger'''
+    r = ledger.execute("SELECT dailyquota,dbversion FROM setup WHERE id = 1;")
+    assert r.fetchone() == (ytaquota.DAILY_QUOTA, 1)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_record(ledger):
+    '''Test recording the units spent per endpoint and API key'''
+    ytaquota.record("key1", "videos.metadata", dbCon=ledger)
+    ytaquota.record("key1", "videos.metadata", 4, ledger)
+    ytaquota.record("key1", "videos.statistics", 2, ledger)
+    ytaquota.record("key2", "videos.statistics", 3, ledger)
+    #Compare
+    assert ytaquota.getSpent("key1", dbCon=ledger) == {"videos.metadata": 5, "videos.statistics": 2}
+    assert ytaquota.getSpent("key2", dbCon=ledger) == {"videos.statistics": 3}
+    assert ytaquota.getRemaining("key1", ledger) == ytaquota.DAILY_QUOTA - 7
+    #Verify that the key itself is not stored
+    assert not ledger.execute("SELECT id FROM ledger WHERE apikey = 'key1';").fetchall()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_markExhausted(ledger):
+    '''Test marking a key as exhausted'''
+    ytaquota.markExhausted("key1", ledger)
+    assert ytaquota.getRemaining("key1", ledger) == 0
+    assert ytaquota.getRemaining("key2", ledger) == ytaquota.DAILY_QUOTA
+    assert ytaquota.getStatisticsBudget(["key1"]) == 0
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_forecast(ledger):
+    '''Test the forecast of the metadata units needed for the rest of the day'''
+    #Add usage of the previous week
+    for i in range(1, 8):
+        day = ytaquota.getQuotaDay(time.time() - i * 86400)
+        ledger.execute("INSERT INTO ledger(day,apikey,endpoint,units,requests) VALUES(?,?,?,?,?);", (day, ytaquota.keyID("key1"), "videos.metadata", 700, 700))
+    ledger.commit()
+    assert ytaquota.forecast("key1", "videos.metadata", dbCon=ledger) == 700
+    ytaquota.record("key1", "videos.metadata", 200, ledger)
+    assert ytaquota.forecast("key1", "videos.metadata", dbCon=ledger) == 500
+    #Budget: remaining minus forecast, 50 videos per unit
+    assert ytaquota.getStatisticsBudget(["key1"]) == (ytaquota.DAILY_QUOTA - 200 - 500) * 50
+    assert ytaquota.getStatisticsBudget(["key1"], 1000) == 1000
+    ytaquota.record("key1", "videos.statistics", 10, ledger)
+    assert ytaquota.getStatisticsBudget(["key1"], 1000) == 500
+    #Budget of multiple keys
+    assert ytaquota.getStatisticsBudget(["key1", "key2"]) == (2 * ytaquota.DAILY_QUOTA - 200 - 500 - 10) * 50
+    assert ytaquota.getStatisticsBudget(["key1", "key2"], 1000) == 500
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_KeyPool(ledger):
+    '''Test dispatching to the key with the most remaining quota'''
+    ytaquota.record("key1", "videos.metadata", 10, ledger)
+    ytaquota.record("key2", "videos.metadata", 5, ledger)
+    ytaquota.markExhausted("key3", ledger)
+    keys = ytaquota.KeyPool(["key1", "key2", "key3"])
+    assert len(keys) == 3
+    assert keys.select() == "key2"
+    keys.record("key2", "videos.statistics", 6)
+    assert keys.select() == "key1"
+    assert ytaquota.getSpent("key2", dbCon=ledger) == {"videos.metadata": 5, "videos.statistics": 6}
+    keys.exhaust("key1")
+    assert keys.select() == "key2"
+    keys.exhaust("key2")
+    with pytest.raises(ytacommon.QuotaExceededError):
+        keys.select()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_KeyPoolConcurrentRecord(ledger):
+    '''Test that requests recorded by several threads are all written to the ledger'''
+    keys = ytaquota.KeyPool(["key1", "key2"])
+    def worker():
+        for _ in range(50):
+            keys.record(keys.select(), "videos.statistics")
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    keys.close()
+    spent = [ytaquota.getSpent(k, dbCon=ledger).get("videos.statistics", 0) for k in ("key1", "key2")]
+    assert sum(spent) == 200
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_KeyPoolLockedLedger(ledger, monkeypatch):
+    '''Test that requests are kept and written later if the ledger is locked'''
+    monkeypatch.setattr(ytaquota, "LEDGER_TIMEOUT", 0.1)
+    keys = ytaquota.KeyPool(["key1"])
+    blocker = sqlite3.connect(os.environ["YTA_QUOTADB"], isolation_level=None)
+    blocker.execute("BEGIN EXCLUSIVE")
+    keys.record("key1", "videos.metadata", 3)
+    keys.record("key1", "videos.statistics", 2)
+    blocker.execute("COMMIT")
+    blocker.close()
+    assert ytaquota.getSpent("key1", dbCon=ledger) == {}
+    keys.record("key1", "videos.metadata", 1)
+    assert ytaquota.getSpent("key1", dbCon=ledger) == {"videos.metadata": 4, "videos.statistics": 2}
+    keys.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.parametrize("status,body,expected", [
+    (200, {}, None),
+    (403, {"error": {"errors": [{"reason": "quotaExceeded"}]}}, ytacommon.QuotaExceededError),
+    (403, {"error": {"errors": [{"reason": "forbidden"}]}}, requests.exceptions.HTTPError)],
+    ids=["ok", "quota", "forbidden"])
+def test_raiseForStatus(ledger, status, body, expected):
+    '''Test the detection of exceeded quotas'''
+    r = requests.models.Response()
+    r.status_code = status
+    r._content = json.dumps(body).encode()
+    if expected:
+        with pytest.raises(expected):
+            ytaquota.raiseForStatus(r, "key1")
+    else:
+        ytaquota.raiseForStatus(r, "key1")
+    assert (ytaquota.getRemaining("key1", ledger) == 0) == (expected is ytacommon.QuotaExceededError)
+# ########################################################################### #
@@ -4,9 +4,13 @@
 import os
 import sqlite3
 import time
+import json
+import shutil
+import threading
 import pytest
 
 import ytarchiver
+import ytabandwidth
 
 # --------------------------------------------------------------------------- #
 @pytest.mark.network
@@ -249,30 +253,227 @@ def test_yta_filter(request, capsys, temparchive):
 
 # --------------------------------------------------------------------------- #
 @pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
-def test_writeDownloadedFile(request, tempdir, tempcopy):
-    ''' Test writeDownloadedFile '''
+def test_DownloadArchive(request, tempcopy):
+    ''' Test the download archive backed by the archive database '''
     #Get path
     dbPath = request.node.get_closest_marker("internal_path").args[0]
-    dirPath = request.node.get_closest_marker("internal_path2").args[0]
-    filePath = os.path.join(dirPath, "down")
     #Read database
     db = sqlite3.connect(dbPath)
     ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos;").fetchall()]
-    db.close()
     #Test no replace
-    exp = ["youtube {}".format(i) for i in ids]
-    ytarchiver.writeDownloadedFile(dbPath, filePath, False, "UUsiMuEX8d_OnJe3u8i4FiqQ")
-    #Compare
-    with open(filePath) as f:
-        rec = [l.strip() for l in f.readlines()]
-    assert exp == rec
+    archive = ytarchiver.DownloadArchive(db)
+    assert archive
+    assert all("youtube {}".format(i) in archive for i in ids)
+    assert "youtube 01234567890" not in archive
+    assert "vimeo {}".format(ids[0]) not in archive
+    #Test added during the run
+    archive.add("youtube 01234567890")
+    assert "youtube 01234567890" in archive
     #Test with replace
-    exp = ["youtube {}".format(i) for i in ids[1:]]
-    ytarchiver.writeDownloadedFile(dbPath, filePath, True, ids[0])
-    #Compare
-    with open(filePath) as f:
-        rec = [l.strip() for l in f.readlines()]
-    assert exp == rec
+    archive = ytarchiver.DownloadArchive(db, ids[0])
+    assert "youtube {}".format(ids[0]) not in archive
+    assert all("youtube {}".format(i) in archive for i in ids[1:])
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_classifyError():
+    ''' Test classifying the error messages of unavailable videos '''
+    messages = {
+        "Private video. Sign in if you've been granted access to this video": "private",
+        "Join this channel to get access to members-only content like this video, and other exclusive perks.": "members",
+        "Premieres in 2 hours": "upcoming",
+        "This live event will begin in a few moments.": "upcoming",
+        "The uploader has not made this video available in your country": "geo",
+        "Sign in to confirm your age. This video may be inappropriate for some users.": "age",
+        "Video unavailable. This video has been removed by the uploader": "removed",
+        "Video unavailable. This video is no longer available because the YouTube account associated with this video has been terminated.": "removed",
+        "Video unavailable": "unavailable",
+        "Unable to download webpage: HTTP Error 503: Service Unavailable": None,
+        "Requested format is not available": None
+    }
+    for message, reason in messages.items():
+        assert ytarchiver.classifyError(message) == reason, message
+    ytdl = ytarchiver.createYoutubeDL({"quiet": True, "ignoreerrors": True})
+    ytdl.report_error("[youtube] dQw4w9WgXcQ: Private video. Sign in if you've been granted access to this video")
+    ytdl.report_error("[youtube] dQw4w9WgXcQ: Unable to download webpage: HTTP Error 503: Service Unavailable")
+    assert ytdl.unavailable == [("dQw4w9WgXcQ", "private")]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_DownloadArchiveUnavailable(request, tempcopy, capsys):
+    ''' Test skipping unavailable videos until they are retried '''
+    #Get path
+    dbPath = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(dbPath)
+    archived = db.execute("SELECT youtubeID FROM videos;").fetchone()[0]
+    archive = ytarchiver.DownloadArchive(db)
+    archive.updateUnavailable([("private0001", "private"), ("upcoming001", "upcoming"), (archived, "private")])
+    assert "INFO: Video private0001 is unavailable (private), skipping it until" in capsys.readouterr().out
+    assert "youtube private0001" in archive
+    assert not archive.archived("private0001")
+    assert archive.archived(archived)
+    #Archived videos are removed from the cache
+    assert db.execute("SELECT youtubeID,failures,retry FROM unavailable ORDER BY youtubeID;").fetchall() == [("private0001", 1, archive.now + 7 * 86400), ("upcoming001", 1, archive.now + 3600)]
+    #Retry after the backoff, which doubles with each failure up to the max of the class
+    archive.now += 3600
+    assert "youtube private0001" in archive
+    assert "youtube upcoming001" not in archive
+    for failures in range(2, 8):
+        archive.updateUnavailable([("upcoming001", "upcoming")])
+        assert db.execute("SELECT failures,retry FROM unavailable WHERE youtubeID = ?;", ("upcoming001",)).fetchone() == (failures, archive.now + min(86400, 3600 * 2 ** (failures - 1)))
+    #The backoff starts over when the class changes
+    archive.updateUnavailable([("upcoming001", "private")])
+    assert db.execute("SELECT reason,failures FROM unavailable WHERE youtubeID = ?;", ("upcoming001",)).fetchone() == ("private", 1)
+    #The video to replace is never skipped
+    assert "youtube private0001" not in ytarchiver.DownloadArchive(db, "private0001")
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_DownloadQueue(request, tempcopy, capsys):
+    ''' Test queueing discovered videos and resuming the downloads '''
+    #Get path
+    dbPath = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(dbPath)
+    archived = db.execute("SELECT youtubeID FROM videos;").fetchone()[0]
+    archive = ytarchiver.DownloadArchive(db)
+    archive.updateUnavailable([("private0001", "private")])
+    queue = ytarchiver.DownloadQueue(db)
+    for youtubeID in ["new00000001", "new00000002", archived, "private0001", "new00000001"]:
+        queue.add(youtubeID)
+    assert len(queue) == 4
+    #Archived videos are removed, unavailable videos are skipped
+    pending = queue.pending(archive)
+    assert next(pending) == "new00000001"
+    assert db.execute("SELECT state,attempts FROM download_queue WHERE youtubeID = ?;", ("new00000001",)).fetchone() == ("downloading", 1)
+    #Abort the run while downloading, the video is pending again in the next run
+    pending.close()
+    assert list(queue.pending(archive)) == ["new00000001", "new00000002"]
+    assert len(queue) == 3
+    #Archived videos are removed when the downloads are finished, failed downloads are retried
+    db.execute("UPDATE videos SET youtubeID = ? WHERE youtubeID = ?;", ("new00000002", archived))
+    queue.finish()
+    assert db.execute("SELECT youtubeID,state,attempts FROM download_queue ORDER BY youtubeID;").fetchall() == [("new00000001", "pending", 2), ("private0001", "pending", 0)]
+    #Unavailable videos that are not retried yet are not due
+    assert len(queue) == 2
+    assert queue.due(archive) == 1
+    #Videos are not retried anymore after failing too often, also when they are queued again
+    for _ in range(2, ytarchiver.QUEUE_MAX_ATTEMPTS):
+        assert list(queue.pending(archive)) == ["new00000001"]
+        queue.finish()
+    assert "WARNING: Download of video new00000001 failed {} times, not retrying it anymore".format(ytarchiver.QUEUE_MAX_ATTEMPTS) in capsys.readouterr().out
+    queue.add("new00000001")
+    assert db.execute("SELECT state,attempts FROM download_queue WHERE youtubeID = ?;", ("new00000001",)).fetchone() == ("failed", ytarchiver.QUEUE_MAX_ATTEMPTS)
+    assert len(queue) == 1
+    assert queue.due(archive) == 0
+    #Videos rejected by the match filter are not downloaded again, also when they are queued again
+    queue.add("new00000003")
+    assert list(queue.pending(archive)) == ["new00000003"]
+    queue.finish({"new00000003"})
+    queue.add("new00000003")
+    assert db.execute("SELECT youtubeID,state FROM download_queue ORDER BY youtubeID;").fetchall() == [("new00000001", "failed"), ("new00000003", "rejected"), ("private0001", "pending")]
+    assert len(queue) == 1
+    assert list(queue.pending(archive)) == []
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_MatchFilter():
+    ''' Test recording the videos rejected by the match filter '''
+    matchFilter = ytarchiver.MatchFilter("duration > 60")
+    assert matchFilter({"id": "short000001", "duration": 30}) is not None
+    assert matchFilter({"id": "long0000001", "duration": 90}) is None
+    assert matchFilter({"id": "flat0000001"}, incomplete=True) is None
+    assert matchFilter.rejected == {"short000001"}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _FakeArchiveYDL:
+    '''Stand-in for yt-dlp that checks the videos against the download
+    archive like yt-dlp and records the downloaded videos
+    '''
+    playlist = []
+    tabs = False
+    downloaded = []
+    lock = threading.Lock()
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.unavailable = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get_info_extractor(self, ieKey):
+        '''Return the extractor of single videos'''
+        return self
+
+    @staticmethod
+    def suitable(url):
+        '''Whether the URL is a single video'''
+        return url.startswith("https://www.youtube.com/watch")
+
+    def extract_info(self, url, download=True, process=True, ie_key=None):
+        '''Return the playlist, or a channel with tabs that can not be enumerated'''
+        if self.tabs:
+            entries = [{"_type": "url", "ie_key": "YoutubeTab", "id": "UCfake", "url": "https://www.youtube.com/channel/UCfake/videos"}]
+        else:
+            entries = [{"_type": "url", "ie_key": "Youtube", "id": i, "url": "https://www.youtube.com/watch?v=" + i} for i in self.playlist]
+        return {"_type": "playlist", "id": "PLfake", "entries": iter(entries)}
+
+    def download(self, urls):
+        '''Download the videos that are not archived'''
+        archive = self.opts["download_archive"]
+        for url in urls:
+            for youtubeID in [url.rsplit('=', 1)[-1]] if self.suitable(url) else self.playlist:
+                if archive is not None and "youtube " + youtubeID in archive:
+                    continue
+                time.sleep(0.05)
+                with self.lock:
+                    _FakeArchiveYDL.downloaded.append((youtubeID, threading.get_ident()))
+                if archive is not None:
+                    archive.add("youtube " + youtubeID)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.temp_archive
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_archiveParallelDirect(request, monkeypatch, fakeapi):
+    ''' Test that parallel downloads of playlists that are not queued skip the archived videos '''
+    path = request.node.get_closest_marker("internal_path").args[0]
+    monkeypatch.setattr(ytarchiver, "createYoutubeDL", _FakeArchiveYDL)
+    db = sqlite3.connect(os.path.join(path, "archive.db"))
+    archived = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id DESC;").fetchall()]
+    db.close()
+    args = ytarchiver.argparse.Namespace(all=False, check="", jobs=1, workers=2, ratelimit=None, profile=None, statistics=False, captions=False, amendcaptions=False, source="auto", probe=False, metrics=None, stage="all", fullsweep=False, replace="", quality=None, file=None, filter=None, DIR=path, LANG=None, VIDEO=None)
+    #Batch file with a playlist and videos, the new videos of the playlist are downloaded in parallel
+    new = ["new0000000{}".format(i) for i in range(1, 5)]
+    _FakeArchiveYDL.playlist = [new[0], archived[0], new[1]] + archived[1:] + [new[2]]
+    batchFile = os.path.join(path, "batch")
+    with open(batchFile, 'w') as f:
+        f.write("https://www.youtube.com/playlist?list=PLfake\nhttps://www.youtube.com/watch?v={}\nhttps://www.youtube.com/watch?v={}\n".format(archived[0], new[3]))
+    args.file = batchFile
+    _FakeArchiveYDL.downloaded = []
+    ytarchiver.archive(args, True)
+    assert sorted(d[0] for d in _FakeArchiveYDL.downloaded) == new
+    assert len({d[1] for d in _FakeArchiveYDL.downloaded}) == 2
+    #Playlist that can not be enumerated, handed to a worker as a whole
+    args.file = None
+    args.VIDEO = None
+    _FakeArchiveYDL.tabs = True
+    _FakeArchiveYDL.playlist = archived + ["new00000005"]
+    _FakeArchiveYDL.downloaded = []
+    try:
+        ytarchiver.archive(args, True)
+    finally:
+        _FakeArchiveYDL.tabs = False
+    assert [d[0] for d in _FakeArchiveYDL.downloaded] == ["new00000005"]
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -287,3 +488,236 @@ def test_readInfoFromDB(request, tempcopy):
     #Compare
     assert exp == rec
 # ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _fakeArchive(args, parsed=False):
+    '''Stand-in for archive used by the parallel mode test, runs in the worker processes'''
+    name = os.path.basename(args.DIR)
+    if name == "3":
+        raise KeyboardInterrupt
+    with open(os.path.join(args.DIR, "log"), 'w') as f:
+        f.write("Downloading {}\n".format(name))
+        if name == "2":
+            f.write("ERROR: Video unavailable\n")
+    print("Archived {} in process {}".format(name, os.getpid()))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_archiveAllParallel(request, capsys, monkeypatch, tempallarchive):
+    ''' Test archiving several channels at once and resuming after an abort '''
+    #Get path
+    path = request.node.get_closest_marker("internal_path").args[0]
+    monkeypatch.setattr(ytarchiver, "archive", _fakeArchive)
+    args = ytarchiver.argparse.Namespace(all=True, DIR=path, LANG=None, VIDEO=None, statistics=False, captions=False, amendcaptions=False, jobs=2)
+    #Abort while archiving the third channel
+    with pytest.raises(KeyboardInterrupt):
+        ytarchiver.archiveAll(args)
+    with open(os.path.join(path, "progress.json")) as f:
+        progress = json.load(f)
+    assert os.path.join(path, "3") in progress["subdirs"]
+    assert progress["counter"] == 4 - len(progress["subdirs"])
+    #Resume with the remaining channel
+    os.makedirs(os.path.join(path, "4"))
+    shutil.copyfile(os.path.join(path, "1", "archive.db"), os.path.join(path, "4", "archive.db"))
+    progress["subdirs"] = [os.path.join(path, "1"), os.path.join(path, "2"), os.path.join(path, "4")]
+    progress["counter"] = 1
+    with open(os.path.join(path, "progress.json"), 'w') as f:
+        json.dump(progress, f)
+    capsys.readouterr()
+    args.all = True
+    ytarchiver.archiveAll(args)
+    out = capsys.readouterr().out
+    assert "CONTINUING ARCHIVING ALL 3 CHANNELS" in out
+    for name in ["1", "2", "4"]:
+        assert "Archived {} in process".format(name) in out
+    assert "({}/3)".format(3) in out
+    #The channels are archived in other processes
+    assert "in process {}\n".format(os.getpid()) not in out
+    assert not os.path.isfile(os.path.join(path, "progress.json"))
+    with open(os.path.join(path, "log")) as f:
+        log = f.read()
+    assert "\n\n2\n\nDownloading 2\nERROR: Video unavailable\n" in log
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_probePlaylist(request, tempcopy, fakeapi):
+    ''' Test checking the feed of a playlist for new videos '''
+    #Get path
+    dbPath = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(dbPath)
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id DESC;").fetchall()]
+    archive = ytarchiver.DownloadArchive(db)
+    queue = ytarchiver.DownloadQueue(db)
+    #No new videos
+    fakeapi.feeds["UUsiMuEX8d_OnJe3u8i4FiqQ"] = ids
+    assert ytarchiver.probePlaylist("UUsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) == []
+    #New videos
+    fakeapi.feeds["UUsiMuEX8d_OnJe3u8i4FiqQ"] = ["01234567890"] + ids
+    assert ytarchiver.probePlaylist("UUsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) == ["01234567890"]
+    fakeapi.feeds["UCsiMuEX8d_OnJe3u8i4FiqQ"] = ["01234567890"]
+    assert ytarchiver.probePlaylist("UCsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) == ["01234567890"]
+    #Feed not available or not conclusive
+    assert ytarchiver.probePlaylist("PLsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) is None
+    fakeapi.feeds["PLsiMuEX8d_OnJe3u8i4FiqQ"] = []
+    assert ytarchiver.probePlaylist("PLsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) is None
+    assert ytarchiver.probePlaylist("https://www.youtube.com/watch?v=" + ids[0], archive, queue) is None
+    assert ytarchiver.probePlaylist(ids[0], archive, queue) is None
+    #Queued videos in any state and unavailable videos are not new, until the unavailable videos are retried
+    fakeapi.feeds["UCsiMuEX8d_OnJe3u8i4FiqQ"] = ["queued00001", "failed00001", "private0001", "removed0001"]
+    queue.add("queued00001")
+    queue.add("failed00001")
+    db.execute("UPDATE download_queue SET state = 'failed' WHERE youtubeID = ?;", ("failed00001",))
+    archive.updateUnavailable([("private0001", "private"), ("removed0001", "removed")])
+    db.execute("UPDATE unavailable SET retry = ? WHERE youtubeID = ?;", (archive.now, "removed0001"))
+    assert ytarchiver.probePlaylist("UCsiMuEX8d_OnJe3u8i4FiqQ", archive, queue) == ["removed0001"]
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_yta_probe(request, capsys, monkeypatch, temparchive, fakeapi):
+    ''' Test that the download is skipped if the feed has no new videos, unless the playlist is swept '''
+    #Get path
+    path = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(os.path.join(path, "archive.db"))
+    fakeapi.feeds["UUsiMuEX8d_OnJe3u8i4FiqQ"] = [i[0] for i in db.execute("SELECT youtubeID FROM videos;").fetchall()]
+    db.execute("UPDATE channel SET lastsweep = ? WHERE id = 1;", (int(time.time()),))
+    db.commit()
+    ytarchiver.archive([path])
+    assert "INFO: No new videos in the feed of \"UUsiMuEX8d_OnJe3u8i4FiqQ\", skipping download\n" in capsys.readouterr().out
+    with open(os.path.join(path, "log")) as f:
+        assert f.read() == "INFO: No new videos in the feed of \"UUsiMuEX8d_OnJe3u8i4FiqQ\", skipping download\n"
+    assert fakeapi.count("/feeds/videos.xml") == 1
+    #A due full sweep enumerates the whole playlist without checking the feed
+    swept = []
+    monkeypatch.setattr(ytarchiver, "enumeratePlaylist", lambda ytdl, playlist, archive, cursor=None, stopAfter=None, process=None: swept.append((cursor, stopAfter)) or ([], []))
+    db.execute("UPDATE channel SET lastsweep = 0 WHERE id = 1;")
+    db.commit()
+    ytarchiver.archive([path])
+    assert swept == [(None, None)]
+    assert fakeapi.count("/feeds/videos.xml") == 1
+    assert db.execute("SELECT lastsweep FROM channel WHERE id = 1;").fetchone()[0] > 0
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _FakePlaylistYDL:
+    '''Stand-in for yt-dlp that enumerates a playlist lazily and counts the enumerated entries'''
+    def __init__(self, ids):
+        self.ids = ids
+        self.enumerated = 0
+
+    def extract_info(self, url, download=True, process=True, ie_key=None):
+        '''Return the playlist, with a redirect for bare playlist IDs'''
+        if not url.startswith("https://"):
+            return {"_type": "url", "url": "https://www.youtube.com/playlist?list=" + url, "ie_key": "YoutubeTab"}
+        return {"_type": "playlist", "id": "PLfake", "entries": self._entries()}
+
+    def _entries(self):
+        for youtubeID in self.ids:
+            self.enumerated += 1
+            yield {"_type": "url", "ie_key": "Youtube", "id": youtubeID, "url": "https://www.youtube.com/watch?v=" + youtubeID}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_enumeratePlaylist(request, tempcopy):
+    ''' Test the incremental enumeration of a playlist '''
+    #Get path
+    dbPath = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(dbPath)
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id DESC;").fetchall()]
+    archive = ytarchiver.DownloadArchive(db)
+    playlist = ["new00000001", ids[0], "new00000002"] + ids[1:] + ["new00000003"]
+    #Full enumeration
+    ytdl = _FakePlaylistYDL(playlist)
+    assert ytarchiver.enumeratePlaylist(ytdl, "PLfake", archive) == (playlist, ["new00000001", "new00000002", "new00000003"])
+    #Stop after consecutive archived videos, the rest of the playlist is not enumerated
+    ytdl = _FakePlaylistYDL(playlist)
+    assert ytarchiver.enumeratePlaylist(ytdl, "PLfake", archive, stopAfter=3) == (playlist[:6], ["new00000001", "new00000002"])
+    assert ytdl.enumerated == 6
+    #Stop at the cursor
+    ytdl = _FakePlaylistYDL(playlist)
+    assert ytarchiver.enumeratePlaylist(ytdl, "PLfake", archive, cursor=ids[0], stopAfter=3) == (["new00000001"], ["new00000001"])
+    #Channels with tabs are not enumerated
+    ytdl = _FakePlaylistYDL(playlist)
+    ytdl._entries = lambda: iter([{"_type": "url", "ie_key": "YoutubeTab", "id": "UCfake", "url": "https://www.youtube.com/channel/UCfake/videos"}])
+    assert ytarchiver.enumeratePlaylist(ytdl, "PLfake", archive) is None
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@pytest.mark.internal_path(os.path.join(os.environ["YTA_TESTDATA"], "dbversions", os.environ["YTA_TEST_LATESTDB"]))
+def test_enumeratePlaylistStreaming(request, tempcopy):
+    ''' Test that new videos are processed while the playlist is enumerated '''
+    #Get path
+    dbPath = request.node.get_closest_marker("internal_path").args[0]
+    db = sqlite3.connect(dbPath)
+    ids = [i[0] for i in db.execute("SELECT youtubeID FROM videos ORDER BY id DESC;").fetchall()]
+    archive = ytarchiver.DownloadArchive(db)
+    ytdl = _FakePlaylistYDL(["new00000001", ids[0], "new00000002"] + ids[1:])
+    processed = []
+    def process(youtubeID):
+        processed.append((youtubeID, ytdl.enumerated))
+        archive.add("youtube " + youtubeID)
+    assert ytarchiver.enumeratePlaylist(ytdl, "PLfake", archive, process=process)[1] == ["new00000001", "new00000002"]
+    #Each video is processed before the next one is enumerated
+    assert processed == [("new00000001", 1), ("new00000002", 3)]
+    db.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _FakeDownloadYDL:
+    '''Stand-in for yt-dlp that "downloads" a video by waiting and calling the post hooks'''
+    active = 0
+    maxActive = 0
+    started = 0
+    lock = threading.Lock()
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.unavailable = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def download(self, urls):
+        '''Download the videos'''
+        for url in urls:
+            with self.lock:
+                _FakeDownloadYDL.started += 1
+                _FakeDownloadYDL.active += 1
+                _FakeDownloadYDL.maxActive = max(_FakeDownloadYDL.maxActive, _FakeDownloadYDL.active)
+            time.sleep(0.05)
+            with self.lock:
+                _FakeDownloadYDL.active -= 1
+            for hook in self.opts["post_hooks"]:
+                hook(url.rsplit('=', 1)[-1] + ".mp4")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def test_ParallelDownloader(monkeypatch):
+    ''' Test downloading several videos at once with serialized post-processing '''
+    monkeypatch.setattr(ytarchiver, "createYoutubeDL", _FakeDownloadYDL)
+    processed = []
+    class PostHook:
+        '''Records the post-processed files and the thread they were processed in'''
+        @staticmethod
+        def finished(filename):
+            processed.append((filename, threading.get_ident()))
+    ids = ["v{:010d}".format(i) for i in range(12)]
+    downloader = ytarchiver.ParallelDownloader({"post_hooks": [], "download_archive": object()}, 4, PostHook(), ytabandwidth.BandwidthGovernor())
+    for i, youtubeID in enumerate(ids):
+        downloader.download(["https://www.youtube.com/watch?v=" + youtubeID])
+        #Videos are only handed over when a worker takes them, not queued ahead
+        assert _FakeDownloadYDL.started >= i - 2
+    downloader.close()
+    assert sorted(p[0] for p in processed) == [i + ".mp4" for i in ids]
+    assert all(p[1] == threading.get_ident() for p in processed)
+    assert _FakeDownloadYDL.maxActive == 4
+# ########################################################################### #
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+''' ytabandwidth - share a download rate between all downloads '''
+
+import re
+import time
+import threading
+from datetime import datetime
+
+# --------------------------------------------------------------------------- #
+#Interval in seconds in which the rates of the running downloads are adjusted
+GOVERNOR_INTERVAL = 5
+#Rate in bytes per second below which yt-dlp assumes that a download is
+#throttled, must match the "throttledratelimit" option of ytarchiver
+THROTTLED_RATE = 100000
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def parseProfile(profile):
+    '''Parse a time-of-day profile
+
+    :param profile: Comma-separated list of windows with the share of the rate during the window (e.g. "08:00-18:00=20%,18:00-22:00=50%")
+    :type profile: string
+
+    :raises: :class:``ValueError: Invalid profile
+
+    :returns: List of windows (start minute, end minute, share), windows may cross midnight
+    :rtype: list of tuple
+    '''
+    windows = []
+    for window in profile.split(','):
+        match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d{1,3})%\s*", window)
+        if not match:
+            raise ValueError("Invalid window \"{}\"".format(window))
+        h1, m1, h2, m2, share = [int(g) for g in match.groups()]
+        if h1 * 60 + m1 > 1440 or h2 * 60 + m2 > 1440 or m1 > 59 or m2 > 59 or not 1 <= share <= 100:
+            raise ValueError("Invalid window \"{}\"".format(window))
+        windows.append((h1 * 60 + m1, h2 * 60 + m2, share / 100))
+    return windows
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class BandwidthGovernor:
+    '''Shares a download rate between all running downloads. The rate can be
+    reduced during time-of-day windows. Each download gets an equal share of
+    the rate, which is adjusted while downloading by changing the "ratelimit"
+    option of the yt-dlp instances. The number of running downloads can be
+    shared between processes
+    '''
+
+    def __init__(self, rate=None, profile=None, shared=None):
+        '''Init
+
+        :param rate: The total download rate in bytes per second (Default: no limit)
+        :type rate: integer, optional
+        :param profile: The time-of-day windows as returned by parseProfile (Default: always the full rate)
+        :type profile: list of tuple, optional
+        :param shared: Counter of the running downloads shared between processes (Default: only count the downloads of this process)
+        :type shared: multiprocessing.Value, optional
+        '''
+        self.rate = rate
+        self.profile = profile or []
+        self._shared = shared
+        #Options of the yt-dlp instances that are downloading, by their id
+        self._running = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def share(self, now=None):
+        '''Return the rate of each running download
+
+        :param now: The current time (Default: now)
+        :type now: datetime.datetime, optional
+
+        :returns: The rate in bytes per second, None if not limited
+        :rtype: integer
+        '''
+        if not self.rate:
+            return None
+        if now is None:
+            now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        factor = 1.0
+        for start, end, share in self.profile:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                factor = share
+                break
+        running = self._shared.value if self._shared is not None else len(self._running)
+        return max(1, int(self.rate * factor / max(1, running)))
+
+    def download(self, ytdl, urls):
+        '''Download with the share of the rate
+
+        :param ytdl: The yt-dlp instance
+        :type ytdl: yt_dlp.YoutubeDL
+        :param urls: The URLs to download
+        :type urls: list of string
+        '''
+        if not self.rate:
+            ytdl.download(urls)
+            return
+        self._register(ytdl.params, 1)
+        try:
+            ytdl.download(urls)
+        finally:
+            self._register(ytdl.params, -1)
+
+    def adjust(self):
+        '''Set the share of the rate for all running downloads of this process'''
+        share = self.share()
+        with self._lock:
+            for params in self._running.values():
+                params["ratelimit"] = share
+                #Slow downloads are only restarted when they are slower than the share
+                params["throttledratelimit"] = THROTTLED_RATE if share is None or share > 2 * THROTTLED_RATE else None
+
+    def _register(self, params, delta):
+        '''Add or remove a running download and adjust the rates'''
+        with self._lock:
+            if delta > 0:
+                self._running[id(params)] = params
+            else:
+                del self._running[id(params)]
+            if self._shared is not None:
+                with self._shared.get_lock():
+                    self._shared.value += delta
+            if delta > 0 and not self._thread:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self.adjust()
+
+    def _run(self):
+        '''Adjust the rates periodically, as the time-of-day window and the
+        downloads of other processes change, until no download is running
+        '''
+        while True:
+            time.sleep(GOVERNOR_INTERVAL)
+            with self._lock:
+                if not self._running:
+                    self._thread = None
+                    return
+            self.adjust()
+# ########################################################################### #
@@ -7,13 +7,73 @@ import sqlite3
 import re
 import subprocess
 import hashlib
+import types
+import threading
+import importlib.util
 from decimal import Decimal as decimal
-import requests
-from appdirs import AppDirs
+
+# --------------------------------------------------------------------------- #
+#Lock held while a lazily imported module is loaded, and the modules being loaded
+_lazyImportLock = threading.RLock()
+_lazyLoading = set()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _LazyModule(types.ModuleType):
+    '''Module that is loaded on the first attribute access. Other threads wait
+    until it is loaded (importlib.util.LazyLoader lets them see the module
+    before it is loaded), and it becomes a normal module once loaded
+    '''
+
+    def __getattribute__(self, attr):
+        '''Load the module, then return the attribute'''
+        with _lazyImportLock:
+            if type(self) is _LazyModule and self not in _lazyLoading:
+                _lazyLoading.add(self)
+                try:
+                    types.ModuleType.__getattribute__(self, "__spec__").loader.exec_module(self)
+                    self.__class__ = types.ModuleType
+                finally:
+                    _lazyLoading.discard(self)
+        return types.ModuleType.__getattribute__(self, attr)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def lazyImport(name):
+    '''Import a module when one of its attributes is first accessed instead
+    of right away, so that the yta* scripts only load heavy dependencies
+    (e.g. requests, yt_dlp) on the paths that use them
+
+    :param name: The module name
+    :type name: string
+
+    :raises: :class:``ModuleNotFoundError: The module is not installed
+
+    :returns: The module, loaded on first use
+    :rtype: module
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named '{}'".format(name), name=name)
+    module = importlib.util.module_from_spec(spec)
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+    return module
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+requests = lazyImport("requests")
+appdirs = lazyImport("appdirs")
+# ########################################################################### #
 
 # --------------------------------------------------------------------------- #
 __version__ = "1.6.0"
-__dbversion__ = 7
+__dbversion__ = 13
+#Base URLs of the web services used, all of them can be redirected to another
+#server (e.g. for testing) with the "YTA_BASEURL" environment variable
+BASE_URLS = {"api": "https://www.googleapis.com", "timedtext": "https://video.google.com", "oembed": "https://www.youtube.com", "feed": "https://www.youtube.com"}
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -83,6 +143,22 @@ def calcSHA(path):
     return sha256.hexdigest()
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def getServiceURL(service, path):
+    '''Return the URL of a web service endpoint
+
+    :param service: The service, one of the keys of BASE_URLS
+    :type service: string
+    :param path: The path of the endpoint (e.g. "/youtube/v3/videos")
+    :type path: string
+
+    :returns: The URL
+    :rtype: string
+    '''
+    base = os.environ.get("YTA_BASEURL") or BASE_URLS[service]
+    return base.rstrip('/') + path
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def loadImage(url):
     '''Download image at url
@@ -128,7 +204,9 @@ def createChannelTable(dbCon):
                   lastupdate INTEGER NOT NULL,
                   dbversion INTEGER NOT NULL,
                   maxresolution NOT NULL,
-                  totalsize INTEGER NOT NULL
+                  totalsize INTEGER NOT NULL,
+                  cursor TEXT,
+                  lastsweep INTEGER NOT NULL DEFAULT 0
               ); """
     #Set encoding
     dbCon.execute("pragma encoding=UTF8")
@@ -179,6 +257,107 @@ def createVideoTable(dbCon):
     dbCon.execute(cmd)
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def createAPICacheTable(dbCon):
+    '''Create the table caching the ETags of Youtube Data API responses if
+    it does not exist already
+
+    :param dbCon: Connection to the database
+    :type dbCon: sqlite3.Connection
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+    '''
+    cmd = """ CREATE TABLE IF NOT EXISTS apicache (
+                  key TEXT NOT NULL,
+                  part TEXT NOT NULL,
+                  etag TEXT NOT NULL,
+                  checked INTEGER NOT NULL,
+                  PRIMARY KEY(key, part)
+              ); """
+    dbCon.execute(cmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createStatisticsHistoryTable(dbCon):
+    '''Create the table containing the delta encoded statistics history of
+    each video if it does not exist already
+
+    :param dbCon: Connection to the database
+    :type dbCon: sqlite3.Connection
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+    '''
+    cmd = """ CREATE TABLE IF NOT EXISTS statisticshistory (
+                  videoid INTEGER PRIMARY KEY UNIQUE NOT NULL,
+                  samples INTEGER NOT NULL,
+                  lasttimestamp INTEGER NOT NULL,
+                  lastviewcount INTEGER NOT NULL,
+                  lastlikecount INTEGER NOT NULL,
+                  lastdislikecount INTEGER NOT NULL,
+                  data BLOB NOT NULL
+              ); """
+    dbCon.execute(cmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createPendingMetadataTable(dbCon):
+    '''Create the table queueing the videos whose metadata could not be
+    loaded from the API when archiving them if it does not exist already
+
+    :param dbCon: Connection to the database
+    :type dbCon: sqlite3.Connection
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+    '''
+    cmd = """ CREATE TABLE IF NOT EXISTS pending_metadata (
+                  youtubeID TEXT PRIMARY KEY UNIQUE NOT NULL,
+                  added INTEGER NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  lastattempt INTEGER
+              ); """
+    dbCon.execute(cmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createUnavailableTable(dbCon):
+    '''Create the table caching the videos that could not be downloaded
+    because they are unavailable (e.g. private) if it does not exist already
+
+    :param dbCon: Connection to the database
+    :type dbCon: sqlite3.Connection
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+    '''
+    cmd = """ CREATE TABLE IF NOT EXISTS unavailable (
+                  youtubeID TEXT PRIMARY KEY UNIQUE NOT NULL,
+                  reason TEXT NOT NULL,
+                  failures INTEGER NOT NULL DEFAULT 1,
+                  lastfailure INTEGER NOT NULL,
+                  retry INTEGER NOT NULL
+              ); """
+    dbCon.execute(cmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createDownloadQueueTable(dbCon):
+    '''Create the table queueing the discovered videos that are not archived
+    yet if it does not exist already
+
+    :param dbCon: Connection to the database
+    :type dbCon: sqlite3.Connection
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+    '''
+    cmd = """ CREATE TABLE IF NOT EXISTS download_queue (
+                  youtubeID TEXT PRIMARY KEY UNIQUE NOT NULL,
+                  state TEXT NOT NULL DEFAULT 'pending',
+                  added INTEGER NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  lastattempt INTEGER
+              ); """
+    dbCon.execute(cmd)
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def upgradeDatabase(dbPath):
     '''Check the database version and upgrade it if not newest
@@ -304,6 +483,51 @@ def upgradeDatabase(dbPath):
                 version = 7
                 db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
                 dbCon.commit()
+            #Perform upgrade to version 8
+            if version < 8:
+                #Add API response cache
+                createAPICacheTable(dbCon)
+                #Update db version
+                version = 8
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
+            #Perform upgrade to version 9
+            if version < 9:
+                #Add statistics history
+                createStatisticsHistoryTable(dbCon)
+                #Update db version
+                version = 9
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
+            if version < 10:
+                #Add queue of videos with missing metadata
+                createPendingMetadataTable(dbCon)
+                #Update db version
+                version = 10
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
+            if version < 11:
+                #Add playlist cursor and time of the last full enumeration of the playlist
+                db.execute('ALTER TABLE channel ADD COLUMN cursor TEXT;')
+                db.execute('ALTER TABLE channel ADD COLUMN lastsweep INTEGER NOT NULL DEFAULT 0;')
+                #Update db version
+                version = 11
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
+            if version < 12:
+                #Add cache of unavailable videos
+                createUnavailableTable(dbCon)
+                #Update db version
+                version = 12
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
+            if version < 13:
+                #Add queue of discovered videos
+                createDownloadQueueTable(dbCon)
+                #Update db version
+                version = 13
+                db.execute("UPDATE channel SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
         except sqlite3.Error as e:
             print("ERROR: Unable to upgrade database (\"{}\")".format(e))
             dbCon.rollback()
@@ -490,13 +714,13 @@ def getAPIKey(askWhenMissing=False):
     '''
     #Check if test env
     if os.environ.get("YTA_TEST"):
-        #Return test API key
+        #Return (first) test API key
         if os.environ.get("YTA_TEST_APIKEY"):
-            return os.environ.get("YTA_TEST_APIKEY")
+            return os.environ.get("YTA_TEST_APIKEY").split(',')[0]
         #In test mode, but no test API key, print warning
         raise Exception("ERROR: No test API key given")
 
-    dirs = AppDirs("ytarchiver", "yta")
+    dirs = appdirs.AppDirs("ytarchiver", "yta")
     try:
         #Try user data dir (e.g. ~.config, ~/Library/Application Support, AppData\Local)
         apiKey = readAPIKey(os.path.join(dirs.user_data_dir, "ytapikey"))
@@ -526,6 +750,50 @@ def getAPIKey(askWhenMissing=False):
     return apiKey
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def getAPIKeys():
+    '''Get all API keys from the config. Multiple keys can be added to the
+    config file with one key per line
+
+    :returns: List of API keys, empty if no key is available
+    :rtype: list of string
+    '''
+    #Check if test env
+    if os.environ.get("YTA_TEST"):
+        #Return test API keys
+        if os.environ.get("YTA_TEST_APIKEY"):
+            return os.environ.get("YTA_TEST_APIKEY").split(',')
+        #In test mode, but no test API key, print warning
+        raise Exception("ERROR: No test API key given")
+
+    dirs = appdirs.AppDirs("ytarchiver", "yta")
+    for directory in [dirs.user_data_dir, dirs.site_data_dir]:
+        try:
+            return readAPIKeys(os.path.join(directory, "ytapikey"))
+        except OSError:
+            continue
+    return []
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def readAPIKeys(filePath):
+    '''Read all API keys from the given file
+
+    :param filePath: The file path to read from
+    :type filePath: string
+    :returns: The API keys
+    :rtype: list of string
+
+    :raises: :class:``OSError: Unable to read API key from file
+    '''
+    with open(filePath) as f:
+        keys = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    #Either no lines or only comments, raise error
+    if not keys:
+        raise OSError
+    return keys
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def readAPIKey(filePath):
     '''Read the API key from the given file
@@ -583,6 +851,20 @@ class NoAPIKeyError(Exception):
     '''Raised if no API key was provided'''
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def __getattr__(name):
+    '''Create QuotaExceededError when it is first used, as it is based on
+    the exceptions of requests, which are only imported when needed
+    '''
+    if name != "QuotaExceededError":
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    #Threads using it at the same time must get the same class
+    with _lazyImportLock:
+        if name not in globals():
+            globals()[name] = type(name, (requests.exceptions.HTTPError,), {"__doc__": "Raised if the daily API quota was exceeded", "__module__": __name__})
+        return globals()[name]
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def toInt(var):
     '''Cast a variable to integer or return null if not possible'''
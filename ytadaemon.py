@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+''' ytadaemon - keep archiving all channels, each on its own polling cadence '''
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import sqlite3
+import argparse
+import threading
+import socketserver
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+
+import ytacommon as yta
+import ytarchiver
+import ytametrics
+
+# --------------------------------------------------------------------------- #
+#Default port of the control interface (only reachable from localhost)
+CONTROL_PORT = 8765
+#Bounds of the polling interval of a channel in seconds
+MIN_POLL_INTERVAL = 3600
+MAX_POLL_INTERVAL = 86400
+#Polling interval of channels with too few videos to derive a cadence
+DEFAULT_POLL_INTERVAL = 6 * 3600
+#Number of the newest uploads used to derive the cadence of a channel
+CADENCE_SAMPLES = 10
+#A channel is polled this many times per average interval between its uploads
+POLLS_PER_UPLOAD = 4
+#Interval in seconds in which new subdirectories are discovered
+RESCAN_INTERVAL = 3600
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def daemon(args):
+    '''Run the archiver daemon or send a command to a running daemon
+
+    :param args: The command line arguments given by the user
+    :type args: list
+    '''
+    parser = argparse.ArgumentParser(prog="ytadaemon", description="Keep archiving all channels in subdirectories, each polled according to how often it uploads")
+    parser.add_argument("-p", "--port", action="store", dest="port", type=int, default=CONTROL_PORT, help="Port of the control interface on localhost (Default: {})".format(CONTROL_PORT))
+    parser.add_argument("-C", "--control", action="store", dest="control", nargs='+', metavar="COMMAND", help="Send a command to the running daemon and print the reply: status, pause [CHANNEL], resume [CHANNEL], enqueue CHANNEL, stop")
+    parser.add_argument("-c", "--check", action="store_const", dest="check", const="-c", default="", help="Check each file after download")
+    parser.add_argument("-j", "--jobs", action="store", dest="jobs", type=int, default=1, help="Number of channels archived at the same time (Default: 1)")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=1, help="Number of videos of a channel downloaded at the same time (Default: 1)")
+    parser.add_argument("--limit-rate", action="store", dest="ratelimit", type=ytarchiver.parseRate, default=None, help="Max total download rate in bytes per second (e.g. 50K or 4.2M), shared equally by all running downloads")
+    parser.add_argument("--rate-profile", action="store", dest="profile", type=ytarchiver.parseProfile, default=None, help="Share of the max download rate during times of the day (e.g. \"08:00-18:00=20%%,18:00-22:00=50%%\"), the full rate outside of the given times")
+    parser.add_argument("--metrics-port", action="store", dest="metricsport", type=int, default=None, help="Serve counters and stage durations in the Prometheus text format on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("-V", "--version", action="version", version='%(prog)s {}'.format(yta.__version__))
+    parser.add_argument("DIR", nargs='?', help="The directory containing the channel archives in subdirectories")
+    args = parser.parse_args(args)
+
+    #Send command
+    if args.control:
+        try:
+            print(json.dumps(sendCommand(args.port, args.control), indent=2))
+        except OSError as e:
+            print("ERROR: Unable to reach the daemon on port {}: \"{}\"".format(args.port, e))
+        return
+
+    if not args.DIR:
+        parser.error("DIR must be specified to start the daemon")
+    if args.jobs < 1:
+        parser.error("-j must be at least 1")
+    if args.workers < 1:
+        parser.error("-w must be at least 1")
+    if args.profile and not args.ratelimit:
+        parser.error("--rate-profile requires --limit-rate")
+    path = os.path.normpath(os.path.abspath(args.DIR))
+    if not os.path.isdir(path):
+        parser.error("An existing directory must be specified")
+
+    #Check if API key provided
+    yta.getAPIKey(True)
+
+    archiver = ArchiveDaemon(path, args)
+    server = ControlServer(("127.0.0.1", args.port), archiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    metricsServer = ytametrics.MetricsServer(("127.0.0.1", args.metricsport)).start() if args.metricsport else None
+    #Finish the running channels before exiting when terminated or interrupted
+    def terminate(signum, _frame):
+        print("INFO: Received {}, stopping after the running channels are finished".format(signal.Signals(signum).name))
+        sys.stdout.flush()
+        archiver.stop()
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    print("INFO: Archiving {} channels in \'{}\', control interface on port {}".format(len(archiver.channels), path, args.port))
+    try:
+        archiver.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if metricsServer:
+            metricsServer.shutdown()
+            metricsServer.server_close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def pollInterval(dbPath, now=None):
+    '''Derive the polling interval of a channel from how often it uploaded
+    recently. A channel that stopped uploading is polled less often the longer
+    its last upload is ago
+
+    :param dbPath: The path of the archive database
+    :type dbPath: string
+    :param now: The current time as timestamp (Default: now)
+    :type now: integer, optional
+
+    :returns: The interval in seconds
+    :rtype: integer
+    '''
+    if now is None:
+        now = int(time.time())
+    try:
+        db = yta.connectDB(dbPath)
+        try:
+            timestamps = [r[0] for r in db.execute("SELECT timestamp FROM videos ORDER BY timestamp DESC LIMIT ?;", (CADENCE_SAMPLES,))]
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return DEFAULT_POLL_INTERVAL
+    if len(timestamps) < 2:
+        return DEFAULT_POLL_INTERVAL
+    average = (timestamps[0] - timestamps[-1]) / (len(timestamps) - 1)
+    average = max(average, now - timestamps[0])
+    return int(min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, average / POLLS_PER_UPLOAD)))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def sendCommand(port, command):
+    '''Send a command to the control interface of a running daemon
+
+    :param port: The port of the control interface
+    :type port: integer
+    :param command: The command and its arguments (e.g. ["pause", "channel"])
+    :type command: list of string
+
+    :raises: :class:``OSError: Unable to reach the daemon
+
+    :returns: The reply
+    :rtype: dict
+    '''
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        sock.sendall((' '.join(command) + '\n').encode("UTF-8"))
+        with sock.makefile('r', encoding="UTF-8") as f:
+            return json.loads(f.readline())
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class Channel:
+    '''The schedule of a channel archive'''
+
+    def __init__(self, path):
+        '''Init, poll the channel as soon as possible
+
+        :param path: The directory of the channel archive
+        :type path: string
+        '''
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+        self.interval = pollInterval(os.path.join(path, "archive.db"))
+        self.nextPoll = 0
+        self.lastPoll = None
+        self.lastResult = None
+        self.paused = False
+        self.running = False
+        #Poll again right after the running poll
+        self.enqueued = False
+
+    def status(self):
+        '''Return the status for the control interface
+
+        :returns: The status
+        :rtype: dict
+        '''
+        state = "running" if self.running else "paused" if self.paused else "waiting"
+        return {"name": self.name, "state": state, "interval": self.interval, "nextPoll": self.nextPoll, "lastPoll": self.lastPoll, "lastResult": self.lastResult}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class ArchiveDaemon:
+    '''Archives the channels in the subdirectories of a directory whenever
+    they are due. The channels are archived in worker processes that are kept
+    for the lifetime of the daemon, so yt-dlp is only imported once
+    '''
+
+    def __init__(self, path, args):
+        '''Init, discover the channels
+
+        :param path: The directory containing the channel archives
+        :type path: string
+        :param args: The command line arguments given by the user
+        :type args: argparse.Namespace
+        '''
+        self.path = path
+        self.jobs = args.jobs
+        self.paused = False
+        self.channels = {}
+        #The arguments of ytarchiver for each channel
+        self._args = argparse.Namespace(all=False, check=args.check, jobs=args.jobs, workers=args.workers, ratelimit=args.ratelimit, profile=args.profile, statistics=False, captions=False, amendcaptions=False, source="auto", probe=True, fullsweep=False, replace="", quality=None, file=None, filter=None, metrics=None, stage="all", DIR=None, LANG=None, VIDEO=None)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._lastScan = 0
+        self.rescan()
+
+    def rescan(self):
+        '''Discover the subdirectories with archive databases'''
+        with self._condition:
+            for name in sorted(os.listdir(self.path), key=str.casefold):
+                sub = os.path.join(self.path, name)
+                if name not in self.channels and os.path.isfile(os.path.join(sub, "archive.db")):
+                    self.channels[name] = Channel(sub)
+            self._lastScan = time.time()
+
+    def command(self, line):
+        '''Execute a command of the control interface
+
+        :param line: The command and its arguments separated by whitespace
+        :type line: string
+
+        :returns: The reply
+        :rtype: dict
+        '''
+        words = line.split(None, 1)
+        if not words:
+            return {"error": "No command given"}
+        name = words[1].strip() if len(words) > 1 else None
+        with self._condition:
+            if name and words[0] in ["pause", "resume", "enqueue"] and name not in self.channels:
+                self.rescan()
+                if name not in self.channels:
+                    return {"error": "Unknown channel \"{}\"".format(name)}
+            if words[0] == "status":
+                return {"paused": self.paused, "channels": [c.status() for c in sorted(self.channels.values(), key=lambda c: c.nextPoll)]}
+            if words[0] in ["pause", "resume"]:
+                if name:
+                    self.channels[name].paused = words[0] == "pause"
+                else:
+                    self.paused = words[0] == "pause"
+            elif words[0] == "enqueue" and name:
+                self.channels[name].nextPoll = 0
+                self.channels[name].paused = False
+                self.channels[name].enqueued = self.channels[name].running
+            elif words[0] == "stop" and not name:
+                self.stop()
+            else:
+                return {"error": "Invalid command \"{}\"".format(line.strip())}
+            self._condition.notify_all()
+        return {"ok": True}
+
+    def stop(self):
+        '''Stop scheduling channels, the running channels are finished'''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self):
+        '''Archive the due channels until stopped'''
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_initWorker, initargs=(multiprocessing.Value('i', 0),)) as executor:
+            while True:
+                if time.time() - self._lastScan >= RESCAN_INTERVAL:
+                    self.rescan()
+                with self._condition:
+                    if self._stopped and not running:
+                        return
+                    now = time.time()
+                    #Start the most overdue channels
+                    due = sorted([c for c in self.channels.values() if not c.running and not c.paused and c.nextPoll <= now], key=lambda c: c.nextPoll)
+                    if self.paused or self._stopped:
+                        due = []
+                    started = due[:self.jobs - len(running)]
+                    for channel in started:
+                        channel.running = True
+                        future = executor.submit(ytarchiver.archiveChannel, self._args, channel.path)
+                        running[future] = channel
+                        future.add_done_callback(self._wake)
+                    ytametrics.REGISTRY.set("yta_queue_depth", len(due) - len(started), "channels")
+                    #Wait until the next channel is due, a channel finished, or a command arrived
+                    waiting = [c.nextPoll for c in self.channels.values() if not c.running and not c.paused]
+                    timeout = min(waiting + [self._lastScan + RESCAN_INTERVAL]) - now
+                    if not any(f.done() for f in running):
+                        self._condition.wait(max(0, timeout))
+                for future in [f for f in running if f.done()]:
+                    self._finished(running.pop(future), future)
+
+    def _wake(self, _future=None):
+        '''Wake up the scheduler'''
+        with self._condition:
+            self._condition.notify_all()
+
+    def _finished(self, channel, future):
+        '''Print the output of an archived channel and schedule its next poll'''
+        now = int(time.time())
+        try:
+            output, metrics = future.result()
+            ytametrics.REGISTRY.merge(metrics)
+            channel.lastResult = "ok"
+        except (SystemExit, OSError, sqlite3.Error, BrokenExecutor) as e:
+            #A failed channel must not stop the daemon, also if it exited
+            output = "ERROR: {}\n".format(e if not isinstance(e, SystemExit) else "Exited with status {}".format(e.code))
+            channel.lastResult = "error"
+        with self._condition:
+            channel.running = False
+            channel.lastPoll = now
+            channel.interval = pollInterval(os.path.join(channel.path, "archive.db"), now)
+            channel.nextPoll = now if channel.enqueued else now + channel.interval
+            channel.enqueued = False
+        print("\nARCHIVED \'{}\', next poll in {}".format(channel.name, yta.intervalToStr(channel.nextPoll - now)))
+        print(output, end='')
+        sys.stdout.flush()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _initWorker(runningDownloads):
+    '''Initialize a worker process of the daemon, which ignores interrupts so
+    that the running channels are finished when the daemon is stopped
+
+    :param runningDownloads: Counter of the running downloads of all worker processes
+    :type runningDownloads: multiprocessing.Value
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ytarchiver.initWorker(runningDownloads)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class ControlServer(socketserver.ThreadingTCPServer):
+    '''Control interface of the daemon, answers one JSON line per command line'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, archiver):
+        '''Init
+
+        :param address: The address to listen on
+        :type address: tuple
+        :param archiver: The daemon to control
+        :type archiver: ArchiveDaemon
+        '''
+        super().__init__(address, _ControlHandler)
+        self.archiver = archiver
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _ControlHandler(socketserver.StreamRequestHandler):
+    '''Handler of the connections to the control interface'''
+
+    def handle(self):
+        '''Answer the commands of a connection'''
+        for line in self.rfile:
+            reply = self.server.archiver.command(line.decode("UTF-8", "replace"))
+            self.wfile.write((json.dumps(reply) + '\n').encode("UTF-8"))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    try:
+        daemon(sys.argv[1:])
+    except KeyboardInterrupt:
+        print("Aborted!")
+# ########################################################################### #
@@ -6,9 +6,11 @@ import sys
 import argparse
 import subprocess
 import sqlite3
-import requests
 import ytacommon as yta
 
+#Loaded on first use to keep the startup fast
+requests = yta.lazyImport("requests")
+
 # --------------------------------------------------------------------------- #
 def fix(args, parsed=False):
     '''Update artist in database and metadata
@@ -108,7 +110,7 @@ def fixVideo(path, videoID, correctArtist=None, fileArtist=None):
     :rtype: tuple(string, string)
     '''
     #Get title
-    r = requests.get("https://www.youtube.com/oembed?url=http://www.youtube.com/watch?v=" + videoID)
+    r = requests.get(yta.getServiceURL("oembed", "/oembed?url=http://www.youtube.com/watch?v=" + videoID))
     r.raise_for_status()
     d = r.json()
     title = d["title"]
@@ -3,9 +3,11 @@
 
 import sys
 import argparse
-import yt_dlp
 import ytacommon as yta
 
+#Loaded on first use to keep the startup fast
+yt_dlp = yta.lazyImport("yt_dlp")
+
 # --------------------------------------------------------------------------- #
 def main(args):
     '''Main function, print info about the download formats used
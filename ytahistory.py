@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+''' ytahistory - store and query the history of the video statistics '''
+
+import os
+import sys
+import argparse
+import time
+from datetime import datetime, timezone
+import ytacommon as yta
+
+# --------------------------------------------------------------------------- #
+#Compaction policy as list of (age, resolution) in seconds: samples older than
+#age are downsampled to one sample per resolution interval
+COMPACTION_POLICY = [(90 * 86400, 7 * 86400), (730 * 86400, 30 * 86400)]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def history(args):
+    '''Print the statistics history of a video or compact the history
+
+    :param args: The command line arguments given by the user
+    :type args: list
+    '''
+    parser = argparse.ArgumentParser(prog="ytahistory", description="Print or compact the history of the video statistics")
+    parser.add_argument("-c", "--compact", action="store_const", dest="compact", const=True, default=False, help="Downsample old samples to save space")
+    parser.add_argument("-a", "--all", action="store_const", dest="all", const=True, default=False, help="Compact the history of all subdirectories with archive databases (implies -c)")
+    parser.add_argument("--from", action="store", dest="start", help="Only print samples from this date on (YYYY-MM-DD)")
+    parser.add_argument("--to", action="store", dest="end", help="Only print samples up to this date (YYYY-MM-DD)")
+    parser.add_argument("DIR", help="The directory containing the archive database")
+    parser.add_argument("VIDEO", nargs='?', help="The Youtube ID of the video whose history should be printed")
+    args = parser.parse_args(args)
+
+    path = os.path.normpath(os.path.abspath(args.DIR))
+    if args.all:
+        subdirs = [os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name, "archive.db"))]
+        if not subdirs:
+            print("ERROR: No subdirs with archive databases at \'{}\'".format(path))
+            return
+        for subdir in subdirs:
+            print("Compacting \'{}\'".format(os.path.basename(subdir)))
+            _compactArchive(os.path.join(subdir, "archive.db"))
+        return
+
+    dbPath = os.path.join(path, "archive.db")
+    if not os.path.isfile(dbPath):
+        parser.error("DIR must be a directory containing an archive database")
+    if args.compact:
+        _compactArchive(dbPath)
+        return
+    if not args.VIDEO:
+        parser.error("VIDEO must be given if the history is not compacted")
+
+    #Convert dates to timestamps
+    try:
+        start = _dateToTimestamp(args.start) if args.start else None
+        end = _dateToTimestamp(args.end) + 86399 if args.end else None
+    except ValueError:
+        parser.error("Dates must be given in the format YYYY-MM-DD")
+
+    yta.upgradeDatabase(dbPath)
+    dbCon = yta.connectDB(dbPath)
+    r = dbCon.execute("SELECT id FROM videos WHERE youtubeID = ?;", (args.VIDEO,)).fetchone()
+    if not r:
+        print("ERROR: Video \"{}\" not in archive".format(args.VIDEO))
+        yta.closeDB(dbCon)
+        return
+    for sample in query(dbCon, r[0], start, end):
+        dt = datetime.fromtimestamp(sample[0], tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        print("{}  views: {}  likes: {}  dislikes: {}".format(dt, sample[1], sample[2], sample[3]))
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _dateToTimestamp(date):
+    '''Convert a date string (YYYY-MM-DD) to the timestamp of midnight UTC'''
+    return int(datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _compactArchive(dbPath):
+    '''Compact the history of an archive database and print the result'''
+    yta.upgradeDatabase(dbPath)
+    dbCon = yta.connectDB(dbPath)
+    before, after = compact(dbCon)
+    yta.closeDB(dbCon)
+    print("Compacted {} samples to {}".format(before, after))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def encodeSamples(samples, previous=(0, 0, 0, 0)):
+    '''Delta encode samples as zigzag varints
+
+    :param samples: List of samples (timestamp, views, likes, dislikes) ordered by time
+    :type samples: list of tuple
+    :param previous: The sample preceding the first one (Default: all zero)
+    :type previous: tuple, optional
+
+    :returns: The encoded samples
+    :rtype: bytes
+    '''
+    out = bytearray()
+    for sample in samples:
+        for value, last in zip(sample, previous):
+            #Zigzag encode the delta, then write it as varint
+            delta = value - last
+            n = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+            while n > 0x7F:
+                out.append((n & 0x7F) | 0x80)
+                n >>= 7
+            out.append(n)
+        previous = sample
+    return bytes(out)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def decodeSamples(data):
+    '''Decode delta encoded samples
+
+    :param data: The encoded samples
+    :type data: bytes
+
+    :returns: List of samples (timestamp, views, likes, dislikes)
+    :rtype: list of tuple
+    '''
+    values = []
+    n = 0
+    shift = 0
+    for b in data:
+        n |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        values.append((n >> 1) if not n & 1 else -((n + 1) >> 1))
+        n = 0
+        shift = 0
+    samples = []
+    previous = (0, 0, 0, 0)
+    for i in range(0, len(values) - 3, 4):
+        previous = tuple(last + delta for last, delta in zip(previous, values[i:i+4]))
+        samples.append(previous)
+    return samples
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def appendSamples(db, samples):
+    '''Append statistics samples to the history. Samples whose values did not
+    change since the last sample of the video are not stored
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param samples: List of samples (database ID, timestamp, views, likes, dislikes)
+    :type samples: list of tuple
+
+    :raises: :class:``sqlite3.Error: Unable to write to database
+    '''
+    if not samples:
+        return
+    #Read last samples
+    last = {}
+    for i in range(0, len(samples), 500):
+        ids = [sample[0] for sample in samples[i:i+500]]
+        r = db.execute("SELECT videoid,lasttimestamp,lastviewcount,lastlikecount,lastdislikecount FROM statisticshistory WHERE videoid IN ({});".format(','.join('?' * len(ids))), ids)
+        for row in r.fetchall():
+            last[row[0]] = row[1:]
+    inserts = []
+    updates = []
+    for sample in samples:
+        dbID = sample[0]
+        values = tuple(sample[1:])
+        if dbID not in last:
+            inserts.append((dbID, 1) + values + (encodeSamples([values]),))
+        elif values[1:] != last[dbID][1:] and values[0] >= last[dbID][0]:
+            updates.append((encodeSamples([values], last[dbID]),) + values + (dbID,))
+        else:
+            continue
+        last[dbID] = values
+    db.executemany("INSERT INTO statisticshistory(videoid,samples,lasttimestamp,lastviewcount,lastlikecount,lastdislikecount,data) VALUES(?,?,?,?,?,?,?);", inserts)
+    db.executemany("UPDATE statisticshistory SET data = CAST(data || ? AS BLOB), samples = samples + 1, lasttimestamp = ?, lastviewcount = ?, lastlikecount = ?, lastdislikecount = ? WHERE videoid = ?;", updates)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def query(db, videoID, start=None, end=None):
+    '''Return the samples of a video in a time range. As unchanged samples are
+    not stored, the values of a sample are valid until the next one
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param videoID: The database ID of the video
+    :type videoID: integer
+    :param start: Only return samples at or after this timestamp (Default: no limit)
+    :type start: integer, optional
+    :param end: Only return samples at or before this timestamp (Default: no limit)
+    :type end: integer, optional
+
+    :raises: :class:``sqlite3.Error: Unable to read from database
+
+    :returns: List of samples (timestamp, views, likes, dislikes)
+    :rtype: list of tuple
+    '''
+    r = db.execute("SELECT data FROM statisticshistory WHERE videoid = ?;", (videoID,)).fetchone()
+    if not r:
+        return []
+    samples = decodeSamples(r[0])
+    return [s for s in samples if (start is None or s[0] >= start) and (end is None or s[0] <= end)]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def downsample(samples, now, policy=None):
+    '''Downsample samples according to a compaction policy, keeping the last
+    sample of each interval
+
+    :param samples: List of samples (timestamp, views, likes, dislikes) ordered by time
+    :type samples: list of tuple
+    :param now: The current timestamp
+    :type now: integer
+    :param policy: List of (age, resolution) in seconds (Default: COMPACTION_POLICY)
+    :type policy: list of tuple, optional
+
+    :returns: The downsampled list of samples
+    :rtype: list of tuple
+    '''
+    if policy is None:
+        policy = COMPACTION_POLICY
+    policy = sorted(policy, reverse=True)
+    result = []
+    lastBucket = None
+    for sample in samples:
+        age = now - sample[0]
+        resolution = next((res for maxAge, res in policy if age > maxAge), None)
+        #Keep recent samples
+        if resolution is None:
+            result.append(sample)
+            lastBucket = None
+            continue
+        #Replace the previous sample if in the same interval
+        bucket = (resolution, sample[0] // resolution)
+        if bucket == lastBucket:
+            result[-1] = sample
+        else:
+            result.append(sample)
+        lastBucket = bucket
+    return result
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def compact(db, now=None, policy=None):
+    '''Downsample the history of all videos in an archive database
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Connection
+    :param now: The current timestamp (Default: now)
+    :type now: integer, optional
+    :param policy: List of (age, resolution) in seconds (Default: COMPACTION_POLICY)
+    :type policy: list of tuple, optional
+
+    :raises: :class:``sqlite3.Error: Unable to read from or write to database
+
+    :returns: Tuple with the number of samples before and after compaction
+    :rtype: tuple(int, int)
+    '''
+    if now is None:
+        now = int(time.time())
+    before = 0
+    after = 0
+    updates = []
+    r = db.execute("SELECT videoid,samples,data FROM statisticshistory;")
+    for videoID, count, data in r.fetchall():
+        before += count
+        samples = downsample(decodeSamples(data), now, policy)
+        after += len(samples)
+        if len(samples) < count:
+            updates.append((len(samples), encodeSamples(samples), videoID))
+    db.executemany("UPDATE statisticshistory SET samples = ?, data = ? WHERE videoid = ?;", updates)
+    db.commit()
+    if updates:
+        db.execute("VACUUM;")
+    return (before, after)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    try:
+        history(sys.argv[1:])
+    except KeyboardInterrupt:
+        print("Aborted!")
+# ########################################################################### #
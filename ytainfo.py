@@ -4,9 +4,11 @@
 import os
 import sys
 import argparse
-import requests
 import ytacommon as yta
 
+#Loaded on first use to keep the startup fast
+requests = yta.lazyImport("requests")
+
 # --------------------------------------------------------------------------- #
 def addInfo(args):
     '''Add channel info to the archive database
@@ -167,8 +169,14 @@ def createOrConnectDB(path):
     '''
     #Create database
     dbCon = yta.connectDB(path)
-    #Create table
+    #Create tables
     yta.createChannelTable(dbCon)
+    yta.createVideoTable(dbCon)
+    yta.createAPICacheTable(dbCon)
+    yta.createStatisticsHistoryTable(dbCon)
+    yta.createPendingMetadataTable(dbCon)
+    yta.createUnavailableTable(dbCon)
+    yta.createDownloadQueueTable(dbCon)
     #Return database connection
     return dbCon
 # ########################################################################### #
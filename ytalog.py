@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+''' ytalog - route the output of the archiver to per-task log files '''
+
+import os
+import re
+import sys
+import gzip
+import collections
+import shutil
+import threading
+from contextlib import contextmanager
+
+# --------------------------------------------------------------------------- #
+#Number of compressed old logs kept when a log is rotated
+LOG_ROTATE = 5
+#Interval in seconds in which the buffered messages are written to a log file
+WRITE_INTERVAL = 0.5
+#Escape sequences removed from the log files
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def rotate(path, keep=LOG_ROTATE):
+    '''Compress a log file to path.1.gz, shifting older logs to path.2.gz etc.
+
+    :param path: The path of the log file
+    :type path: string
+    :param keep: The number of compressed logs to keep (Default: LOG_ROTATE)
+    :type keep: integer, optional
+
+    :raises: :class:``OSError: Unable to rotate the logs
+    '''
+    if not os.path.isfile(path) or not os.path.getsize(path):
+        return
+    for i in range(keep - 1, 0, -1):
+        old = "{}.{}.gz".format(path, i)
+        if os.path.isfile(old):
+            os.replace(old, "{}.{}.gz".format(path, i + 1))
+    if keep < 1:
+        os.remove(path)
+        return
+    with open(path, 'rb') as src, gzip.open(path + ".1.gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def clean(text):
+    '''Remove escape sequences and the progress updates that were overwritten
+    using carriage returns from the text of a log
+
+    :param text: The text
+    :type text: string
+
+    :returns: The cleaned text
+    :rtype: string
+    '''
+    text = ANSI_ESCAPE.sub('', text)
+    if '\r' not in text:
+        return text
+    return '\n'.join(_lastUpdate(line) if '\r' in line else line for line in text.split('\n'))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _lastUpdate(line):
+    '''Return the last text written over a line using carriage returns'''
+    line = line.rstrip('\r')
+    return line[line.rfind('\r') + 1:]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class LogFile:
+    '''Log file written by a background thread. Messages are only appended to
+    a buffer when written, the buffer is written to the file in batches every
+    WRITE_INTERVAL seconds and the escape sequences are removed from each batch
+    at once
+    '''
+
+    def __init__(self, path):
+        '''Init, rotate an existing log and start the writer thread
+
+        :param path: The path of the log file
+        :type path: string
+
+        :raises: :class:``OSError: Unable to open the log file
+        '''
+        self.path = path
+        try:
+            rotate(path)
+        except OSError as e:
+            print("WARNING: Unable to rotate the log \"{}\": \"{}\"".format(path, e))
+        self._file = open(path, 'w', encoding="UTF-8")
+        #Messages, and events to set once the messages before them are written
+        self._buffer = collections.deque()
+        self._wake = threading.Event()
+        #Start of a line that is not complete yet
+        self._pending = ''
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, msg):
+        '''Buffer a message
+
+        :param msg: The message
+        :type msg: string
+        '''
+        self._buffer.append(msg)
+
+    def flush(self):
+        '''Wait until the buffered messages are written'''
+        done = threading.Event()
+        self._buffer.append(done)
+        self._wake.set()
+        done.wait()
+
+    def close(self):
+        '''Write the buffered messages and close the file'''
+        self._buffer.append(None)
+        self._wake.set()
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        '''Write the buffered messages in batches until closed'''
+        while True:
+            self._wake.wait(WRITE_INTERVAL)
+            self._wake.clear()
+            batch = []
+            try:
+                while True:
+                    batch.append(self._buffer.popleft())
+            except IndexError:
+                pass
+            if not batch:
+                continue
+            text = ''.join(m for m in batch if isinstance(m, str))
+            closing = None in batch
+            self._writeText(text, closing or any(isinstance(m, threading.Event) for m in batch))
+            for m in batch:
+                if isinstance(m, threading.Event):
+                    m.set()
+            if closing:
+                return
+
+    def _writeText(self, text, final):
+        '''Clean and write text, keep an incomplete line until it is complete
+        unless final is set
+        '''
+        text = self._pending + text
+        end = len(text) if final else text.rfind('\n') + 1
+        self._pending = text[end:]
+        #Only the last progress update of an incomplete line is kept
+        if '\r' in self._pending:
+            self._pending = self._pending[self._pending.rfind('\r'):]
+        if end:
+            self._file.write(clean(text[:end]))
+            self._file.flush()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class LogRouter:
+    '''Replacement of stdout and stderr that prints to the terminal and writes
+    to the log file of the task of the current thread. Threads without a task
+    write to the log of the only task, if there is exactly one
+    '''
+
+    def __init__(self, stdout, stderr):
+        '''Init
+
+        :param stdout: The replaced stdout, which is printed to
+        :type stdout: file-like object
+        :param stderr: The replaced stderr
+        :type stderr: file-like object
+        '''
+        self.term = stdout
+        self.stdout = stdout
+        self.stderr = stderr
+        #The logs of the tasks by the ID of their threads
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def write(self, msg):
+        '''Print a message and buffer it for the log of the current task
+
+        :param msg: The message
+        :type msg: string
+        '''
+        self.term.write(msg)
+        log = self.tasks.get(threading.get_ident())
+        if log is None and len(set(self.tasks.values())) == 1:
+            log = next(iter(self.tasks.values()))
+        if log is not None:
+            log.write(msg)
+
+    def flush(self):
+        '''Flush the terminal, the log files are written in the background'''
+        self.term.flush()
+
+    @staticmethod
+    def isatty():
+        '''Answer True to "Is a TTY?" question'''
+        return True
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+#The router of this process while a task is running
+_router = None
+_routerLock = threading.Lock()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def currentTask():
+    '''Return the log of the task of the current thread, to pass it to other threads
+
+    :returns: The log of the task, None if the thread has no task
+    :rtype: LogFile
+    '''
+    router = _router
+    return router.tasks.get(threading.get_ident()) if router else None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@contextmanager
+def bind(log):
+    '''Write the output of the current thread to the log of a task
+
+    :param log: The log of the task as returned by currentTask
+    :type log: LogFile
+    '''
+    router = _router
+    if router is None or log is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with router.lock:
+        previous = router.tasks.get(ident)
+        router.tasks[ident] = log
+    try:
+        yield
+    finally:
+        with router.lock:
+            if previous is None:
+                router.tasks.pop(ident, None)
+            else:
+                router.tasks[ident] = previous
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@contextmanager
+def task(path):
+    '''Print the output of the current thread and write it to a log file.
+    stdout and stderr are replaced while at least one task is running
+
+    :param path: The path of the log file, an existing log is rotated
+    :type path: string
+
+    :raises: :class:``OSError: Unable to open the log file
+    '''
+    global _router
+    log = LogFile(path)
+    with _routerLock:
+        if _router is None:
+            _router = LogRouter(sys.stdout, sys.stderr)
+            sys.stdout = _router
+            sys.stderr = _router
+        router = _router
+    try:
+        with bind(log):
+            yield log
+    finally:
+        log.close()
+        with _routerLock:
+            if not router.tasks:
+                sys.stdout = router.stdout
+                sys.stderr = router.stderr
+                _router = None
+# ########################################################################### #
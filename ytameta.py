@@ -10,12 +10,58 @@ from datetime import datetime
 from xml.etree import ElementTree
 import time
 import json
-import requests
-import pytz
+import hashlib
+import heapq
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import ytacommon as yta
+import ytaquota
+import ytahistory
+import ytametrics
+
+#Loaded on first use to keep the startup fast
+requests = yta.lazyImport("requests")
+pytz = yta.lazyImport("pytz")
+yt_dlp = yta.lazyImport("yt_dlp")
 
 # --------------------------------------------------------------------------- #
-__statisticsdbversion__ = 1
+__statisticsdbversion__ = 2
+#Headers for requests to the Youtube Data API, the API only compresses the
+#response if the user agent contains "gzip"
+API_HEADERS = {"Accept-Encoding": "gzip", "User-Agent": "ytarchiver/{} (gzip)".format(yta.__version__)}
+#Fields needed by the metadata lookup and the statistics update
+METADATA_FIELDS = "items(id,snippet(publishedAt,description,tags),contentDetails(duration),statistics(viewCount,likeCount,dislikeCount),liveStreamingDetails(actualStartTime))"
+STATISTICS_FIELDS = "etag,items(id,etag,snippet(title,description),contentDetails(caption),statistics(viewCount,likeCount,dislikeCount))"
+#Max age of cached ETags of request batches in seconds
+CACHE_MAX_AGE = 30 * 86400
+#Refresh interval for the statistics of new and old videos in seconds and the
+#time constant in seconds of the exponential decay between the two
+REFRESH_INTERVAL_NEW = 86400
+REFRESH_INTERVAL_OLD = 60 * 86400
+REFRESH_DECAY = 180 * 86400
+#Share of the videos updated per run that are selected in order of their
+#database ID starting at the cursor of the channel instead of by priority, so
+#that all videos are covered over consecutive runs
+SWEEP_SHARE = 0.1
+#Max number of concurrent caption downloads, number of retries of failed
+#downloads, delay in seconds before the first retry, and number of captions
+#written to the database at once
+CAPTION_WORKERS = 4
+CAPTION_RETRIES = 2
+CAPTION_RETRY_DELAY = 1
+CAPTION_BATCH = 50
+#Max number of metadata requests at once per archive, and max number of
+#archives whose metadata is loaded at once
+METADATA_WORKERS = 4
+METADATA_CHANNELS = 4
+#Sources of the statistics update, max number of concurrent extractions and
+#number of videos read from the archive at once when extracting the statistics
+#with yt-dlp, and the yt-dlp options that skip everything not needed for them
+STATISTICS_SOURCES = ["auto", "api", "ytdlp"]
+YTDLP_WORKERS = 4
+YTDLP_BATCH = 50
+YTDLP_OPTIONS = {"quiet": True, "no_warnings": True, "skip_download": True, "call_home": False, "cachedir": False, "extractor_args": {"youtube": {"skip": ["dash", "hls", "translated_subs"], "player_skip": ["js"]}}}
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -27,46 +73,219 @@ def addMetadata(args):
     '''
     #Get database path
     parser = argparse.ArgumentParser(prog="ytameta", description="Add additional metadata to existing archive databases")
+    parser.add_argument("-a", "--all", action="store_const", dest="all", const=True, default=False, help="Add the metadata to all subdirectories with archive databases, several at once")
+    parser.add_argument("-b", "--backfill", action="store_const", dest="backfill", const=True, default=False, help="Only load the metadata of the videos that were queued because the API was not available when archiving them")
     parser.add_argument("DIR", help="The directory containing the archive database to work on")
     args = parser.parse_args(args)
 
     path = os.path.normpath(os.path.abspath(args.DIR))
-    dbPath = os.path.join(path, "archive.db")
-    if not os.path.isdir(path) or not os.path.isfile(dbPath):
-        parser.error("DIR must be a directory containing an archive database")
+    if args.all:
+        dbPaths = [os.path.join(path, name, "archive.db") for name in sorted(os.listdir(path))]
+        dbPaths = [dbPath for dbPath in dbPaths if os.path.isfile(dbPath)]
+        if not dbPaths:
+            print("ERROR: No subdirs with archive databases at \'{}\'".format(path))
+            return
+    else:
+        dbPath = os.path.join(path, "archive.db")
+        if not os.path.isdir(path) or not os.path.isfile(dbPath):
+            parser.error("DIR must be a directory containing an archive database")
+        dbPaths = [dbPath]
 
-    #Check if database needs upgrade
-    yta.upgradeDatabase(dbPath)
+    #Check if databases need upgrade
+    for dbPath in dbPaths:
+        yta.upgradeDatabase(dbPath)
 
-    #Connect to database
+    #Get API keys, shared by all channels
+    keys = ytaquota.KeyPool()
+    if not keys:
+        print("ERROR: Unable to load metadata as no API key is available")
+        return
+    if len(dbPaths) == 1:
+        _addChannelMetadata(dbPaths[0], keys, args.backfill)
+        return
+    #Process several channels at once
+    with ThreadPoolExecutor(max_workers=METADATA_CHANNELS) as executor:
+        futures = [executor.submit(_addChannelMetadata, dbPath, keys, args.backfill, os.path.basename(os.path.dirname(dbPath))) for dbPath in dbPaths]
+        for future in futures:
+            future.result()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _addChannelMetadata(dbPath, keys, backfill, name=None):
+    '''Add the metadata to one archive database
+
+    :param dbPath: The path of the archive database
+    :type dbPath: string
+    :param keys: The API keys to use
+    :type keys: ytaquota.KeyPool
+    :param backfill: Whether to only load the metadata of the queued videos
+    :type backfill: boolean
+    :param name: The channel/subdir name printed before starting (Default: print nothing)
+    :type name: string, optional
+    '''
+    if name:
+        print("Loading metadata of \"{}\"".format(name))
     dbCon = yta.connectDB(dbPath)
     db = dbCon.cursor()
-    #Save thumbnails to database
+    try:
+        if backfill:
+            backfillMetadata(db, keys)
+        else:
+            loadMetadata(db, keys)
+    finally:
+        yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def loadMetadata(db, keys=None, workers=METADATA_WORKERS):
+    '''Load the upload timestamp, duration, and tags of all videos in an
+    archive database with one request per 50 videos and several requests at once
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param keys: The API keys to use (Default: all keys from the config)
+    :type keys: ytaquota.KeyPool, optional
+    :param workers: Max number of requests at once (Default: METADATA_WORKERS)
+    :type workers: integer, optional
+
+    :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
+
+    :returns: The number of updated videos
+    :rtype: integer
+    '''
+    #Get API keys
+    if keys is None:
+        keys = ytaquota.KeyPool()
+    if not keys:
+        raise yta.NoAPIKeyError
     r = db.execute("SELECT youtubeID FROM videos;")
-    for item in r.fetchall():
-        #Get video filepath
-        youtubeID = item[0]
+    ids = [row[0] for row in r.fetchall()]
+    updated = 0
+    stopped = False
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        batches = [ids[n:n+ytaquota.VIDEOS_PER_REQUEST] for n in range(0, len(ids), ytaquota.VIDEOS_PER_REQUEST)]
+        futures = {executor.submit(getMetadataBatch, batch, keys): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                metadata = future.result()
+            except yta.QuotaExceededError:
+                #Stop sending requests, but keep the results received so far
+                if not stopped:
+                    print("WARNING: API quota exceeded, metadata update stopped early")
+                    stopped = True
+                    for f in futures:
+                        f.cancel()
+                continue
+            except requests.exceptions.RequestException:
+                print("ERROR: Unable to load metadata for {}".format(", ".join(batch)))
+                continue
+            for youtubeID in batch:
+                if youtubeID not in metadata:
+                    print("WARNING: No metadata available for " + youtubeID)
+            #Write the results of the batch at once
+            rows = [(m[0], m[1], m[2], youtubeID) for youtubeID, m in metadata.items()]
+            db.executemany("UPDATE videos SET timestamp = ?, duration = ?, tags = ? WHERE youtubeID = ?", rows)
+            updated += len(rows)
+    return updated
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def queueMetadata(db, youtubeID):
+    '''Queue a video whose metadata could not be loaded for the backfill
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param youtubeID: The Youtube ID
+    :type youtubeID: string
+
+    :raises: :class:``sqlite3.Error: Unable to write to database
+    '''
+    db.execute("INSERT OR IGNORE INTO pending_metadata(youtubeID,added) VALUES(?,?);", (youtubeID, int(time.time())))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def backfillMetadata(db, keys=None):
+    '''Load the metadata of the queued videos in batches of 50 videos until
+    the queue is empty or the API quota is exhausted
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param keys: The API keys to use (Default: all keys from the config)
+    :type keys: ytaquota.KeyPool, optional
+
+    :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
+
+    :returns: The number of videos left in the queue
+    :rtype: integer
+    '''
+    r = db.execute("SELECT youtubeID FROM pending_metadata ORDER BY added, youtubeID;")
+    pending = [row[0] for row in r.fetchall()]
+    if not pending:
+        return 0
+    #Get API keys
+    if keys is None:
+        keys = ytaquota.KeyPool()
+    if not keys:
+        raise yta.NoAPIKeyError
+    print("Loading metadata of {} queued videos".format(len(pending)))
+    for n in range(0, len(pending), ytaquota.VIDEOS_PER_REQUEST):
+        batch = pending[n:n+ytaquota.VIDEOS_PER_REQUEST]
         try:
-            [timestamp, duration, tags, _, _, _, _, _] = getMetadata(youtubeID)
-            db.execute("UPDATE videos SET timestamp = ?, duration = ?, tags = ? WHERE youtubeID = ?", (timestamp, duration, tags, youtubeID))
-        except yta.NoAPIKeyError:
+            metadata = getMetadataBatch(batch, keys)
+        except yta.QuotaExceededError:
+            print("WARNING: API quota exceeded, metadata backfill stopped early")
             break
-        except requests.exceptions.RequestException:
-            print("ERROR: Unable to load metadata for {}".format(youtubeID))
-            continue
-    #Close database
-    yta.closeDB(dbCon)
+        except requests.exceptions.RequestException as e:
+            db.executemany("UPDATE pending_metadata SET attempts = attempts + 1, lastattempt = ? WHERE youtubeID = ?;", [(int(time.time()), i) for i in batch])
+            print("ERROR: Network error while trying to load the metadata (\"{}\")".format(e))
+            break
+        placeholders = ','.join('?' * len(batch))
+        r = db.execute("SELECT youtubeID,id FROM videos WHERE youtubeID IN ({});".format(placeholders), batch)
+        dbIDs = dict(r.fetchall())
+        updates = []
+        descUpdates = []
+        samples = []
+        for youtubeID in batch:
+            if youtubeID not in metadata:
+                #Deleted or private videos will never have metadata
+                print("WARNING: No metadata available for " + youtubeID)
+                continue
+            if youtubeID not in dbIDs:
+                continue
+            [timestamp, duration, tags, description, viewCount, likeCount, dislikeCount, statisticsUpdated] = metadata[youtubeID]
+            date = datetime.fromtimestamp(timestamp, tz=pytz.utc).strftime("%Y-%m-%d")
+            row = (timestamp, date, duration, tags, viewCount, likeCount, dislikeCount, statisticsUpdated or 0)
+            #Replace the description and its chapters only if one was returned
+            if description:
+                descUpdates.append(row + (description, yta.extractChapters(description), dbIDs[youtubeID]))
+            else:
+                updates.append(row + (dbIDs[youtubeID],))
+            #Missing like and dislike counts are stored as zero in the history, as in updateStatistics
+            if statisticsUpdated and isinstance(viewCount, int):
+                samples.append((dbIDs[youtubeID], statisticsUpdated, viewCount, likeCount or 0, dislikeCount or 0))
+        cmd = "UPDATE videos SET timestamp = ?, date = ?, duration = ?, tags = ?, viewcount = ?, likecount = ?, dislikecount = ?, statisticsupdated = ?"
+        db.executemany(cmd + " WHERE id = ?;", updates)
+        db.executemany(cmd + ", description = ?, chapters = ? WHERE id = ?;", descUpdates)
+        ytahistory.appendSamples(db, samples)
+        db.executemany("DELETE FROM pending_metadata WHERE youtubeID = ?;", [(i,) for i in batch])
+    return db.execute("SELECT count(*) FROM pending_metadata;").fetchone()[0]
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def getMetadata(youtubeID):
+def getMetadata(youtubeID, keys=None):
     '''Calls the Youtube Data API to get the video duration, upload timestamp
     and tags
 
     :param youtubeID: The Youtube ID
     :type youtubeID: string
+    :param keys: The API keys to use (Default: all keys from the config)
+    :type keys: ytaquota.KeyPool, optional
 
     :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
+    :raises: :class:``ytacommon.QuotaExceededError: The API quota of all keys is exhausted
     :raises: :class:``requests.exceptions.RequestException: Unable to get metadata
 
     :returns: List with timestamp (int) at index 0, duration (int) at index 1,
@@ -76,48 +295,80 @@ def getMetadata(youtubeID):
         at index 7. The timestamp is None, if one or more of the other statistics items is None
     :rtype: list
     '''
-    #Get API key
-    apiKey = yta.getAPIKey()
-    if not apiKey:
-        raise yta.NoAPIKeyError
-    #Get metadata
-    url = "https://www.googleapis.com/youtube/v3/videos?part=contentDetails%2Csnippet%2Cstatistics%2CliveStreamingDetails&id={}&key={}".format(youtubeID, apiKey)
-    r = requests.get(url)
-    r.raise_for_status()
-    d = r.json()
+    r = getMetadataBatch([youtubeID], keys)
     #Check if empty
-    if not d["items"]:
+    if youtubeID not in r:
         print("WARNING: No metadata available for " + youtubeID)
         return [None, None, None, None, None, None, None, None]
+    return r[youtubeID]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getMetadataBatch(youtubeIDs, keys=None):
+    '''Calls the Youtube Data API to get the metadata of multiple videos with
+    one request per 50 videos
+
+    :param youtubeIDs: The Youtube IDs
+    :type youtubeIDs: list of string
+    :param keys: The API keys to use (Default: all keys from the config)
+    :type keys: ytaquota.KeyPool, optional
+
+    :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
+    :raises: :class:``ytacommon.QuotaExceededError: The API quota of all keys is exhausted
+    :raises: :class:``requests.exceptions.RequestException: Unable to get metadata
+
+    :returns: Dictionary with the Youtube IDs as keys and lists as returned by
+        getMetadata as values. Videos without metadata are missing
+    :rtype: dict
+    '''
+    #Get API keys
+    if keys is None:
+        keys = ytaquota.KeyPool()
+    if not keys:
+        raise yta.NoAPIKeyError
+    metadata = {}
+    for n in range(0, len(youtubeIDs), ytaquota.VIDEOS_PER_REQUEST):
+        #Get metadata
+        params = {"part": "contentDetails,snippet,statistics,liveStreamingDetails", "id": ','.join(youtubeIDs[n:n+ytaquota.VIDEOS_PER_REQUEST]), "fields": METADATA_FIELDS}
+        r = requestAPI(keys, "videos.metadata", params)
+        for item in r.json()["items"]:
+            metadata[item["id"]] = _parseMetadata(item)
+    return metadata
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _parseMetadata(item):
+    '''Convert a video resource of the Youtube Data API to the list returned
+    by getMetadata'''
     #Convert update time to timestamp
-    if "liveStreamingDetails" in d["items"][0] and "actualStartTime" in d["items"][0]["liveStreamingDetails"]:
-        dtString = d["items"][0]["liveStreamingDetails"]["actualStartTime"]
+    if "liveStreamingDetails" in item and "actualStartTime" in item["liveStreamingDetails"]:
+        dtString = item["liveStreamingDetails"]["actualStartTime"]
     else:
-        dtString = d["items"][0]["snippet"]["publishedAt"]
+        dtString = item["snippet"]["publishedAt"]
     try:
         timestamp = int(datetime.timestamp(datetime.strptime(dtString, "%Y-%m-%dT%H:%M:%S.%f%z")))
     except ValueError:
         timestamp = int(datetime.timestamp(datetime.strptime(dtString, "%Y-%m-%dT%H:%M:%S%z")))
     #Get description
-    description = d["items"][0]["snippet"]["description"]
+    description = item["snippet"]["description"]
     #Convert duration to seconds
-    duration = yta.convertDuration(d["items"][0]["contentDetails"]["duration"])
+    duration = yta.convertDuration(item["contentDetails"]["duration"])
     #Extract tags
-    if "tags" in d["items"][0]["snippet"]:
-        tags = '\n'.join([i.lower() for i in d["items"][0]["snippet"]["tags"]])
+    if "tags" in item["snippet"]:
+        tags = '\n'.join([i.lower() for i in item["snippet"]["tags"]])
     else:
         tags = None
     #Extract statistics
     try:
-        viewCount = yta.toInt(d["items"][0]["statistics"]["viewCount"])
+        viewCount = yta.toInt(item["statistics"]["viewCount"])
     except KeyError:
         viewCount = None
     try:
-        likeCount = yta.toInt(d["items"][0]["statistics"]["likeCount"])
+        likeCount = yta.toInt(item["statistics"]["likeCount"])
     except KeyError:
         likeCount = None
     try:
-        dislikeCount = yta.toInt(d["items"][0]["statistics"]["dislikeCount"])
+        dislikeCount = yta.toInt(item["statistics"]["dislikeCount"])
     except KeyError:
         dislikeCount = None
     if isinstance(viewCount, int) or isinstance(likeCount, int):
@@ -129,7 +380,7 @@ def getMetadata(youtubeID):
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def updateStatistics(db, youngerTimestamp=sys.maxsize, checkCaptions=False, count=sys.maxsize, apiKey=None, amendCaptions=False):
+def updateStatistics(db, youngerTimestamp=sys.maxsize, checkCaptions=False, count=sys.maxsize, apiKey=None, amendCaptions=False, cursor=None, source="api"):
     '''Update the video statistics in an archive database
 
     :param db: Connection to the archive database
@@ -140,96 +391,66 @@ def updateStatistics(db, youngerTimestamp=sys.maxsize, checkCaptions=False, coun
     :type checkCaptions: boolean, option
     :param count: Max number of videos to update (Default: max 64-bit int)
     :type count: integer, optional
-    :param apiKey: The API-Key for the Youtube-API (if not given, it will be read from file)
-    :type apiKey: string, optional
+    :param apiKey: The API-Key or the pool of API keys for the Youtube-API (if not given, all keys will be read from file)
+    :type apiKey: string or ytaquota.KeyPool, optional
     :param amendCaptions: Whether to download the captions that were added since the video was archived
     :type amendCaptions: boolean, optional
+    :param cursor: The cursor returned by the previous update of the archive (Default: select videos only by priority)
+    :type cursor: integer, optional
+    :param source: Where to get the statistics from, one of STATISTICS_SOURCES: "api" for the Youtube Data API, "ytdlp" for
+        the yt-dlp extractor, or "auto" for the API with yt-dlp as fallback if no key or quota is available (Default: "api")
+    :type source: string, optional
 
     :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
     :raises: :class:``requests.exceptions.RequestException: Unable to connect to API endpoint
 
-    :returns: Tuple with what is left of maxCount (int), whether the update was complete (bool)
+    :returns: Tuple with what is left of maxCount (int, zero if the API quota was exceeded), whether the update was complete (bool),
+        and the cursor for the next update (int, None if no cursor was given)
     :rtype: Tuple
     '''
-    #Get API key
-    if not apiKey:
-        apiKey = yta.getAPIKey()
-    if not apiKey:
-        raise yta.NoAPIKeyError
+    #Get API keys, fall back to yt-dlp if none are available
+    keys = None
+    if source != "ytdlp":
+        keys = apiKey if isinstance(apiKey, ytaquota.KeyPool) else ytaquota.KeyPool([apiKey] if apiKey else None)
+        if not keys:
+            if source == "api":
+                raise yta.NoAPIKeyError
+            source = "ytdlp"
     #Check captions
     checkCaptions = True if amendCaptions else checkCaptions
-    #Loop through videos
-    requestLimit = 50
-    offset = 0
-    completed = False
+    #Remove cached batch ETags that are unlikely to be requested again
+    db.execute("DELETE FROM apicache WHERE part = ? AND checked < ?;", ("batch", int(time.time()) - CACHE_MAX_AGE))
+    #Select the videos to update ordered by priority
+    startCursor = cursor
+    schedule, completed, cursor = scheduleStatistics(db, count, youngerTimestamp, cursor=cursor)
+    count -= len(schedule)
+    #Request the statistics
     items = []
-    while True:
-        #Check if max videos count reached zero
-        if count <= 0:
-            #Check if videos missing
-            r = db.execute("SELECT id FROM videos WHERE statisticsupdated < ? ORDER BY id LIMIT 1;", (youngerTimestamp))
-            #If videos missing exist loop without setting complete to true
-            if r.fetchone():
-                break
-            #If no videos missing exist loop after setting complete to true
-            completed = True
-            break
-        #Update request limit if smaller than max count
-        if requestLimit > count:
-            requestLimit = count
-        #Select videos
-        r = db.execute("SELECT id,youtubeID,title,description,subtitles,oldtitles,olddescriptions,language FROM videos ORDER BY id LIMIT ? OFFSET ?;", (requestLimit, offset))
-        videos = r.fetchall()
-        #If no more videos exit look
-        if not videos:
-            completed = True
-            break
-        #Create result dict and ids list
-        ids = []
-        vids = {}
-        for video in videos:
-            ids.append(video[1])
-            try:
-                oldtitles = json.loads(video[5])
-            except TypeError:
-                oldtitles = []
-            try:
-                olddescs = json.loads(video[6])
-            except TypeError:
-                olddescs = []
-            try:
-                subtitles = len(video[4]) > 0
-            except TypeError:
-                subtitles = False
-            vids[video[1]] = [video[0], video[2], video[3], subtitles, oldtitles, olddescs, video[7]] #database ID, title, desc, subtitles, oldtitles, olddescriptions, language
-        #Update offset and count
-        offset += requestLimit
-        count -= requestLimit
-        #Get metadata
-        url = "https://www.googleapis.com/youtube/v3/videos?part=contentDetails%2Csnippet%2Cstatistics&id={}&key={}".format(','.join(ids), apiKey)
-        r = requests.get(url)
-        r.raise_for_status()
-        d = r.json()
-        if not d["items"]:
-            continue
-        #Add request time to items
-        requestTime = int(time.time())
-        for i in d["items"]:
-            i["requestTime"] = requestTime
-            i["dbid"] = vids[i["id"]][0]
-            i["currenttitle"] = vids[i["id"]][1]
-            i["currentdesc"] = vids[i["id"]][2]
-            i["subtitles"] = vids[i["id"]][3]
-            i["oldtitles"] = vids[i["id"]][4]
-            i["olddescs"] = vids[i["id"]][5]
-            i["language"] = vids[i["id"]][6]
-        #Add items to list
-        items += d["items"]
-
-    #Loop through items
+    unchanged = []
+    etags = []
+    if source != "ytdlp":
+        items, unchanged, etags, schedule = _fetchStatisticsAPI(db, schedule, keys, checkCaptions)
+        if schedule and source == "api":
+            #Stop requesting, but still apply the items received so far
+            print("WARNING: API quota exceeded, statistics update stopped early")
+            count = 0
+            completed = False
+            schedule = []
+            #Swept videos may not have been updated, sweep them again next time
+            cursor = startCursor
+        elif schedule:
+            print("WARNING: API quota exceeded, updating the statistics of the remaining {} videos with yt-dlp".format(len(schedule)))
+    if schedule:
+        received = _fetchStatisticsYTDLP(db, schedule, checkCaptions)
+        items += received[0]
+        unchanged += received[1]
+        etags += received[2]
+
+    #Loop through items and group the updates by the changed columns
+    samples = []
+    missingCaptions = []
+    updates = {}
     for item in items:
-        cmd = []
-        i = []
         try:
             viewCount = yta.toInt(item["statistics"]["viewCount"])
         except KeyError:
@@ -242,21 +463,28 @@ def updateStatistics(db, youngerTimestamp=sys.maxsize, checkCaptions=False, coun
             dislikeCount = yta.toInt(item["statistics"]["dislikeCount"])
         except KeyError:
             dislikeCount = 0
-        if isinstance(viewCount, int) and isinstance(likeCount, int) and isinstance(dislikeCount, int):
-            cmd.append("viewcount = ?, likecount = ?, dislikecount = ?, statisticsupdated = ?")
-            i += [viewCount, likeCount, dislikeCount, item["requestTime"]]
+        valid = isinstance(viewCount, int) and isinstance(likeCount, int) and isinstance(dislikeCount, int)
+        statistics = False
+        title = False
+        desc = False
+        i = []
+        if valid:
+            samples.append((item["dbid"], item["requestTime"], viewCount, likeCount, dislikeCount))
+            if (viewCount, likeCount, dislikeCount) != item["currentstatistics"]:
+                statistics = True
+                i += [viewCount, likeCount, dislikeCount]
         #Compare title and desc
         try:
             if item["snippet"]["title"] and item["snippet"]["title"] != item["currenttitle"]:
                 item["oldtitles"].append({"timestamp":item["requestTime"],"title":item["currenttitle"]})
-                cmd.append("title = ?, oldtitles = ?")
+                title = True
                 i += [item["snippet"]["title"], json.dumps(item["oldtitles"], ensure_ascii=False)]
         except KeyError:
             pass
         try:
             if item["snippet"]["description"] and item["snippet"]["description"] != item["currentdesc"]:
                 item["olddescs"].append({"timestamp":item["requestTime"],"description":item["currentdesc"]})
-                cmd.append("description = ?, olddescriptions = ?")
+                desc = True
                 i += [item["snippet"]["description"], json.dumps(item["olddescs"], ensure_ascii=False)]
         except KeyError:
             pass
@@ -265,22 +493,384 @@ def updateStatistics(db, youngerTimestamp=sys.maxsize, checkCaptions=False, coun
         if checkCaptions and captions != item["subtitles"]:
             if captions:
                 if amendCaptions:
-                    amendCaption(db,item["dbid"], item["id"], item["language"])
+                    missingCaptions.append((item["dbid"], item["id"], item["language"]))
                 else:
                     print("INFO: Video [{}] \"{}\" had captions added since archiving".format(item["id"], item["snippet"]["title"]))
             else:
                 print("INFO: Video [{}] \"{}\" had captions removed since archiving".format(item["id"], item["snippet"]["title"]))
-        #Update database
-        if cmd:
-            update = "UPDATE videos SET " + ", ".join(cmd) + " WHERE id = ?"
-            i.append(item["dbid"])
-            db.execute(update, tuple(i))
+        #Skip items without changes, only their update timestamp is written
+        if not statistics and not title and not desc:
+            if valid:
+                unchanged.append((item["requestTime"], item["dbid"]))
+            continue
+        if valid:
+            i.append(item["requestTime"])
+        i.append(item["dbid"])
+        updates.setdefault((statistics, title, desc, valid), []).append(tuple(i))
+
+    #Only update the timestamp of unchanged items
+    db.executemany("UPDATE videos SET statisticsupdated = ? WHERE id = ?;", unchanged)
+    #Update the changed items with one statement per combination of changed columns
+    for shape, rows in updates.items():
+        cmd = [c for c, changed in zip(["viewcount = ?, likecount = ?, dislikecount = ?", "title = ?, oldtitles = ?", "description = ?, olddescriptions = ?", "statisticsupdated = ?"], shape) if changed]
+        db.executemany("UPDATE videos SET " + ", ".join(cmd) + " WHERE id = ?;", rows)
+    #Add statistics to history
+    ytahistory.appendSamples(db, samples)
+    #Save ETags
+    db.executemany("INSERT OR REPLACE INTO apicache(key,part,etag,checked) VALUES(?,?,?,?);", etags)
+    #Download the captions that were added since archiving
+    amendMissingCaptions(db, missingCaptions)
     #Return status
-    return (count, completed)
+    return (count, completed, cursor)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _fetchStatisticsAPI(db, schedule, keys, checkCaptions):
+    '''Request the statistics of the scheduled videos from the Youtube Data API
+    in batches, using conditional requests with the cached ETags
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param schedule: The database IDs of the videos to update
+    :type schedule: list of integer
+    :param keys: The API keys to use
+    :type keys: ytaquota.KeyPool
+    :param checkCaptions: Whether the captions are checked, in which case the cached ETags are ignored
+    :type checkCaptions: boolean
+
+    :raises: :class:``requests.exceptions.RequestException: Unable to connect to API endpoint
+
+    :returns: Tuple with the list of changed items, the list of unchanged videos (request time, database ID),
+        the list of ETags to cache, and the database IDs of the videos that were not requested as the quota was exceeded
+    :rtype: tuple
+    '''
+    items = []
+    unchanged = []
+    etags = []
+    requestLimit = 50
+    for n in range(0, len(schedule), requestLimit):
+        #Select videos
+        batch = schedule[n:n+requestLimit]
+        vids = _readScheduledVideos(db, batch)
+        ids = list(vids)
+        #Read cached ETags, ignore them when checking the captions as those depend on the archive as well
+        batchKey = hashlib.sha1(','.join(ids).encode("UTF-8")).hexdigest()
+        headers = dict(API_HEADERS)
+        cached = {}
+        if not checkCaptions:
+            cached = _readETags(db, ids, "statistics")
+            batchETag = _readETags(db, [batchKey], "batch").get(batchKey)
+            if batchETag:
+                headers["If-None-Match"] = batchETag
+        #Get metadata
+        params = {"part": "contentDetails,snippet,statistics", "id": ','.join(ids), "fields": STATISTICS_FIELDS}
+        try:
+            r = requestAPI(keys, "videos.statistics", params, headers)
+        except yta.QuotaExceededError:
+            return (items, unchanged, etags, schedule[n:])
+        requestTime = int(time.time())
+        #Nothing changed since the last request for the same batch
+        if r.status_code == 304:
+            unchanged += [(requestTime, vids[i][0]) for i in ids if i in cached]
+            etags += [(i, "statistics", cached[i], requestTime) for i in ids if i in cached]
+            etags.append((batchKey, "batch", batchETag, requestTime))
+            continue
+        d = r.json()
+        if "etag" in d:
+            etags.append((batchKey, "batch", d["etag"], requestTime))
+        #Skip items that did not change since they were last requested
+        changed = []
+        for i in d["items"]:
+            etags.append((i["id"], "statistics", i["etag"], requestTime))
+            i["requestTime"] = requestTime
+            if cached.get(i["id"]) == i["etag"]:
+                unchanged.append((requestTime, vids[i["id"]][0]))
+            else:
+                changed.append(i)
+        items += _addCurrentValues(db, changed, vids)
+    return (items, unchanged, etags, [])
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _fetchStatisticsYTDLP(db, schedule, checkCaptions, workers=YTDLP_WORKERS):
+    '''Extract the statistics of the scheduled videos with yt-dlp, with one
+    extractor per worker. A hash of the extracted values is cached like the
+    ETags of the API, so that only changed videos are compared to the archive
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param schedule: The database IDs of the videos to update
+    :type schedule: list of integer
+    :param checkCaptions: Whether the captions are checked, in which case the cached hashes are ignored
+    :type checkCaptions: boolean
+    :param workers: Max number of concurrent extractions (Default: YTDLP_WORKERS)
+    :type workers: integer, optional
+
+    :returns: Tuple with the list of changed items, the list of unchanged videos (request time, database ID),
+        and the list of hashes to cache
+    :rtype: tuple
+    '''
+    items = []
+    unchanged = []
+    etags = []
+    failed = 0
+    local = threading.local()
+    extractors = []
+    lock = threading.Lock()
+    def extract(youtubeID):
+        #Each worker thread uses its own extractor as YoutubeDL is not thread-safe
+        if not hasattr(local, "ytdl"):
+            local.ytdl = yt_dlp.YoutubeDL(YTDLP_OPTIONS)
+            with lock:
+                extractors.append(local.ytdl)
+        return extractStatistics(local.ytdl, youtubeID)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for n in range(0, len(schedule), YTDLP_BATCH):
+            vids = _readScheduledVideos(db, schedule[n:n+YTDLP_BATCH])
+            ids = list(vids)
+            cached = {} if checkCaptions else _readETags(db, ids, "ytdlp")
+            changed = []
+            for youtubeID, item in zip(ids, executor.map(extract, ids)):
+                if not item:
+                    failed += 1
+                    continue
+                requestTime = int(time.time())
+                item["requestTime"] = requestTime
+                etag = hashlib.sha1(json.dumps(item["statistics"], sort_keys=True).encode("UTF-8") + json.dumps(item["snippet"], sort_keys=True).encode("UTF-8")).hexdigest()
+                etags.append((youtubeID, "ytdlp", etag, requestTime))
+                if cached.get(youtubeID) == etag:
+                    unchanged.append((requestTime, vids[youtubeID][0]))
+                else:
+                    changed.append(item)
+            items += _addCurrentValues(db, changed, vids)
+    for ytdl in extractors:
+        ytdl.close()
+    if failed:
+        print("WARNING: Unable to extract the statistics of {} videos with yt-dlp".format(failed))
+    return (items, unchanged, etags)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def extractStatistics(ytdl, youtubeID):
+    '''Extract the statistics of a video with yt-dlp without processing the
+    formats. The result has the same structure as an item of the statistics
+    request to the Youtube Data API
+
+    :param ytdl: The yt-dlp instance to extract with
+    :type ytdl: yt_dlp.YoutubeDL
+    :param youtubeID: The Youtube ID of the video
+    :type youtubeID: string
+
+    :returns: Dictionary with the id, snippet, contentDetails, and statistics, None if the extraction failed
+    :rtype: dict
+    '''
+    try:
+        info = ytdl.extract_info("https://www.youtube.com/watch?v=" + youtubeID, download=False, process=False)
+    except yt_dlp.utils.DownloadError:
+        return None
+    if not info:
+        return None
+    statistics = {}
+    if info.get("view_count") is not None:
+        statistics["viewCount"] = str(info["view_count"])
+    if info.get("like_count") is not None:
+        statistics["likeCount"] = str(info["like_count"])
+    captions = [lang for lang in (info.get("subtitles") or {}) if lang != "live_chat"]
+    return {"id": youtubeID, "snippet": {"title": info.get("title"), "description": info.get("description")}, "contentDetails": {"caption": "true" if captions else "false"}, "statistics": statistics}
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=False):
+def _readScheduledVideos(db, batch):
+    '''Read the Youtube IDs, subtitle state, and language of scheduled videos
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param batch: The database IDs of the videos
+    :type batch: list of integer
+
+    :returns: Dictionary with the Youtube IDs as keys and lists (database ID, subtitles, language) as values, ordered by the database ID
+    :rtype: dict
+    '''
+    placeholders = ','.join('?' * len(batch))
+    r = db.execute("SELECT id,youtubeID,length(subtitles) > 0,language FROM videos WHERE id IN ({}) ORDER BY id;".format(placeholders), batch)
+    return {video[1]: [video[0], bool(video[2]), video[3]] for video in r.fetchall()}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _addCurrentValues(db, changed, vids):
+    '''Add the archived title, description, and statistics to changed items
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param changed: The changed items
+    :type changed: list of dict
+    :param vids: The scheduled videos as returned by _readScheduledVideos
+    :type vids: dict
+
+    :returns: The changed items
+    :rtype: list of dict
+    '''
+    if not changed:
+        return []
+    #Read current title and description of the changed items
+    placeholders = ','.join('?' * len(changed))
+    r = db.execute("SELECT id,title,description,oldtitles,olddescriptions,viewcount,likecount,dislikecount FROM videos WHERE id IN ({});".format(placeholders), [vids[i["id"]][0] for i in changed])
+    current = {video[0]: video[1:] for video in r.fetchall()}
+    for i in changed:
+        dbid = vids[i["id"]][0]
+        try:
+            oldtitles = json.loads(current[dbid][2])
+        except TypeError:
+            oldtitles = []
+        try:
+            olddescs = json.loads(current[dbid][3])
+        except TypeError:
+            olddescs = []
+        i["dbid"] = dbid
+        i["currenttitle"] = current[dbid][0]
+        i["currentdesc"] = current[dbid][1]
+        i["subtitles"] = vids[i["id"]][1]
+        i["oldtitles"] = oldtitles
+        i["olddescs"] = olddescs
+        i["language"] = vids[i["id"]][2]
+        i["currentstatistics"] = tuple(current[dbid][4:7])
+    return changed
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def requestAPI(keys, endpoint, params, headers=None):
+    '''Send a request to the videos endpoint of the Youtube Data API with the
+    key that has the most remaining quota, and retry with the next key if the
+    quota of a key is exceeded
+
+    :param keys: The API keys to use
+    :type keys: ytaquota.KeyPool
+    :param endpoint: The endpoint name used for the quota accounting (one of the keys of ytaquota.ENDPOINTS)
+    :type endpoint: string
+    :param params: The request parameters without the key
+    :type params: dict
+    :param headers: The request headers (Default: API_HEADERS)
+    :type headers: dict, optional
+
+    :raises: :class:``ytacommon.QuotaExceededError: The API quota of all keys is exhausted
+    :raises: :class:``requests.exceptions.RequestException: The request was unsuccessful
+
+    :returns: The response
+    :rtype: requests.Response
+    '''
+    url = yta.getServiceURL("api", "/youtube/v3/videos")
+    while True:
+        apiKey = keys.select()
+        with ytametrics.timed("api"):
+            r = requests.get(url, params=dict(params, key=apiKey), headers=headers if headers else API_HEADERS)
+        keys.record(apiKey, endpoint)
+        try:
+            ytaquota.raiseForStatus(r, apiKey)
+        except yta.QuotaExceededError:
+            keys.exhaust(apiKey)
+            continue
+        return r
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def scheduleStatistics(db, count, youngerTimestamp=sys.maxsize, now=None, cursor=None):
+    '''Select the videos whose statistics should be updated next. Each video
+    is due after a refresh interval that grows with its age from
+    REFRESH_INTERVAL_NEW to REFRESH_INTERVAL_OLD, videos are ordered by how
+    overdue they are. If a cursor is given, SWEEP_SHARE of the videos are
+    selected in order of their database ID after the cursor instead
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param count: Max number of videos to select
+    :type count: integer
+    :param youngerTimestamp: Only return incomplete if videos with a timestamp earlier than this one were not selected (Default: max 64-bit int)
+    :type youngerTimestamp: integer, optional
+    :param now: The current timestamp (Default: now)
+    :type now: integer, optional
+    :param cursor: The database ID of the last video selected in order of the ID by the previous run (Default: no selection by ID)
+    :type cursor: integer, optional
+
+    :returns: Tuple with the list of database IDs of the selected videos, whether
+        all videos that need an update were selected (bool), and the new
+        cursor (int, None if no cursor was given)
+    :rtype: tuple
+    '''
+    if now is None:
+        now = int(time.time())
+    videos = db.execute("SELECT id,timestamp,statisticsupdated FROM videos ORDER BY id;").fetchall()
+    count = max(0, count)
+    #Select videos in order of the ID, continuing after the cursor
+    swept = []
+    if cursor is not None and count < len(videos):
+        sweepCount = min(count, math.ceil(count * SWEEP_SHARE))
+        swept = ([video for video in videos if video[0] > cursor] + [video for video in videos if video[0] <= cursor])[:sweepCount]
+        if swept:
+            cursor = swept[-1][0]
+    sweptIDs = {video[0] for video in swept}
+    #Calculate priorities
+    def priority(video):
+        age = max(0, now - video[1])
+        interval = REFRESH_INTERVAL_OLD - (REFRESH_INTERVAL_OLD - REFRESH_INTERVAL_NEW) * math.exp(-age / REFRESH_DECAY)
+        return max(0, now - video[2]) / interval
+    selected = swept + heapq.nlargest(count - len(swept), [video for video in videos if video[0] not in sweptIDs], key=priority)
+    #Check whether videos are left that needed an update
+    if len(selected) == len(videos):
+        completed = True
+    else:
+        ids = {video[0] for video in selected}
+        completed = not any(video[2] < youngerTimestamp for video in videos if video[0] not in ids)
+    return ([video[0] for video in selected], completed, cursor)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _readETags(db, keys, part):
+    '''Read the cached ETags for the given keys
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Cursor
+    :param keys: The cache keys (Youtube IDs or batch hashes)
+    :type keys: list of string
+    :param part: The requested part the ETags belong to
+    :type part: string
+
+    :returns: Dictionary with the keys as keys and the ETags as values
+    :rtype: dict
+    '''
+    placeholders = ','.join('?' * len(keys))
+    r = db.execute("SELECT key,etag FROM apicache WHERE part = ? AND key IN ({});".format(placeholders), [part] + list(keys))
+    return dict(r.fetchall())
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getStatisticsSource(source, keys, maxcount=None):
+    '''Decide where to get the statistics from and how many videos can be
+    updated. With "auto", the Youtube Data API is used as long as a key with
+    quota left is available and yt-dlp otherwise. As yt-dlp does not use the
+    quota, its number of videos is only limited by maxcount
+
+    :param source: The requested source, one of STATISTICS_SOURCES
+    :type source: string
+    :param keys: The API keys
+    :type keys: ytaquota.KeyPool
+    :param maxcount: Max number of videos to update (Default: no limit)
+    :type maxcount: integer, optional
+
+    :returns: Tuple with the source to use ("api" or "ytdlp") and the max number of videos to update
+    :rtype: tuple(string, int)
+    '''
+    if maxcount is None:
+        maxcount = sys.maxsize
+    if source == "ytdlp" or (source == "auto" and not keys):
+        return ("ytdlp", maxcount)
+    budget = ytaquota.getStatisticsBudget(keys.keys, maxcount) if keys else 0
+    if source == "auto":
+        return ("auto", budget) if budget else ("ytdlp", maxcount)
+    return ("api", budget)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=False, source="auto"):
     '''Update the video statistics from all subdirs
 
     :param path: The path of the parent directory
@@ -291,6 +881,8 @@ def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=Fal
     :type captions: boolean, optional
     :param amendCaptions: Whether to download the captions that were added since the video was archived
     :type amendCaptions: boolean, optional
+    :param source: Where to get the statistics from, one of STATISTICS_SOURCES (Default: "auto")
+    :type source: string, optional
 
     :raises: :class:``ytacommon.NoAPIKeyError: Unable to read API key from file
     :raises: :class:``requests.exceptions.RequestException: Unable to connect to API endpoint
@@ -310,24 +902,28 @@ def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=Fal
     #Connect to database
     dbCon = connectUpdateCreateStatisticsDB(path)
     db = dbCon.cursor()
-    #Check if quota was reset since last update
-    lastupdate = db.execute("SELECT lastupdate FROM setup WHERE id = 1 LIMIT 1;").fetchone()[0]
-    if lastupdate > getResetTimestamp():
-        print("WARNING: Statistics update skipped because no quota reset since the last update")
+    #Get maxcount
+    maxcount = db.execute("SELECT maxcount FROM setup WHERE id = 1 LIMIT 1;").fetchone()[0]
+    #Get API keys and check how many videos the quota left for today allows to update
+    keys = ytaquota.KeyPool()
+    source, maxcount = getStatisticsSource(source, keys, maxcount)
+    if source == "api" and not keys:
+        yta.closeDB(dbCon)
+        raise yta.NoAPIKeyError
+    if maxcount == 0:
+        print("WARNING: Statistics update skipped because the API quota for today is used up")
         yta.closeDB(dbCon)
         return
-    print('')
+    if source == "ytdlp":
+        print("Updating up to {} videos with yt-dlp\n".format(maxcount))
+    else:
+        print("Quota allows updating up to {} videos\n".format(maxcount))
     #Get channels
-    r = db.execute("SELECT name,lastupdate,complete FROM channels;")
+    r = db.execute("SELECT name,lastupdate,complete,cursor FROM channels;")
     channels = {}
     for item in r.fetchall():
-        channels[item[0]] = [item[1], item[2]]
-    #Get maxcount
-    maxcount = db.execute("SELECT maxcount FROM setup WHERE id = 1 LIMIT 1;").fetchone()[0]
-    #Get API key
-    apiKey = yta.getAPIKey()
-    if not apiKey:
-        raise yta.NoAPIKeyError
+        #The name column has numeric affinity, so numeric names are returned as integers
+        channels[str(item[0])] = [item[1], item[2], item[3]]
     #Loop through subdirs, skip completed ones
     skippedSubdirs = []
     for subdir in subdirs:
@@ -337,20 +933,23 @@ def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=Fal
         #Get last update info
         name = os.path.basename(os.path.normpath(subdir))
         try:
-            lastupdate, complete = channels[name]
+            lastupdate, complete, cursor = channels[name]
         except KeyError:
             lastupdate = sys.maxsize
             complete = False
-            db.execute("INSERT INTO channels(name,lastupdate,complete) VALUES(?,?,?);", (name, lastupdate, complete))
+            cursor = 0
+            db.execute("INSERT INTO channels(name,lastupdate,complete,cursor) VALUES(?,?,?,?);", (name, lastupdate, complete, cursor))
+            channels[name] = [lastupdate, complete, cursor]
         #If completed, skip for now
         if complete:
             skippedSubdirs.append(subdir)
             continue
         #Update statistics
         try:
-            maxcount = _updateSubdirStatistics(db, subdir, name, captions, amendCaptions, maxcount, lastupdate, complete, apiKey)
+            maxcount = _updateSubdirStatistics(db, subdir, name, captions, amendCaptions, maxcount, lastupdate, complete, keys, cursor, source)
         except requests.exceptions.RequestException as e:
             print("ERROR: Network error while trying to update the statistics (\"{}\")".format(e))
+            yta.closeDB(dbCon)
             return
 
     #Loop through skipped subdirs
@@ -364,13 +963,14 @@ def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=Fal
         i += 1
         #Get last update info
         name = os.path.basename(os.path.normpath(subdir))
-        lastupdate, complete = channels[name]
+        lastupdate, complete, cursor = channels[name]
         #Update statistics
         print("({}/{}) ".format(i, count), end='')
         try:
-            maxcount = _updateSubdirStatistics(db, subdir, name, captions, amendCaptions, maxcount, lastupdate, complete, apiKey)
+            maxcount = _updateSubdirStatistics(db, subdir, name, captions, amendCaptions, maxcount, lastupdate, complete, keys, cursor, source)
         except requests.exceptions.RequestException as e:
             print("ERROR: Network error while trying to update the statistics (\"{}\")".format(e))
+            yta.closeDB(dbCon)
             return
 
     #Write lastupdate to statistics database
@@ -380,7 +980,7 @@ def updateAllStatistics(path, automatic=False, captions=False, amendCaptions=Fal
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def _updateSubdirStatistics(db, path, name, captions, amendCaptions, maxcount, lastupdate, complete, apiKey):
+def _updateSubdirStatistics(db, path, name, captions, amendCaptions, maxcount, lastupdate, complete, keys, cursor, source):
     '''Update the statistics for one subdir
 
     :param db: Connection to the statistics database
@@ -399,8 +999,12 @@ def _updateSubdirStatistics(db, path, name, captions, amendCaptions, maxcount, l
     :type lastupdate: integer
     :param complete: Whether the last update was complete
     :type complete: boolean
-    :param apiKey: The API-Key for the Youtube-API
-    :type apiKey: string
+    :param keys: The API keys for the Youtube-API
+    :type keys: ytaquota.KeyPool
+    :param cursor: The cursor of the channel returned by the last update
+    :type cursor: integer
+    :param source: Where to get the statistics from, one of STATISTICS_SOURCES
+    :type source: string
 
     :raises: :class:``requests.exceptions.RequestException: Unable to connect to API endpoint
 
@@ -409,15 +1013,18 @@ def _updateSubdirStatistics(db, path, name, captions, amendCaptions, maxcount, l
     '''
     #Print status
     print("Updating \"{}\"".format(name))
+    #Check if database needs upgrade
+    dbPath = os.path.join(path, "archive.db")
+    yta.upgradeDatabase(dbPath)
     #Connect to channel database
-    channelDB = yta.connectDB(os.path.join(path, "archive.db"))
+    channelDB = yta.connectDB(dbPath)
     #Perform update
     updateTimestamp = int(time.time())
-    maxcount, complete = updateStatistics(channelDB, lastupdate, captions, maxcount, apiKey, amendCaptions)
+    maxcount, complete, cursor = updateStatistics(channelDB, lastupdate, captions, maxcount, keys, amendCaptions, cursor, source)
     #Close channel db
     yta.closeDB(channelDB)
     #Write new info to database
-    db.execute("UPDATE channels SET lastupdate = ?, complete = ? WHERE name = ?;", (updateTimestamp, complete, name))
+    db.execute("UPDATE channels SET lastupdate = ?, complete = ?, cursor = ? WHERE name = ?;", (updateTimestamp, complete, cursor, name))
 
     return maxcount
 # ########################################################################### #
@@ -435,15 +1042,99 @@ def amendCaption(db, dbID, youtubeID, lang):
     :param lang: The language string of the video
     :type lang: string
     '''
+    try:
+        sub = fetchCaption(youtubeID, lang)
+    except requests.exceptions.RequestException as e:
+        print(e.args[0])
+        return
+    if not sub:
+        print("INFO: No subtitle with language \"{}\" for video \"{}\" available".format(lang, youtubeID))
+        return
+    #Write new subtitles to database
+    _writeCaptions(db, [(dbID, youtubeID) + sub])
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def amendMissingCaptions(db, videos, workers=CAPTION_WORKERS, retries=CAPTION_RETRIES):
+    '''Download the video captions that were added since the videos were
+    archived. The captions are downloaded concurrently, failed downloads are
+    queued for retry, and the results are written to the database in batches
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Connection
+    :param videos: List of videos (database ID, Youtube ID, language)
+    :type videos: list of tuple
+    :param workers: Max number of concurrent downloads (Default: CAPTION_WORKERS)
+    :type workers: integer, optional
+    :param retries: Number of times failed downloads are retried (Default: CAPTION_RETRIES)
+    :type retries: integer, optional
+
+    :returns: Tuple with the number of amended captions, the number of failed downloads
+    :rtype: tuple(int, int)
+    '''
+    if not videos:
+        return (0, 0)
+    t1 = time.time()
+    amended = 0
+    queue = list(videos)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for attempt in range(retries + 1):
+            if not queue:
+                break
+            if attempt:
+                time.sleep(CAPTION_RETRY_DELAY * attempt)
+            futures = {executor.submit(fetchCaption, video[1], video[2]): video for video in queue}
+            queue = []
+            results = []
+            for future in as_completed(futures):
+                video = futures[future]
+                try:
+                    sub = future.result()
+                except requests.exceptions.RequestException as e:
+                    #Queue for retry
+                    errors[video[1]] = e.args[0]
+                    queue.append(video)
+                    continue
+                errors.pop(video[1], None)
+                if not sub:
+                    print("INFO: No subtitle with language \"{}\" for video \"{}\" available".format(video[2], video[1]))
+                    continue
+                results.append((video[0], video[1]) + sub)
+                if len(results) >= CAPTION_BATCH:
+                    amended += _writeCaptions(db, results)
+                    results = []
+            amended += _writeCaptions(db, results)
+    for video in queue:
+        print(errors[video[1]])
+    #Print throughput
+    duration = time.time() - t1
+    print("INFO: Amended captions of {} of {} videos in {:.1f} s ({:.1f} videos/s)".format(amended, len(videos), duration, len(videos) / duration if duration else 0))
+    return (amended, len(queue))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def fetchCaption(youtubeID, lang):
+    '''Download the captions of a video in the video language
+
+    :param youtubeID: The youtube id of the video
+    :type youtubeID: string
+    :param lang: The language string of the video
+    :type lang: string
+
+    :raises: :class:``requests.exceptions.RequestException: Unable to download the captions, the first argument is the error message
+
+    :returns: Tuple with the language code and the captions, None if no captions in the language are available
+    :rtype: tuple(string, string)
+    '''
     #Get a list of all available subtitles
     try:
-        url = "https://video.google.com/timedtext?hl=en&type=list&v=" + youtubeID
+        url = yta.getServiceURL("timedtext", "/timedtext?hl=en&type=list&v=" + youtubeID)
         r = requests.get(url)
         r.raise_for_status()
         subs = [c.attrib for c in ElementTree.fromstring(r.content) if c.tag == "track"]
-    except requests.exceptions.RequestException:
-        print("ERROR: Unable to amend subtitles for video \"{}\"".format(youtubeID))
-        return
+    except requests.exceptions.RequestException as e:
+        raise requests.exceptions.RequestException("ERROR: Unable to amend subtitles for video \"{}\"".format(youtubeID)) from e
     sub = None
     #Try direct match for sub language
     for s in subs:
@@ -463,25 +1154,40 @@ def amendCaption(db, dbID, youtubeID, lang):
                 sub = s
                 break
     if not sub:
-        print("INFO: No subtitle with language \"{}\" for video \"{}\" available".format(lang, youtubeID))
-        return
+        return None
     #Download subtitles
     try:
-        url = "https://video.google.com/timedtext?fmt=vtt&lang={}&v={}&name={}".format(sub["lang_code"], youtubeID, requests.utils.quote(sub["name"]))
+        url = yta.getServiceURL("timedtext", "/timedtext?fmt=vtt&lang={}&v={}&name={}".format(sub["lang_code"], youtubeID, requests.utils.quote(sub["name"])))
         r = requests.get(url)
         r.raise_for_status()
-        subtitles = r.text
-    except requests.exceptions.RequestException:
-        print("ERROR: Unable to download subtitle \"{}\" for video \"{}\"".format(sub["lang_code"], youtubeID))
-        return
-    #Write new subtitles to database
+    except requests.exceptions.RequestException as e:
+        raise requests.exceptions.RequestException("ERROR: Unable to download subtitle \"{}\" for video \"{}\"".format(sub["lang_code"], youtubeID)) from e
+    return (sub["lang_code"], r.text)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _writeCaptions(db, captions):
+    '''Write amended captions to the database in one statement
+
+    :param db: Connection to the archive database
+    :type db: sqlite3.Connection
+    :param captions: List of captions (database ID, Youtube ID, language code, subtitles)
+    :type captions: list of tuple
+
+    :returns: The number of written captions
+    :rtype: integer
+    '''
+    if not captions:
+        return 0
     try:
-        db.execute("UPDATE videos SET subtitles = ? WHERE id = ?", (subtitles, dbID))
+        db.executemany("UPDATE videos SET subtitles = ? WHERE id = ?", [(c[3], c[0]) for c in captions])
     except sqlite3.Error as e:
-        print("ERROR: Unable to write subtitle for video \"{}\" to database (Error: \"{}\")".format(youtubeID, e))
-        return
-    #Print success message
-    print("INFO: Added subtitle \"{}\" for video \"{}\" to the database".format(sub["lang_code"], youtubeID))
+        print("ERROR: Unable to write subtitles for videos {} to database (Error: \"{}\")".format(", ".join("\"{}\"".format(c[1]) for c in captions), e))
+        return 0
+    #Print success messages
+    for c in captions:
+        print("INFO: Added subtitle \"{}\" for video \"{}\" to the database".format(c[2], c[1]))
+    return len(captions)
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -535,6 +1241,13 @@ def connectUpdateCreateStatisticsDB(directory):
                 version = 1
                 db.execute("INSERT INTO setup(autoupdate,lastupdate,maxcount,dbversion) VALUES(?,?,?,?)", (False, 0, 100000, version))
                 dbCon.commit()
+            if version < 2:
+                #Add the cursor of the selection by ID
+                db.execute("ALTER TABLE channels ADD COLUMN cursor INTEGER NOT NULL DEFAULT 0;")
+                #Update db version
+                version = 2
+                db.execute("UPDATE setup SET dbversion = ? WHERE id = 1", (version,))
+                dbCon.commit()
         except sqlite3.Error as e:
             print("ERROR: Unable to upgrade database (\"{}\")".format(e))
             dbCon.rollback()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+''' ytametrics - instrumentation of the archiver in the Prometheus text format '''
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --------------------------------------------------------------------------- #
+#The metrics by name as (type, help, label name)
+METRICS = {
+    "yta_downloaded_bytes_total": ("counter", "Bytes downloaded by yt-dlp", None),
+    "yta_videos_archived_total": ("counter", "Videos added to the archive databases", None),
+    "yta_stage_duration_seconds": ("histogram", "Duration of the stages of archiving a video (download, remux, exiftool, api, hash, db)", "stage"),
+    "yta_queue_depth": ("gauge", "Number of items waiting in a queue (videos, downloads, channels)", "queue")
+}
+#Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class Registry:
+    '''Holds the values of all metrics of this process'''
+
+    def __init__(self):
+        '''Init'''
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Reset all values'''
+        with self._lock:
+            #Values by (name, label value): a number for counters and gauges,
+            #a list with the bucket counts, the count, and the sum for histograms
+            self._values = {}
+
+    def inc(self, name, value=1, label=None):
+        '''Increase a counter or gauge
+
+        :param name: The metric name (one of the keys of METRICS)
+        :type name: string
+        :param value: The increase (Default: 1)
+        :type value: integer or float, optional
+        :param label: The label value (Default: no label)
+        :type label: string, optional
+        '''
+        with self._lock:
+            self._values[(name, label)] = self._values.get((name, label), 0) + value
+
+    def set(self, name, value, label=None):
+        '''Set a gauge
+
+        :param name: The metric name (one of the keys of METRICS)
+        :type name: string
+        :param value: The value
+        :type value: integer or float
+        :param label: The label value (Default: no label)
+        :type label: string, optional
+        '''
+        with self._lock:
+            self._values[(name, label)] = value
+
+    def observe(self, name, value, label=None):
+        '''Add an observation to a histogram
+
+        :param name: The metric name (one of the keys of METRICS)
+        :type name: string
+        :param value: The observed value
+        :type value: float
+        :param label: The label value (Default: no label)
+        :type label: string, optional
+        '''
+        with self._lock:
+            histogram = self._values.setdefault((name, label), [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        '''Return a copy of the values, e.g. to pass them to another process
+
+        :returns: The values
+        :rtype: dict
+        '''
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def merge(self, values):
+        '''Add the values of another process (gauges are replaced)
+
+        :param values: The values as returned by snapshot
+        :type values: dict
+        '''
+        with self._lock:
+            for key, value in values.items():
+                if isinstance(value, list):
+                    current = self._values.setdefault(key, [0] * len(value))
+                    self._values[key] = [a + b for a, b in zip(current, value)]
+                elif METRICS[key[0]][0] == "gauge":
+                    self._values[key] = value
+                else:
+                    self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        '''Return the metrics in the Prometheus text format
+
+        :returns: The metrics
+        :rtype: string
+        '''
+        values = self.snapshot()
+        lines = []
+        for name, (kind, desc, labelName) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, desc))
+            lines.append("# TYPE {} {}".format(name, kind))
+            keys = sorted([key for key in values if key[0] == name], key=lambda k: k[1] or '')
+            if not keys and not labelName:
+                keys = [(name, None)]
+            for key in keys:
+                label = '{}="{}"'.format(labelName, key[1]) if key[1] is not None else ''
+                value = values.get(key, 0)
+                if kind != "histogram":
+                    lines.append("{}{} {}".format(name, "{" + label + "}" if label else '', _format(value)))
+                    continue
+                sep = ',' if label else ''
+                for bound, count in zip(BUCKETS + ("+Inf",), value[:len(BUCKETS)] + [value[-2]]):
+                    lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, label, sep, bound, count))
+                lines.append("{}_count{} {}".format(name, "{" + label + "}" if label else '', value[-2]))
+                lines.append("{}_sum{} {}".format(name, "{" + label + "}" if label else '', _format(value[-1])))
+        return '\n'.join(lines) + '\n'
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+#The registry of this process
+REGISTRY = Registry()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _format(value):
+    '''Format a value for the text format'''
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+@contextmanager
+def timed(stage):
+    '''Observe the duration of a stage
+
+    :param stage: The stage name
+    :type stage: string
+    '''
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("yta_stage_duration_seconds", time.perf_counter() - t, stage)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def progressHook(d):
+    '''yt-dlp progress hook counting the downloaded bytes and the download durations
+
+    :param d: The progress information of yt-dlp
+    :type d: dict
+    '''
+    if d.get("status") != "finished":
+        return
+    REGISTRY.inc("yta_downloaded_bytes_total", d.get("total_bytes") or d.get("downloaded_bytes") or 0)
+    if d.get("elapsed") is not None:
+        REGISTRY.observe("yta_stage_duration_seconds", d["elapsed"], "download")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def writeTextfile(path):
+    '''Write the metrics to a file (e.g. for the textfile collector of the
+    node exporter), the file is replaced atomically
+
+    :param path: The file path
+    :type path: string
+
+    :raises: :class:``OSError: Unable to write the file
+    '''
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmpPath, path)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class MetricsServer(ThreadingHTTPServer):
+    '''Serves the metrics on /metrics'''
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        '''Init
+
+        :param address: The address to listen on
+        :type address: tuple
+        '''
+        super().__init__(address, _MetricsHandler)
+
+    def start(self):
+        '''Start serving in a background thread'''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class _MetricsHandler(BaseHTTPRequestHandler):
+    '''Handler of the requests to the metrics server'''
+
+    def log_message(self, fmt, *args):
+        '''Do not log requests'''
+
+    def do_GET(self):
+        '''Answer GET requests'''
+        if self.path.split('?', 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+# ########################################################################### #
@@ -10,10 +10,14 @@ import sqlite3
 import json
 import time
 from datetime import datetime, timezone
-from pycountry import languages
 import ytacommon as yta
 import ytameta
 import ytafix
+import ytahistory
+import ytametrics
+
+#Loaded on first use to keep the startup fast
+pycountry = yta.lazyImport("pycountry")
 
 # --------------------------------------------------------------------------- #
 def postprocess(args):
@@ -81,7 +85,7 @@ def processFile(name, subLang, db, check, replace):
     '''
     videoFileComp = os.path.splitext(name)
     #Get language for ffmpeg
-    lang = languages.get(alpha_2=subLang).alpha_3
+    lang = pycountry.languages.get(alpha_2=subLang).alpha_3
     #If subtitles, read and embed them
     subs = None
     tmpFile = videoFileComp[0] + "_tmp" + videoFileComp[1]
@@ -92,8 +96,9 @@ def processFile(name, subLang, db, check, replace):
             with open(subFile, 'r') as f:
                 subs = f.read()
             cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "panic", "-i", name, "-sub_charenc", "UTF-8", "-i", subFile, "-map", "0:v", "-map", "0:a", "-c", "copy", "-map", "1", "-c:s:0", "mov_text", "-metadata:s:s:0", "language=" + lang, "-metadata:s:a:0", "language=" + lang, tmpFile]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            process.wait()
+            with ytametrics.timed("remux"):
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                process.wait()
             shutil.move(tmpFile, name)
             os.remove(subFile)
         except IOError:
@@ -101,8 +106,9 @@ def processFile(name, subLang, db, check, replace):
     #If no subtitles added, change audio language at least
     if not subs:
         cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "panic", "-i", name, "-map", "0:v", "-map", "0:a", "-c", "copy", "-metadata:s:a:0", "language=" + lang, tmpFile]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        process.wait()
+        with ytametrics.timed("remux"):
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            process.wait()
         shutil.move(tmpFile, name)
     #Read description
     desc = None
@@ -113,22 +119,23 @@ def processFile(name, subLang, db, check, replace):
         os.remove(descFile)
     except IOError:
         pass
-    #Read artist, title
-    cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-Artist", name]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    artist = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
-    cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-Title", name]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    title = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
-    #Read image width
-    hd, formatString, width, height = yta.readResolution(name)
-    #Read date
-    cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-ContentCreateDate", name]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    r = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
+    with ytametrics.timed("exiftool"):
+        #Read artist, title
+        cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-Artist", name]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        process.wait()
+        artist = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
+        cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-Title", name]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        process.wait()
+        title = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
+        #Read image width
+        hd, formatString, width, height = yta.readResolution(name)
+        #Read date
+        cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-ContentCreateDate", name]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        process.wait()
+        r = process.stdout.read().decode("UTF-8").split(':', 1)[1].strip()
     dateTime = r[0:4] + ':' + r[4:6] + ':' + r[6:8] + " 00:00:00"
     date = r[0:4] + '-' + r[4:6] + '-' + r[6:8]
     oldName = os.path.basename(name)
@@ -146,12 +153,14 @@ def processFile(name, subLang, db, check, replace):
     likeCount = None
     dislikeCount = None
     statisticsUpdated = None
+    metadataPending = False
     try:
         [timestamp, duration, tags, apiDesc, viewCount, likeCount, dislikeCount, statisticsUpdated] = ytameta.getMetadata(videoID)
     except yta.NoAPIKeyError:
-        pass
+        metadataPending = True
     except OSError:
-        print("ERROR: Unable to load metadata for {}".format(videoID))
+        print("ERROR: Unable to load metadata for {}, queued for backfill".format(videoID))
+        metadataPending = True
     if timestamp:
         dt = datetime.fromtimestamp(timestamp, tz=timezone.utc)
         dateTime = datetime.strftime(dt, "%Y:%m:%d %H:%M:%S+0")
@@ -183,25 +192,27 @@ def processFile(name, subLang, db, check, replace):
     newName = os.path.join(os.path.dirname(name), fileName)
     os.rename(name, newName)
     #Set additional metadata
-    cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-overwrite_original", "-ContentCreateDate='{}'".format(dateTime), "-Comment={}".format('YoutubeID: ' + videoID), "-Encoder=", newName]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "--printConv", "-overwrite_original", "-HDVideo={}".format(hd), newName]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    #Use description from API if available
-    if apiDesc:
-        desc = apiDesc
-        config = os.path.join(os.path.dirname(os.path.realpath(__file__)), "exiftool.config")
-        cmd = ["exiftool", "-config", config, "-api", "largefilesupport=1", "-overwrite_original", "-ec", "-Description={}".format(desc), newName]
+    with ytametrics.timed("exiftool"):
+        cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "-overwrite_original", "-ContentCreateDate='{}'".format(dateTime), "-Comment={}".format('YoutubeID: ' + videoID), "-Encoder=", newName]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        process.wait()
+        cmd = ["exiftool", "-api", "largefilesupport=1", "-m", "--printConv", "-overwrite_original", "-HDVideo={}".format(hd), newName]
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         process.wait()
+        #Use description from API if available
+        if apiDesc:
+            desc = apiDesc
+            config = os.path.join(os.path.dirname(os.path.realpath(__file__)), "exiftool.config")
+            cmd = ["exiftool", "-config", config, "-api", "largefilesupport=1", "-overwrite_original", "-ec", "-Description={}".format(desc), newName]
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            process.wait()
     #Get chapter information
     chapters = yta.extractChapters(desc)
     #Check if fix required
     artist, title = ytafix.fixVideo(newName, videoID, fileArtist=artist)
     #Calculate checksum
-    checksum = yta.calcSHA(newName)
+    with ytametrics.timed("hash"):
+        checksum = yta.calcSHA(newName)
     #Get filesize
     filesize = os.path.getsize(newName)
     #Check file integrity
@@ -226,7 +237,11 @@ def processFile(name, subLang, db, check, replace):
             thumbData = None
             thumbFormat = None
     #Save to database
-    saveToDB(db, replace, title, artist, date, timestamp, desc, videoID, subs, fileName, checksum, thumbData, thumbFormat, duration, tags, formatString, width, height, subLang, viewCount, likeCount, dislikeCount, statisticsUpdated, chapters, filesize)
+    with ytametrics.timed("db"):
+        saveToDB(db, replace, title, artist, date, timestamp, desc, videoID, subs, fileName, checksum, thumbData, thumbFormat, duration, tags, formatString, width, height, subLang, viewCount, likeCount, dislikeCount, statisticsUpdated, chapters, filesize)
+        #Queue the metadata lookup for later if the API was not available
+        if metadataPending:
+            ytameta.queueMetadata(db, videoID)
     #Remove replaced file:
     if replace:
         try:
@@ -338,6 +353,9 @@ def saveToDB(db, replace, name, artist, date, timestamp, desc, youtubeID, subs,
     if statisticsUpdated:
         update = "UPDATE videos SET viewcount = ?, likecount = ?, dislikecount = ?, statisticsupdated = ? WHERE youtubeID = ?"
         db.execute(update, (viewCount, likeCount, dislikeCount, statisticsUpdated, youtubeID))
+        if isinstance(viewCount, int) and statisticsUpdated:
+            dbID = db.execute("SELECT id FROM videos WHERE youtubeID = ?;", (youtubeID,)).fetchone()[0]
+            ytahistory.appendSamples(db, [(dbID, statisticsUpdated, viewCount, likeCount or 0, dislikeCount or 0)])
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -378,8 +396,13 @@ def createOrConnectDB(path):
 
     #Create database
     dbCon = yta.connectDB(path)
-    #Create table
+    #Create tables
     yta.createVideoTable(dbCon)
+    yta.createAPICacheTable(dbCon)
+    yta.createStatisticsHistoryTable(dbCon)
+    yta.createPendingMetadataTable(dbCon)
+    yta.createUnavailableTable(dbCon)
+    yta.createDownloadQueueTable(dbCon)
     #Return database connection
     return dbCon
 # ########################################################################### #
@@ -414,7 +437,9 @@ class PostHook:
         '''
         print("[ytarchiver] Post-processing \"{}\"".format(filename))
         processFile(filename, self._lang, self._db, self._check, self._replace)
-        self._db.commit()
+        with ytametrics.timed("db"):
+            self._db.commit()
+        ytametrics.REGISTRY.inc("yta_videos_archived_total")
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+''' ytaquota - keep track of the Youtube Data API quota usage '''
+
+import os
+import sys
+import argparse
+import sqlite3
+import hashlib
+import time
+import threading
+from datetime import datetime, timedelta
+import ytacommon as yta
+
+#Loaded on first use to keep the startup fast
+pytz = yta.lazyImport("pytz")
+appdirs = yta.lazyImport("appdirs")
+
+# --------------------------------------------------------------------------- #
+__quotadbversion__ = 1
+#Default daily quota of a Youtube Data API project
+DAILY_QUOTA = 10000
+#Unit cost of a single request to each endpoint
+ENDPOINTS = {"videos.metadata": 1, "videos.statistics": 1}
+#Number of videos whose statistics can be requested with one request
+VIDEOS_PER_REQUEST = 50
+#Seconds to wait for other processes to release the lock of the ledger before a write fails
+LEDGER_TIMEOUT = 30
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def main(args):
+    '''Print the quota usage of the current day
+
+    :param args: The command line arguments given by the user
+    :type args: list
+    '''
+    parser = argparse.ArgumentParser(prog="ytaquota", description="Print the Youtube Data API quota usage")
+    parser.add_argument("-d", "--days", action="store", dest="days", type=int, default=1, help="Number of days to print (Default: 1)")
+    args = parser.parse_args(args)
+
+    apiKeys = yta.getAPIKeys()
+    if not apiKeys:
+        print("ERROR: No API key available")
+        return
+    dbCon = connectQuotaDB()
+    today = datetime.strptime(getQuotaDay(), "%Y-%m-%d")
+    for apiKey in apiKeys:
+        if len(apiKeys) > 1:
+            print("API key {}:".format(keyID(apiKey)))
+        for i in range(args.days):
+            day = (today - timedelta(days=i)).strftime("%Y-%m-%d")
+            spent = getSpent(apiKey, day, dbCon)
+            print("{}: {} units".format(day, sum(spent.values())))
+            for endpoint, units in sorted(spent.items()):
+                print("    {}: {}".format(endpoint, units))
+        print("Remaining today: {} units".format(getRemaining(apiKey, dbCon)))
+    yta.closeDB(dbCon)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getQuotaDBPath():
+    '''Return the path of the quota ledger, which is stored next to the API key
+    in the user data dir unless the "YTA_QUOTADB" environment variable is set
+
+    :returns: The path of the quota ledger database
+    :rtype: string
+    '''
+    if os.environ.get("YTA_QUOTADB"):
+        return os.environ.get("YTA_QUOTADB")
+    dirs = appdirs.AppDirs("ytarchiver", "yta")
+    os.makedirs(dirs.user_data_dir, exist_ok=True)
+    return os.path.join(dirs.user_data_dir, "quota.db")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def connectQuotaDB(shared=False):
+    '''Connects to the quota ledger database, updates it if necessary or
+    creates it if it does not exist
+
+    :param shared: Whether the connection is used by several threads, which have to serialize their access (Default: False)
+    :type shared: boolean, optional
+
+    :raises: :class:``sqlite3.Error: Unable to connect to database
+
+    :returns: Connection to the database
+    :rtype: sqlite3.Connection
+    '''
+    #Connect to database
+    dbCon = sqlite3.connect(getQuotaDBPath(), timeout=LEDGER_TIMEOUT, check_same_thread=not shared)
+    db = dbCon.cursor()
+    #Get database version
+    try:
+        r = db.execute("SELECT dbversion FROM setup ORDER BY id DESC LIMIT 1;")
+        version = r.fetchone()[0]
+        del r
+    except sqlite3.Error:
+        #No version field: new database
+        version = 0
+
+    if version < __quotadbversion__:
+        try:
+            #Perform initial setup
+            if version < 1:
+                #Set encoding
+                dbCon.execute("pragma encoding=UTF8")
+                #Create tables
+                cmd = """ CREATE TABLE setup (
+                              id INTEGER PRIMARY KEY UNIQUE NOT NULL,
+                              dailyquota INTEGER NOT NULL,
+                              dbversion INTEGER NOT NULL
+                          ); """
+                dbCon.execute(cmd)
+                cmd = """ CREATE TABLE ledger (
+                              id INTEGER PRIMARY KEY UNIQUE NOT NULL,
+                              day TEXT NOT NULL,
+                              apikey TEXT NOT NULL,
+                              endpoint TEXT NOT NULL,
+                              units INTEGER NOT NULL,
+                              requests INTEGER NOT NULL,
+                              UNIQUE(day, apikey, endpoint)
+                          ); """
+                dbCon.execute(cmd)
+                cmd = """ CREATE TABLE exhausted (
+                              day TEXT NOT NULL,
+                              apikey TEXT NOT NULL,
+                              timestamp INTEGER NOT NULL,
+                              PRIMARY KEY(day, apikey)
+                          ); """
+                dbCon.execute(cmd)
+                #Set db version
+                version = 1
+                db.execute("INSERT INTO setup(dailyquota,dbversion) VALUES(?,?)", (DAILY_QUOTA, version))
+                dbCon.commit()
+        except sqlite3.Error as e:
+            print("ERROR: Unable to upgrade database (\"{}\")".format(e))
+            dbCon.rollback()
+            yta.closeDB(dbCon)
+            sys.exit(1)
+
+    #Return connection to database
+    return dbCon
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getQuotaDay(timestamp=None):
+    '''Return the quota day (date in Pacific time, when the quota is reset) of
+    the given timestamp
+
+    :param timestamp: The timestamp (Default: now)
+    :type timestamp: integer, optional
+
+    :returns: The date in the format YYYY-MM-DD
+    :rtype: string
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    tz = pytz.timezone('US/Pacific')
+    return datetime.fromtimestamp(timestamp, tz).strftime("%Y-%m-%d")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def keyID(apiKey):
+    '''Return the identifier used for the API key in the ledger, so that the
+    key itself is never written to the ledger
+
+    :param apiKey: The API key
+    :type apiKey: string
+
+    :returns: The key identifier
+    :rtype: string
+    '''
+    return hashlib.sha256(apiKey.encode("UTF-8")).hexdigest()[:16]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def record(apiKey, endpoint, count=1, dbCon=None):
+    '''Record the units spent for requests to an endpoint
+
+    :param apiKey: The API key used for the requests
+    :type apiKey: string
+    :param endpoint: The endpoint name (one of the keys of ENDPOINTS)
+    :type endpoint: string
+    :param count: The number of requests (Default: 1)
+    :type count: integer, optional
+    :param dbCon: Connection to the quota database (Default: open a new one)
+    :type dbCon: sqlite3.Connection, optional
+    '''
+    con = dbCon if dbCon else connectQuotaDB()
+    try:
+        writeLedger(con, {(getQuotaDay(), apiKey, endpoint): count})
+    except sqlite3.Error as e:
+        print("WARNING: Unable to write to quota ledger (\"{}\")".format(e))
+    finally:
+        if not dbCon:
+            yta.closeDB(con)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def writeLedger(dbCon, counts):
+    '''Add requests to the ledger in one transaction
+
+    :param dbCon: Connection to the quota database
+    :type dbCon: sqlite3.Connection
+    :param counts: The number of requests by (quota day, API key, endpoint)
+    :type counts: dict
+
+    :raises: :class:``sqlite3.Error: Unable to write to the ledger, nothing was written
+    '''
+    cmd = """ INSERT INTO ledger(day,apikey,endpoint,units,requests) VALUES(?,?,?,?,?)
+              ON CONFLICT(day,apikey,endpoint) DO UPDATE SET units = units + excluded.units, requests = requests + excluded.requests; """
+    try:
+        with dbCon:
+            dbCon.executemany(cmd, [(day, keyID(apiKey), endpoint, ENDPOINTS[endpoint] * count, count) for (day, apiKey, endpoint), count in counts.items()])
+    except sqlite3.Error:
+        dbCon.rollback()
+        raise
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def markExhausted(apiKey, dbCon=None):
+    '''Mark the quota of an API key as exhausted for the current day
+
+    :param apiKey: The API key
+    :type apiKey: string
+    :param dbCon: Connection to the quota database (Default: open a new one)
+    :type dbCon: sqlite3.Connection, optional
+    '''
+    con = dbCon if dbCon else connectQuotaDB()
+    try:
+        con.execute("INSERT OR REPLACE INTO exhausted(day,apikey,timestamp) VALUES(?,?,?);", (getQuotaDay(), keyID(apiKey), int(time.time())))
+        con.commit()
+    except sqlite3.Error as e:
+        print("WARNING: Unable to write to quota ledger (\"{}\")".format(e))
+    finally:
+        if not dbCon:
+            yta.closeDB(con)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getSpent(apiKey, day=None, dbCon=None):
+    '''Return the units spent per endpoint on a given day
+
+    :param apiKey: The API key
+    :type apiKey: string
+    :param day: The quota day in the format YYYY-MM-DD (Default: today)
+    :type day: string, optional
+    :param dbCon: Connection to the quota database (Default: open a new one)
+    :type dbCon: sqlite3.Connection, optional
+
+    :returns: Dictionary with the endpoint names as keys and the spent units as values
+    :rtype: dict
+    '''
+    if not day:
+        day = getQuotaDay()
+    con = dbCon if dbCon else connectQuotaDB()
+    r = con.execute("SELECT endpoint,units FROM ledger WHERE day = ? AND apikey = ?;", (day, keyID(apiKey)))
+    spent = dict(r.fetchall())
+    if not dbCon:
+        yta.closeDB(con)
+    return spent
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getRemaining(apiKey, dbCon=None):
+    '''Return the units that are left for today
+
+    :param apiKey: The API key
+    :type apiKey: string
+    :param dbCon: Connection to the quota database (Default: open a new one)
+    :type dbCon: sqlite3.Connection, optional
+
+    :returns: The number of units left
+    :rtype: integer
+    '''
+    con = dbCon if dbCon else connectQuotaDB()
+    day = getQuotaDay()
+    try:
+        if con.execute("SELECT day FROM exhausted WHERE day = ? AND apikey = ?;", (day, keyID(apiKey))).fetchone():
+            return 0
+        quota = con.execute("SELECT dailyquota FROM setup WHERE id = 1 LIMIT 1;").fetchone()[0]
+        spent = sum(getSpent(apiKey, day, con).values())
+    finally:
+        if not dbCon:
+            yta.closeDB(con)
+    return max(0, quota - spent)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def forecast(apiKey, endpoint, days=7, dbCon=None):
+    '''Forecast how many more units an endpoint will need today, based on the
+    average daily usage of the previous days
+
+    :param apiKey: The API key
+    :type apiKey: string
+    :param endpoint: The endpoint name (one of the keys of ENDPOINTS)
+    :type endpoint: string
+    :param days: The number of previous days to average over (Default: 7)
+    :type days: integer, optional
+    :param dbCon: Connection to the quota database (Default: open a new one)
+    :type dbCon: sqlite3.Connection, optional
+
+    :returns: The number of units expected to be spent for the rest of the day
+    :rtype: integer
+    '''
+    con = dbCon if dbCon else connectQuotaDB()
+    today = datetime.strptime(getQuotaDay(), "%Y-%m-%d")
+    first = (today - timedelta(days=days)).strftime("%Y-%m-%d")
+    r = con.execute("SELECT sum(units) FROM ledger WHERE apikey = ? AND endpoint = ? AND day >= ? AND day < ?;", (keyID(apiKey), endpoint, first, today.strftime("%Y-%m-%d")))
+    total = r.fetchone()[0] or 0
+    spentToday = getSpent(apiKey, None, con).get(endpoint, 0)
+    if not dbCon:
+        yta.closeDB(con)
+    return max(0, -(-total // days) - spentToday)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getStatisticsBudget(apiKeys, maxcount=None):
+    '''Return the number of videos whose statistics can be updated today
+    without cutting into the units the metadata lookups of the remaining
+    downloads are expected to need
+
+    :param apiKeys: The API keys
+    :type apiKeys: list of string
+    :param maxcount: The max number of videos to update per day (Default: no limit)
+    :type maxcount: integer, optional
+
+    :returns: The number of videos
+    :rtype: integer
+    '''
+    dbCon = connectQuotaDB()
+    try:
+        budget = 0
+        updated = 0
+        for apiKey in apiKeys:
+            units = getRemaining(apiKey, dbCon) - forecast(apiKey, "videos.metadata", dbCon=dbCon)
+            budget += max(0, units) * VIDEOS_PER_REQUEST
+            updated += getSpent(apiKey, None, dbCon).get("videos.statistics", 0) * VIDEOS_PER_REQUEST
+        #Subtract the videos already updated today from the daily max count
+        if maxcount is not None:
+            budget = min(budget, max(0, maxcount - updated))
+    finally:
+        yta.closeDB(dbCon)
+    return budget
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def raiseForStatus(r, apiKey):
+    '''Check the response of an API request, mark the key as exhausted if the
+    quota was exceeded, and raise an exception for all unsuccessful requests
+
+    :param r: The response
+    :type r: requests.Response
+    :param apiKey: The API key used for the request
+    :type apiKey: string
+
+    :raises: :class:``ytacommon.QuotaExceededError: The quota of the API key is exhausted
+    :raises: :class:``requests.exceptions.HTTPError: The request was unsuccessful
+    '''
+    if r.status_code == 403:
+        try:
+            reasons = [e.get("reason") for e in r.json()["error"]["errors"]]
+        except (ValueError, KeyError, TypeError):
+            reasons = []
+        if "quotaExceeded" in reasons or "dailyLimitExceeded" in reasons:
+            markExhausted(apiKey)
+            raise yta.QuotaExceededError("API quota exceeded", response=r)
+    r.raise_for_status()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class KeyPool:
+    '''Pool of API keys that dispatches requests to the key with the most
+    remaining quota. The pool can be shared between threads, which record
+    the spent units in the ledger using the one connection of the pool'''
+
+    def __init__(self, apiKeys=None):
+        '''Init
+
+        :param apiKeys: The API keys (Default: all keys from the config)
+        :type apiKeys: list of string, optional
+        '''
+        self.keys = list(apiKeys) if apiKeys is not None else yta.getAPIKeys()
+        #The connection to the ledger is shared by all threads using the pool
+        self._db = connectQuotaDB(True)
+        self._remaining = {apiKey: getRemaining(apiKey, self._db) for apiKey in self.keys}
+        #Keys whose quota was exceeded stay exhausted until the next quota day
+        r = self._db.execute("SELECT apikey FROM exhausted WHERE day = ?;", (getQuotaDay(),))
+        exhausted = {row[0] for row in r.fetchall()}
+        self._exhausted = {apiKey for apiKey in self.keys if keyID(apiKey) in exhausted}
+        self._lock = threading.Lock()
+        #Requests that could not be written to the ledger yet by (quota day, API key, endpoint)
+        self._unrecorded = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def select(self):
+        '''Return the key with the most remaining quota
+
+        :raises: :class:``ytacommon.QuotaExceededError: The quota of all keys is exhausted
+
+        :returns: The API key
+        :rtype: string
+        '''
+        with self._lock:
+            available = [k for k in self.keys if k not in self._exhausted]
+            if not available:
+                raise yta.QuotaExceededError("API quota of all keys exceeded")
+            return max(available, key=lambda k: self._remaining[k])
+
+    def record(self, apiKey, endpoint, count=1):
+        '''Record the units spent for requests to an endpoint in the ledger
+        and in the pool
+
+        :param apiKey: The API key used for the requests
+        :type apiKey: string
+        :param endpoint: The endpoint name (one of the keys of ENDPOINTS)
+        :type endpoint: string
+        :param count: The number of requests (Default: 1)
+        :type count: integer, optional
+        '''
+        with self._lock:
+            self._remaining[apiKey] = max(0, self._remaining[apiKey] - ENDPOINTS[endpoint] * count)
+            key = (getQuotaDay(), apiKey, endpoint)
+            self._unrecorded[key] = self._unrecorded.get(key, 0) + count
+            self._flush()
+
+    def close(self):
+        '''Write the requests that could not be written yet and close the connection to the ledger'''
+        with self._lock:
+            self._flush()
+            if self._db:
+                yta.closeDB(self._db)
+                self._db = None
+
+    def __del__(self):
+        '''Close the pool'''
+        if getattr(self, "_db", None):
+            self.close()
+
+    def _flush(self):
+        '''Write the requests that were not written yet to the ledger, they
+        are kept and written with the next request if the ledger is locked.
+        The pool lock must be held
+        '''
+        if not self._unrecorded:
+            return
+        if not self._db:
+            print("WARNING: Quota ledger already closed, unable to record {} requests".format(sum(self._unrecorded.values())))
+            return
+        try:
+            writeLedger(self._db, self._unrecorded)
+            self._unrecorded = {}
+        except sqlite3.Error as e:
+            print("WARNING: Unable to write to quota ledger, retrying with the next request (\"{}\")".format(e))
+
+    def exhaust(self, apiKey):
+        '''Stop dispatching requests to a key whose quota was exceeded
+
+        :param apiKey: The API key
+        :type apiKey: string
+        '''
+        with self._lock:
+            self._exhausted.add(apiKey)
+            self._remaining[apiKey] = 0
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt:
+        print("Aborted!")
+# ########################################################################### #
@@ -7,16 +7,65 @@ import re
 import argparse
 import time
 import sqlite3
+import pathlib
 import json
 import random
-import yt_dlp
-from yt_dlp.utils import read_batch_urls as readBatchURLs
-from yt_dlp.utils import match_filter_func as matchFilterFunc
-from requests.exceptions import RequestException
+import io
+import queue
+import multiprocessing
+import threading
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import ytacommon as yta
 from ytapost import PostHook
 import ytainfo
 import ytameta
+import ytaquota
+import ytabandwidth
+import ytametrics
+import ytalog
+
+#Loaded on first use to keep the startup fast
+requests = yta.lazyImport("requests")
+yt_dlp = yta.lazyImport("yt_dlp")
+
+# --------------------------------------------------------------------------- #
+#XML namespaces of the playlist feed and timeout of the feed request in seconds
+FEED_NAMESPACES = {"atom": "http://www.w3.org/2005/Atom", "yt": "http://www.youtube.com/xml/schemas/2015"}
+FEED_TIMEOUT = 10
+#Number of consecutive archived videos after which the enumeration of a
+#playlist stops, and interval in seconds of full enumerations of the playlist
+INCREMENTAL_STOP = 10
+FULL_SWEEP_INTERVAL = 7 * 86400
+#Stages of archiving a playlist: discovering and queueing new videos, and downloading the queued videos
+STAGES = ["all", "discover", "download"]
+#Number of failed downloads after which a queued video is not retried anymore
+QUEUE_MAX_ATTEMPTS = 5
+#Classes of unavailable videos with the pattern of their yt-dlp error messages, checked in order
+UNAVAILABLE_CLASSES = [
+    ("upcoming", r"premieres in|live event will begin|scheduled to start"),
+    ("members", r"members[- ]only|join this channel"),
+    ("private", r"private video"),
+    ("age", r"confirm your age|age[- ]restricted|inappropriate for some users"),
+    ("geo", r"not (?:made this video )?available in your country|geo[- ]?restrict"),
+    ("removed", r"has been removed|no longer available|account associated with this video has been terminated"),
+    ("unavailable", r"video unavailable")
+]
+#Time in seconds after which an unavailable video is retried the first time and
+#at most per class, the time doubles with each failure
+RETRY_POLICIES = {
+    "upcoming": (3600, 86400),
+    "members": (7 * 86400, 90 * 86400),
+    "private": (7 * 86400, 90 * 86400),
+    "age": (7 * 86400, 90 * 86400),
+    "geo": (86400, 30 * 86400),
+    "removed": (30 * 86400, 365 * 86400),
+    "unavailable": (86400, 30 * 86400)
+}
+#Counter of the running downloads of all channels archived at the same time,
+#set in the worker processes of archiveAll
+_runningDownloads = None
+# ########################################################################### #
 
 # --------------------------------------------------------------------------- #
 def archive(args, parsed=False):
@@ -31,10 +80,19 @@ def archive(args, parsed=False):
         parser = argparse.ArgumentParser(prog="ytarchiver", description="Download and archive Youtube videos or playlists")
         parser.add_argument("-a", "--all", action="store_const", dest="all", const=True, default=False, help="Run archiver for all subdirectories with archive databases. In this mode, LANG and VIDEO will always be read from the databases")
         parser.add_argument("-c", "--check", action="store_const", dest="check", const="-c", default="", help="Check each file after download")
+        parser.add_argument("-j", "--jobs", action="store", dest="jobs", type=int, default=1, help="Number of channels archived at the same time with -a (Default: 1)")
+        parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=1, help="Number of videos of a channel downloaded at the same time (Default: 1)")
+        parser.add_argument("--limit-rate", action="store", dest="ratelimit", type=parseRate, default=None, help="Max total download rate in bytes per second (e.g. 50K or 4.2M), shared equally by all running downloads")
+        parser.add_argument("--rate-profile", action="store", dest="profile", type=parseProfile, default=None, help="Share of the max download rate during times of the day (e.g. \"08:00-18:00=20%%,18:00-22:00=50%%\"), the full rate outside of the given times")
         group = parser.add_mutually_exclusive_group()
         group.add_argument("-s", "--statistics", action="store_const", dest="statistics", const=True, default=False, help="Update the video statistics")
         group.add_argument("-u", "--captions", action="store_const", dest="captions", const=True, default=False, help="List videos where captions were added since archiving (forces -s)")
         group.add_argument("-x", "--amendcaptions", action="store_const", dest="amendcaptions", const=True, default=False, help="Download captions were they were added since archiving (forces -u and consequently -s)")
+        parser.add_argument("--source", action="store", dest="source", choices=ytameta.STATISTICS_SOURCES, default="auto", help="Where to get the video statistics from: the Youtube Data API, yt-dlp, or the API with yt-dlp as fallback if no API key or quota is available (Default: auto)")
+        parser.add_argument("--noprobe", action="store_const", dest="probe", const=False, default=True, help="Always enumerate the playlist instead of skipping the download when the playlist feed has no new videos")
+        parser.add_argument("--metrics-file", action="store", dest="metrics", default=None, help="Write counters and stage durations in the Prometheus text format to this file when done (e.g. for the textfile collector of the node exporter)")
+        parser.add_argument("--stage", action="store", dest="stage", choices=STAGES, default="all", help="Only discover the new videos of the playlists and queue them, only download the queued videos, or both (Default: all)")
+        parser.add_argument("--fullsweep", action="store_const", dest="fullsweep", const=True, default=False, help="Enumerate the whole playlist instead of stopping after {} consecutive archived videos (done automatically once a week)".format(INCREMENTAL_STOP))
         parser.add_argument("-r", "--replace", action="store_const", dest="replace", const="-r", default="", help="Replace an existing video (a video ID has to be provided)")
         group = parser.add_mutually_exclusive_group()
         group.add_argument("-8k", "--8K", action="store_const", dest="quality", const="8k", help="Limit download resolution to 8K")
@@ -52,6 +110,12 @@ def archive(args, parsed=False):
             parser.error("-a cannot be used in combination with batch file")
         if args.all and args.replace:
             parser.error("-a cannot be used in combination with replace")
+        if args.jobs < 1:
+            parser.error("-j must be at least 1")
+        if args.workers < 1:
+            parser.error("-w must be at least 1")
+        if args.profile and not args.ratelimit:
+            parser.error("--rate-profile requires --limit-rate")
 
 
     #Check if API key provided
@@ -60,6 +124,7 @@ def archive(args, parsed=False):
     #Archive all subdirectories
     if args.all:
         archiveAll(args)
+        _writeMetrics(args.metrics)
         return
 
     #Validate path
@@ -125,31 +190,87 @@ def archive(args, parsed=False):
     dlformat = yta.getFormatString(q)
 
     #Prepare download
-    dlfilePath = os.path.join(path, "downloaded")
-    dbPath = os.path.join(path, "archive.db")
-    writeDownloadedFile(dbPath, dlfilePath, args.replace, args.VIDEO)
+    downloadArchive = DownloadArchive(db, args.VIDEO if args.replace else None)
     dlpath = os.path.join(path, "ID%(id)s&%(title)s.%(ext)s")
     postHook = PostHook(args.LANG, db, args.check, args.replace)
 
-    #Set options
-    ytdlOpts = {"call_home": False, "quiet": False, "format": dlformat, "ignoreerrors": True, "download_archive": dlfilePath, "writesubtitles": True, "subtitleslangs": [args.LANG], "writedescription": True, "writethumbnail": True, "outtmpl": dlpath, "cachedir": False, "youtube_include_dash_manifest": True, "retries": 10, "fragment_retries": 25, "skip_unavailable_fragments": False, "continuedl": True, "extractor_args": {"youtube": {"player_client": ["android"]}}, "throttledratelimit": 100000, "allow_playlist_files": False, "post_hooks": [postHook.finished]}
+    #Set options, playlist entries are processed as they are enumerated and
+    #their info is not kept in memory, so memory does not grow with the playlist
+    ytdlOpts = {"call_home": False, "quiet": False, "format": dlformat, "ignoreerrors": True, "download_archive": downloadArchive, "writesubtitles": True, "subtitleslangs": [args.LANG], "writedescription": True, "writethumbnail": True, "outtmpl": dlpath, "cachedir": False, "youtube_include_dash_manifest": True, "retries": 10, "fragment_retries": 25, "skip_unavailable_fragments": False, "continuedl": True, "extractor_args": {"youtube": {"player_client": ["android"]}}, "throttledratelimit": ytabandwidth.THROTTLED_RATE, "allow_playlist_files": False, "lazy_playlist": True, "extract_flat": "discard_in_playlist", "post_hooks": [postHook.finished], "progress_hooks": [ytametrics.progressHook]}
     ytdlOpts["postprocessors"] = [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}, {"key": "FFmpegMetadata"}, {"key": "EmbedThumbnail","already_have_thumbnail": False}]
     if args.filter:
-        ytdlOpts["match_filter"] = matchFilterFunc(args.filter)
+        ytdlOpts["match_filter"] = MatchFilter(args.filter)
+    #Share the download rate between the channels and videos downloaded at the same time
+    governor = ytabandwidth.BandwidthGovernor(args.ratelimit, args.profile, _runningDownloads)
+    if (parsed and args.jobs > 1) or args.workers > 1:
+        ytdlOpts["noprogress"] = True
 
     #Check if archiving one video/playlist or using a batch file
     if args.file:
         with open(args.file, 'r', encoding="utf-8") as f:
-            url = readBatchURLs(f)
+            url = yt_dlp.utils.read_batch_urls(f)
     else:
         url = [args.VIDEO]
 
+    #Read the playlist cursor, enumerate the whole playlist if it is due
+    incremental = not args.file and not args.replace
+    cursor, lastsweep = db.execute("SELECT cursor,lastsweep FROM channel WHERE id = 1;").fetchone() or (None, 0)
+    fullSweep = args.fullsweep or updateTimestamp - lastsweep >= FULL_SWEEP_INTERVAL
+
+    #Check the feed of the playlist for new videos, not needed for a full
+    #sweep, which looks for older videos that are not in the feed
+    discover = args.stage != "download"
+    newVideos = None
+    downloadQueue = DownloadQueue(db)
+    if discover and args.probe and incremental and not fullSweep:
+        newVideos = probePlaylist(args.VIDEO, downloadArchive, downloadQueue)
+
     #Prepare log
     logFile = os.path.join(path, "log")
     #Download
-    with DoubleLogger(logFile):
-        with yt_dlp.YoutubeDL(ytdlOpts) as ytdl:
-            ytdl.download(url)
+    with ytalog.task(logFile):
+        if newVideos == [] and (not downloadQueue.due(downloadArchive) or args.stage == "discover"):
+            print("INFO: No new videos in the feed of \"{}\", skipping download".format(args.VIDEO))
+        else:
+            with createYoutubeDL(ytdlOpts) as ytdl:
+                #Discover the new videos of the playlist and queue them
+                direct = not incremental
+                if incremental and discover and newVideos != []:
+                    enumerated = enumeratePlaylist(ytdl, args.VIDEO, downloadArchive, None if fullSweep else cursor, None if fullSweep else INCREMENTAL_STOP, downloadQueue.add)
+                    if enumerated is None:
+                        direct = True
+                    else:
+                        #Save the cursor and the time of the full enumeration,
+                        #the discovered videos are kept in the queue until they are archived
+                        if enumerated[0]:
+                            cursor = enumerated[0][0]
+                        if fullSweep:
+                            lastsweep = updateTimestamp
+                        db.execute("UPDATE channel SET cursor = ?, lastsweep = ? WHERE id = 1", (cursor, lastsweep))
+                        db.commit()
+                ytametrics.REGISTRY.set("yta_queue_depth", len(downloadQueue), "videos")
+                #Download the queued videos, or the videos, playlists, or batch file directly
+                if args.stage != "discover":
+                    downloader = ParallelDownloader(ytdlOpts, args.workers, postHook, governor, downloadArchive) if args.workers > 1 else None
+                    download = downloader.download if downloader else lambda urls: governor.download(ytdl, urls)
+                    if direct and downloader and args.file:
+                        #Split the playlists of the batch file into their videos, so that they are downloaded in parallel
+                        for u in url:
+                            enumerated = None if ytdl.get_info_extractor("Youtube").suitable(u) else enumeratePlaylist(ytdl, u, downloadArchive)
+                            download([u] if enumerated is None else ["https://www.youtube.com/watch?v=" + i for i in enumerated[1]])
+                    elif direct:
+                        download(url)
+                    else:
+                        for youtubeID in downloadQueue.pending(downloadArchive):
+                            download(["https://www.youtube.com/watch?v=" + youtubeID])
+                    if downloader:
+                        downloader.close()
+                    #Skip the unavailable videos until they are retried
+                    downloadArchive.updateUnavailable(ytdl.unavailable + (downloader.unavailable if downloader else []))
+                    downloadQueue.finish(ytdlOpts["match_filter"].rejected if args.filter else ())
+                    ytametrics.REGISTRY.set("yta_queue_depth", len(downloadQueue), "videos")
+                elif direct:
+                    print("WARNING: Only the videos of playlists can be queued, nothing to do for \"{}\"".format(args.VIDEO or args.file))
 
     #Print status
     print("Download complete, updating database...")
@@ -160,28 +281,38 @@ def archive(args, parsed=False):
     except sqlite3.Error:
         pass
 
+    #Load the metadata that could not be loaded while archiving
+    try:
+        ytameta.backfillMetadata(db)
+    except yta.NoAPIKeyError:
+        print("WARNING: Unable to load queued metadata as no API key is available")
+
     #Update statistics
     if args.statistics or args.captions or args.amendcaptions:
         print("Updating video statistics...")
         try:
-            ytameta.updateStatistics(db, updateTimestamp, args.captions, amendCaptions=args.amendcaptions)
+            keys = ytaquota.KeyPool()
+            source, count = ytameta.getStatisticsSource(args.source, keys)
+            if source == "api" and not keys:
+                raise yta.NoAPIKeyError
+            if source == "ytdlp":
+                print("INFO: Updating video statistics with yt-dlp")
+            ytameta.updateStatistics(db, updateTimestamp, args.captions, count, keys, args.amendcaptions, source=source)
         except yta.NoAPIKeyError:
             print("ERROR: Unable to update video statistics as no API key is available")
-        except RequestException as e:
+        except requests.exceptions.RequestException as e:
             print("ERROR: Unable to update video statistics due to connection error: \"{}\"".format(e))
 
     #Close database
     yta.closeDB(db)
 
+    #Write metrics
+    if not parsed:
+        _writeMetrics(args.metrics)
+
     #Print time
     t2 = time.time()
     print("DONE! Duration: " + yta.intervalToStr(t2-t1))
-
-    #Remove download archive file
-    try:
-        os.remove(dlfilePath)
-    except OSError:
-        pass
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -249,24 +380,38 @@ def archiveAll(args):
     try:
         t2 = time.time()
         leftover = subdirs.copy()
-        for subdir in subdirs:
-            counter += 1
-            name = os.path.basename(os.path.normpath(subdir))
-            args.DIR = subdir
-            args.LANG = None
-            args.VIDEO = None
-            print("\nARCHIVING \'{}\' ({}/{})".format(name, counter, channels))
-            archive(args, True)
-            #Read errors from log
-            error = ""
-            with open(os.path.join(subdir, "log"), 'r') as f:
-                lines = f.readlines()
-                for i in range(len(lines)):
-                    if lines[i].startswith("ERROR"):
-                        error += "\n" + lines[i-1] + lines[i]
-            if error:
-                errorLog += '\n\n' + name + '\n' + error
-            leftover.remove(subdir)
+        if args.jobs > 1:
+            #Archive several channels at once, each in its own process. The
+            #output of a channel is printed when it is finished
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=initWorker, initargs=(multiprocessing.Value('i', 0),)) as executor:
+                futures = {executor.submit(archiveChannel, args, subdir): subdir for subdir in subdirs}
+                try:
+                    for future in as_completed(futures):
+                        subdir = futures[future]
+                        output, metrics = future.result()
+                        ytametrics.REGISTRY.merge(metrics)
+                        counter += 1
+                        name = os.path.basename(os.path.normpath(subdir))
+                        print("\nARCHIVED \'{}\' ({}/{})".format(name, counter, channels))
+                        print(output, end='')
+                        errorLog += _readErrors(subdir, name)
+                        leftover.remove(subdir)
+                except KeyboardInterrupt:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    #The counter points to the channel being archived when aborting
+                    counter += 1
+                    raise
+        else:
+            for subdir in subdirs:
+                counter += 1
+                name = os.path.basename(os.path.normpath(subdir))
+                args.DIR = subdir
+                args.LANG = None
+                args.VIDEO = None
+                print("\nARCHIVING \'{}\' ({}/{})".format(name, counter, channels))
+                archive(args, True)
+                errorLog += _readErrors(subdir, name)
+                leftover.remove(subdir)
     except KeyboardInterrupt:
         #Aborting, write progress file and log
         t = time.time()
@@ -314,10 +459,10 @@ def archiveAll(args):
     if updateStatistics or autoUpdateStatistics or updateCaptions or amendCaptions:
         statTime = True
         try:
-            ytameta.updateAllStatistics(path, autoUpdateStatistics, updateCaptions, amendCaptions)
+            ytameta.updateAllStatistics(path, autoUpdateStatistics, updateCaptions, amendCaptions, args.source)
         except yta.NoAPIKeyError:
             print("ERROR: Unable to update video statistics as no API key is available")
-        except RequestException as e:
+        except requests.exceptions.RequestException as e:
             print("ERROR: Unable to update video statistics due to connection error: \"{}\"".format(e))
     else:
         statTime = False
@@ -333,34 +478,212 @@ def archiveAll(args):
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def writeDownloadedFile(dbPath, filePath, replace, videoID):
-    '''Write file containing Youtube IDs of all videos already archived
+def archiveChannel(args, subdir):
+    '''Archive one channel in a worker process of archiveAll or ytadaemon and return its
+    output instead of printing it, together with the metrics of the channel
 
-    :param dbPath: Path of the archive database
-    :type dbPath: string
-    :param filePath: Path where the file containing all existing IDs should be written to
-    :type filePath: string
-    :param replace: Whether to replace the existing video in the archive database
-    :type replace: boolean
-    :param videoID: The new video id
-    :type videoID: string
+    :param args: The command line arguments given by the user
+    :type args: argparse.Namespace
+    :param subdir: The directory of the channel archive
+    :type subdir: string
+
+    :returns: Tuple of the output (string) and the metrics (dict, see ytametrics.Registry.snapshot)
+    :rtype: tuple
     '''
-    #Check if db exists
-    if not os.path.isfile(dbPath):
-        return
+    ytametrics.REGISTRY.reset()
+    args.DIR = subdir
+    args.LANG = None
+    args.VIDEO = None
+    output = io.StringIO()
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = output
+    sys.stderr = output
     try:
-        with open(filePath, 'w+') as f:
-            #Connect to database
-            db = yta.connectDB(dbPath)
-            #Read IDs of all videos already in archive
-            r = db.execute("SELECT youtubeID FROM videos;")
-            for item in r.fetchall():
-                #Write IDs to file
-                if not (replace and videoID == item[0]):
-                    f.write("youtube {}\n".format(item[0]))
-            yta.closeDB(db)
-    except sqlite3.Error:
+        archive(args, True)
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+    return output.getvalue(), ytametrics.REGISTRY.snapshot()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def initWorker(runningDownloads):
+    '''Initialize a worker process of archiveAll or ytadaemon
+
+    :param runningDownloads: Counter of the running downloads of all worker processes
+    :type runningDownloads: multiprocessing.Value
+    '''
+    global _runningDownloads
+    _runningDownloads = runningDownloads
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _readErrors(subdir, name):
+    '''Read the errors from the log of a channel archive
+
+    :param subdir: The directory of the channel archive
+    :type subdir: string
+    :param name: The channel/subdir name
+    :type name: string
+
+    :returns: The errors with the preceding lines for the error log, empty if there were none
+    :rtype: string
+    '''
+    error = ""
+    with open(os.path.join(subdir, "log"), 'r') as f:
+        lines = f.readlines()
+        for i in range(len(lines)):
+            if lines[i].startswith("ERROR"):
+                error += "\n" + lines[i-1] + lines[i]
+    if error:
+        return '\n\n' + name + '\n' + error
+    return ""
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def _writeMetrics(path):
+    '''Write the metrics to a file if a path is given
+
+    :param path: The file path (Default: do not write the metrics)
+    :type path: string
+    '''
+    if not path:
         return
+    try:
+        ytametrics.writeTextfile(path)
+    except OSError as e:
+        print("ERROR: Unable to write the metrics to \"{}\": \"{}\"".format(path, e))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def parseRate(rate):
+    '''Parse a download rate for argparse
+
+    :param rate: The rate in bytes per second, optionally with a suffix (e.g. 50K or 4.2M)
+    :type rate: string
+
+    :raises: :class:``argparse.ArgumentTypeError: Invalid rate
+
+    :returns: The rate in bytes per second
+    :rtype: integer
+    '''
+    parsed = yt_dlp.utils.parse_bytes(rate)
+    if not parsed:
+        raise argparse.ArgumentTypeError("invalid rate \"{}\"".format(rate))
+    return parsed
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def parseProfile(profile):
+    '''Parse a time-of-day profile of the download rate for argparse
+
+    :param profile: The profile (e.g. "08:00-18:00=20%,18:00-22:00=50%")
+    :type profile: string
+
+    :raises: :class:``argparse.ArgumentTypeError: Invalid profile
+
+    :returns: The windows of the profile
+    :rtype: list of tuple
+    '''
+    try:
+        return ytabandwidth.parseProfile(profile)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def probePlaylist(playlist, archive, downloadQueue):
+    '''Check the feed of a playlist or channel, which lists the newest videos,
+    for videos that are not in the archive or the download queue yet. This is
+    much cheaper than enumerating the whole playlist with yt-dlp
+
+    :param playlist: The Youtube playlist or channel ID
+    :type playlist: string
+    :param archive: The download archive, unavailable videos are new once they are retried
+    :type archive: DownloadArchive
+    :param downloadQueue: The download queue, queued videos are not new, including failed and rejected ones
+    :type downloadQueue: DownloadQueue
+
+    :returns: List of the Youtube IDs in the feed that are neither archived nor queued, None if the feed is not available
+    :rtype: list of string
+    '''
+    #Only IDs have a feed, not URLs or single videos
+    if re.fullmatch(r"UC[0-9A-Za-z_-]{22}", playlist):
+        query = "channel_id=" + playlist
+    elif re.fullmatch(r"(UU|PL|FL|OL)[0-9A-Za-z_-]{10,}", playlist):
+        query = "playlist_id=" + playlist
+    else:
+        return None
+    try:
+        r = requests.get(yta.getServiceURL("feed", "/feeds/videos.xml?" + query), timeout=FEED_TIMEOUT)
+        r.raise_for_status()
+        feed = ElementTree.fromstring(r.content)
+    except (requests.exceptions.RequestException, ElementTree.ParseError):
+        return None
+    ids = [e.text for e in feed.iterfind("atom:entry/yt:videoId", FEED_NAMESPACES) if e.text]
+    #An empty feed is not conclusive, e.g. for playlists that only contain older videos
+    if not ids:
+        return None
+    return [i for i in ids if "youtube " + i not in archive and i not in downloadQueue]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def enumeratePlaylist(ytdl, playlist, archive, cursor=None, stopAfter=None, process=None):
+    '''Enumerate the videos of a playlist in playlist order (newest first for
+    uploads) without resolving them. The pages of the playlist are only
+    requested as far as needed: the enumeration stops at the cursor or after
+    a number of consecutive videos that are already archived. Videos that are
+    not archived can be processed while enumerating, so that only one video is
+    resolved at a time
+
+    :param ytdl: The yt-dlp instance
+    :type ytdl: yt_dlp.YoutubeDL
+    :param playlist: The Youtube playlist ID or URL
+    :type playlist: string
+    :param archive: The download archive
+    :type archive: DownloadArchive
+    :param cursor: Youtube ID at which to stop, the newest video of the previous enumeration (Default: None)
+    :type cursor: string, optional
+    :param stopAfter: Number of consecutive archived videos after which to stop (Default: enumerate all)
+    :type stopAfter: integer, optional
+    :param process: Function called with the Youtube ID of each video that is not archived before the next video is enumerated (Default: None)
+    :type process: function, optional
+
+    :returns: Tuple with the list of the enumerated Youtube IDs and the list of the IDs that are not archived,
+        None if the playlist could not be enumerated or does not consist of videos (e.g. a channel with tabs)
+    :rtype: tuple(list, list)
+    '''
+    info = ytdl.extract_info(playlist, download=False, process=False)
+    #Follow the redirects, e.g. from a playlist ID to the playlist page
+    for _ in range(3):
+        if not info or info.get("_type") not in ("url", "url_transparent"):
+            break
+        info = ytdl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+    if not info or info.get("_type") != "playlist":
+        return None
+    enumerated = []
+    new = []
+    known = 0
+    for entry in info.get("entries") or []:
+        if not entry:
+            continue
+        if entry.get("ie_key") != "Youtube" or not entry.get("id"):
+            return None
+        youtubeID = entry["id"]
+        if youtubeID == cursor:
+            break
+        enumerated.append(youtubeID)
+        if "youtube " + youtubeID in archive:
+            known += 1
+            if stopAfter and known >= stopAfter:
+                break
+        else:
+            known = 0
+            new.append(youtubeID)
+            if process:
+                process(youtubeID)
+    return (enumerated, new)
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -383,55 +706,391 @@ def readInfoFromDB(dbPath):
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-class DoubleLogger:
-    '''Double logger context
-    Get messages to stdout and stderr, print them to stdout and write them to a log
+def classifyError(message):
+    '''Return the class of a video that is unavailable according to an error message of yt-dlp
+
+    :param message: The error message
+    :type message: string
+
+    :returns: The class (one of the keys of RETRY_POLICIES), None if the error is not caused by the video being unavailable
+    :rtype: string
+    '''
+    for reason, pattern in UNAVAILABLE_CLASSES:
+        if re.search(pattern, message, re.IGNORECASE):
+            return reason
+    return None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class UnavailableCollector:
+    '''Mixin for yt_dlp.YoutubeDL that collects the videos that failed to
+    download because they are unavailable
     '''
-    def __init__(self, log):
+
+    def __init__(self, *args, **kwargs):
+        '''Init, see yt_dlp.YoutubeDL'''
+        #The unavailable videos as (Youtube ID, class)
+        self.unavailable = []
+        super().__init__(*args, **kwargs)
+
+    def report_error(self, message, *args, **kwargs):
+        '''Collect the video if the error is caused by it being unavailable, then report the error'''
+        match = re.search(r"\[youtube\] ([0-9A-Za-z_-]{11}): (.*)", message)
+        if match:
+            reason = classifyError(match.group(2))
+            if reason:
+                self.unavailable.append((match.group(1), reason))
+        return super().report_error(message, *args, **kwargs)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+#The yt-dlp class with UnavailableCollector, created on first use so that
+#yt_dlp is not imported before something is downloaded
+_ArchiveYoutubeDL = None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createYoutubeDL(params):
+    '''Create a yt-dlp instance that collects the unavailable videos
+
+    :param params: The yt-dlp options
+    :type params: dict
+
+    :returns: The yt-dlp instance, with the unavailable videos as (Youtube ID, class) in its unavailable attribute
+    :rtype: yt_dlp.YoutubeDL
+    '''
+    global _ArchiveYoutubeDL
+    if _ArchiveYoutubeDL is None:
+        _ArchiveYoutubeDL = type("ArchiveYoutubeDL", (UnavailableCollector, yt_dlp.YoutubeDL), {})
+    return _ArchiveYoutubeDL(params)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class DownloadArchive:
+    '''Download archive for yt-dlp backed by the videos table of the archive
+    database. yt-dlp checks each video with "in" and adds downloaded videos
+    with add(), so the archived IDs are looked up in the database instead of
+    being loaded from a file. Unavailable videos are treated as archived until
+    they are retried
+    '''
+
+    def __init__(self, db, exclude=None):
         '''Init
 
-        :param log: Location of the new log file
-        :type log: path-like
+        :param db: Connection to the archive database
+        :type db: sqlite3.Connection
+        :param exclude: Youtube ID that is treated as not archived, e.g. the video to replace (Default: None)
+        :type exclude: string, optional
+        '''
+        self.db = db
+        self.exclude = exclude
+        self.now = int(time.time())
+        #Videos added during this run, before or without being written to the database
+        self.added = set()
+
+    def __contains__(self, archiveID):
+        '''Check whether a video was already archived
+
+        :param archiveID: The archive ID of yt-dlp (extractor and video ID, e.g. "youtube dQw4w9WgXcQ")
+        :type archiveID: string
+
+        :returns: Whether the video was archived or is unavailable and not retried yet
+        :rtype: boolean
         '''
-        self.oldout = sys.stdout
-        self.olderr = sys.stderr
-        self.term = sys.stdout
-        self.log = open(log, 'w+')
-        self.filter = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-
-    def __enter__(self):
-        '''Enter context, start logging to stdout and log file'''
-        sys.stdout = self
-        sys.stderr = self
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        '''Exit context, restore stdout and stderr'''
-        sys.stdout = self.oldout
-        sys.stderr = self.olderr
-        self.close()
-
-    def write(self, msg):
-        '''Write a message to stdout and the log file
-
-        :param msg: The message
-        :type msg: string
+        if archiveID in self.added:
+            return True
+        extractor, _, youtubeID = archiveID.partition(' ')
+        if extractor != "youtube" or youtubeID == self.exclude:
+            return False
+        return self.db.execute("SELECT 1 FROM videos WHERE youtubeID = ? UNION ALL SELECT 1 FROM unavailable WHERE youtubeID = ? AND retry > ?;", (youtubeID, youtubeID, self.now)).fetchone() is not None
+
+    def archived(self, youtubeID):
+        '''Check whether a video was archived, not counting unavailable videos
+
+        :param youtubeID: The Youtube ID
+        :type youtubeID: string
+
+        :returns: Whether the video was archived
+        :rtype: boolean
         '''
-        self.term.write(msg)
-        self.log.write(self.filter.sub('', msg))
+        if "youtube " + youtubeID in self.added:
+            return True
+        return self.db.execute("SELECT 1 FROM videos WHERE youtubeID = ?;", (youtubeID,)).fetchone() is not None
 
-    def flush(self):
-        '''Flush the log file'''
-        self.log.flush()
+    def updateUnavailable(self, unavailable):
+        '''Record the failures of unavailable videos and schedule their next
+        retry, remove the videos that were archived in the meantime
 
-    def close(self):
-        '''Close the log file'''
-        self.log.close()
+        :param unavailable: The unavailable videos as (Youtube ID, class)
+        :type unavailable: list of tuple
+        '''
+        for youtubeID, reason in dict(unavailable).items():
+            r = self.db.execute("SELECT failures FROM unavailable WHERE youtubeID = ? AND reason = ?;", (youtubeID, reason)).fetchone()
+            failures = r[0] + 1 if r else 1
+            first, longest = RETRY_POLICIES[reason]
+            retry = self.now + min(longest, first * 2 ** (failures - 1))
+            self.db.execute("INSERT OR REPLACE INTO unavailable(youtubeID, reason, failures, lastfailure, retry) VALUES(?,?,?,?,?);", (youtubeID, reason, failures, self.now, retry))
+            print("INFO: Video {} is unavailable ({}), skipping it until {}".format(youtubeID, reason, time.strftime("%Y-%m-%d %H:%M", time.localtime(retry))))
+        self.db.execute("DELETE FROM unavailable WHERE youtubeID IN (SELECT youtubeID FROM videos);")
 
-    @staticmethod
-    def isatty():
-        '''Answer True to "Is a TTY?" question'''
+    def __bool__(self):
+        '''The archive is always checked, as the database is only queried for single IDs'''
         return True
+
+    def copy(self):
+        '''Return a copy for another thread, which reads the database with its
+        own connection that may only be used by that thread. The videos added
+        during this run are shared with the copy
+
+        :raises: :class:``sqlite3.Error: Unable to connect to the database
+
+        :returns: The copy, its connection has to be closed by the thread using it
+        :rtype: DownloadArchive
+        '''
+        path = self.db.execute("PRAGMA database_list;").fetchone()[2]
+        archive = DownloadArchive(sqlite3.connect(pathlib.Path(path).as_uri() + "?mode=ro", uri=True, check_same_thread=False), self.exclude)
+        archive.now = self.now
+        archive.added = self.added
+        return archive
+
+    def add(self, archiveID):
+        '''Mark a video as archived
+
+        :param archiveID: The archive ID of yt-dlp
+        :type archiveID: string
+        '''
+        self.added.add(archiveID)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class MatchFilter:
+    '''Match filter for yt-dlp that records the videos it rejects, as the
+    filter can only be applied once a video is resolved, not while the
+    playlist is enumerated
+    '''
+
+    def __init__(self, filters):
+        '''Init
+
+        :param filters: The match filter (see the --match-filters option of yt-dlp)
+        :type filters: string
+        '''
+        self._filter = yt_dlp.utils.match_filter_func(filters)
+        #The Youtube IDs of the rejected videos
+        self.rejected = set()
+
+    def __call__(self, info, incomplete=False):
+        '''Apply the filter, see yt_dlp.utils.match_filter_func'''
+        reason = self._filter(info, incomplete)
+        if isinstance(reason, str) and not incomplete and info.get("id"):
+            self.rejected.add(info["id"])
+        return reason
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class DownloadQueue:
+    '''Queue of the discovered videos that are not archived yet, backed by the
+    download_queue table of the archive database. Each video is committed as
+    soon as it is queued, so that an aborted run only repeats the download of
+    the videos that were not archived yet
+    '''
+
+    def __init__(self, db):
+        '''Init
+
+        :param db: Connection to the archive database
+        :type db: sqlite3.Connection
+        '''
+        self.db = db
+
+    def __len__(self):
+        '''Return the number of videos waiting to be downloaded'''
+        return self.db.execute("SELECT count(*) FROM download_queue WHERE state NOT IN ('failed', 'rejected');").fetchone()[0]
+
+    def __contains__(self, youtubeID):
+        '''Check whether a video is in the queue, in any state
+
+        :param youtubeID: The Youtube ID
+        :type youtubeID: string
+
+        :returns: Whether the video is queued
+        :rtype: boolean
+        '''
+        return self.db.execute("SELECT 1 FROM download_queue WHERE youtubeID = ?;", (youtubeID,)).fetchone() is not None
+
+    def due(self, archive):
+        '''Return the number of videos that would be downloaded now, which
+        excludes the unavailable videos that are not retried yet
+
+        :param archive: The download archive
+        :type archive: DownloadArchive
+
+        :returns: The number of videos
+        :rtype: integer
+        '''
+        return self.db.execute("SELECT count(*) FROM download_queue WHERE state NOT IN ('failed', 'rejected') AND youtubeID NOT IN (SELECT youtubeID FROM unavailable WHERE retry > ?);", (archive.now,)).fetchone()[0]
+
+    def add(self, youtubeID):
+        '''Queue a video if it is not queued yet
+
+        :param youtubeID: The Youtube ID
+        :type youtubeID: string
+        '''
+        self.db.execute("INSERT OR IGNORE INTO download_queue(youtubeID, added) VALUES(?,?);", (youtubeID, int(time.time())))
+        self.db.commit()
+
+    def pending(self, archive):
+        '''Yield the queued videos in the order they were queued and mark them
+        as downloading. Archived videos are removed from the queue, unavailable
+        videos are skipped until they are retried
+
+        :param archive: The download archive
+        :type archive: DownloadArchive
+
+        :returns: Generator of the Youtube IDs
+        :rtype: generator
+        '''
+        #Videos that were being downloaded when a previous run was aborted
+        self.db.execute("UPDATE download_queue SET state = 'pending' WHERE state = 'downloading';")
+        for (youtubeID,) in self.db.execute("SELECT youtubeID FROM download_queue WHERE state = 'pending' ORDER BY added, rowid;").fetchall():
+            if archive.archived(youtubeID):
+                self.db.execute("DELETE FROM download_queue WHERE youtubeID = ?;", (youtubeID,))
+                continue
+            if "youtube " + youtubeID in archive:
+                continue
+            self.db.execute("UPDATE download_queue SET state = 'downloading', attempts = attempts + 1, lastattempt = ? WHERE youtubeID = ?;", (int(time.time()), youtubeID))
+            self.db.commit()
+            yield youtubeID
+
+    def finish(self, rejected=()):
+        '''Remove the archived videos from the queue and mark the videos
+        rejected by the match filter as rejected, so that they are not
+        resolved again. The videos whose download failed are pending again,
+        unless they failed QUEUE_MAX_ATTEMPTS times for other reasons than
+        being unavailable, then they are not retried anymore
+
+        :param rejected: The Youtube IDs of the videos rejected by the match filter (Default: none)
+        :type rejected: iterable
+        '''
+        self.db.execute("DELETE FROM download_queue WHERE youtubeID IN (SELECT youtubeID FROM videos);")
+        self.db.executemany("UPDATE download_queue SET state = 'rejected' WHERE youtubeID = ?;", [(youtubeID,) for youtubeID in rejected])
+        failed = self.db.execute("SELECT youtubeID,attempts FROM download_queue WHERE state = 'downloading' AND attempts >= ? AND youtubeID NOT IN (SELECT youtubeID FROM unavailable);", (QUEUE_MAX_ATTEMPTS,)).fetchall()
+        for youtubeID, attempts in failed:
+            print("WARNING: Download of video {} failed {} times, not retrying it anymore".format(youtubeID, attempts))
+        self.db.executemany("UPDATE download_queue SET state = 'failed' WHERE youtubeID = ?;", [(youtubeID,) for youtubeID, _ in failed])
+        self.db.execute("UPDATE download_queue SET state = 'pending' WHERE state = 'downloading';")
+        self.db.commit()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class ParallelDownloader:
+    '''Downloads videos with several yt-dlp instances at once, each in its own
+    worker thread. The post-processing of the downloaded videos, which writes
+    to the archive database, is serialized and done in the thread that owns
+    the database connection whenever it calls download() or close()
+    '''
+
+    def __init__(self, ytdlOpts, workers, postHook, governor, archive=None):
+        '''Init, start the workers
+
+        :param ytdlOpts: The yt-dlp options
+        :type ytdlOpts: dict
+        :param workers: The number of videos downloaded at the same time
+        :type workers: integer
+        :param postHook: The post-processing of the downloaded videos
+        :type postHook: ytapost.PostHook
+        :param governor: The governor of the download rate
+        :type governor: ytabandwidth.BandwidthGovernor
+        :param archive: The download archive, each worker checks the videos against a copy of it (Default: no archive)
+        :type archive: DownloadArchive, optional
+        '''
+        self._postHook = postHook
+        self._governor = governor
+        #The output of the workers is written to the log of the channel
+        self._log = ytalog.currentTask()
+        #A video is only handed over when the previous one was taken by a
+        #worker, so the queued videos are not marked as downloading (and
+        #charged an attempt) long before a worker starts them
+        self._urls = queue.Queue(1)
+        self._finished = queue.Queue()
+        #The unavailable videos as (Youtube ID, class)
+        self.unavailable = []
+        #The database connection of the download archive is bound to its
+        #thread, so each worker gets its own copy of the archive
+        opts = dict(ytdlOpts, download_archive=None, post_hooks=[self._finished.put])
+        self._workers = [threading.Thread(target=self._work, args=(dict(opts), archive.copy() if archive else None), daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def download(self, urls):
+        '''Hand videos over to the workers, waiting for a worker to take each
+        of them, and post-process the videos downloaded so far
+
+        :param urls: The URLs of the videos
+        :type urls: list of string
+        '''
+        for url in urls:
+            self._handOver(url)
+        ytametrics.REGISTRY.set("yta_queue_depth", self._urls.qsize(), "downloads")
+        self._postProcess(False)
+
+    def close(self):
+        '''Wait until all queued videos are downloaded and post-processed'''
+        for _ in self._workers:
+            self._handOver(None)
+        while any(worker.is_alive() for worker in self._workers):
+            self._postProcess(True)
+        self._postProcess(False)
+
+    def _handOver(self, url):
+        '''Queue a video once the previous one was taken by a worker,
+        post-processing the downloaded videos while waiting
+
+        :param url: The URL of the video, None to stop a worker
+        :type url: string
+        '''
+        while True:
+            try:
+                self._urls.put(url, timeout=0.1)
+                return
+            except queue.Full:
+                self._postProcess(False)
+
+    def _postProcess(self, wait):
+        '''Post-process the downloaded videos
+
+        :param wait: Whether to wait up to a second for a video if none is downloaded yet
+        :type wait: boolean
+        '''
+        while True:
+            try:
+                filename = self._finished.get(wait, 1)
+            except queue.Empty:
+                return
+            self._postHook.finished(filename)
+            wait = False
+
+    def _work(self, opts, archive):
+        '''Download the queued videos until the queue is closed
+
+        :param opts: The yt-dlp options
+        :type opts: dict
+        :param archive: The copy of the download archive of the worker
+        :type archive: DownloadArchive
+        '''
+        opts["download_archive"] = archive
+        try:
+            with ytalog.bind(self._log), createYoutubeDL(opts) as ytdl:
+                while True:
+                    url = self._urls.get()
+                    if url is None:
+                        self.unavailable.extend(ytdl.unavailable)
+                        return
+                    ytametrics.REGISTRY.set("yta_queue_depth", self._urls.qsize(), "downloads")
+                    self._governor.download(ytdl, [url])
+        finally:
+            if archive:
+                archive.db.close()
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #